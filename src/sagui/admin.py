@@ -113,6 +113,31 @@ class SaguiConfigAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(models.PostProcessingJob)
+class PostProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'tablename', 'status', 'attempts', 'created_at', 'started_at', 'duration', 'last_error']
+    list_filter = ['status', 'tablename']
+
+
+@admin.register(models.PostProcessingStep)
+class PostProcessingStepAdmin(admin.ModelAdmin):
+    list_display = ['step', 'status', 'started_at', 'duration', 'attempts', 'job', 'error']
+    list_filter = ['status', 'step']
+
+
+@admin.register(models.FilesManifest)
+class FilesManifestAdmin(admin.ModelAdmin):
+    list_display = ['name', 'folder', 'file_date', 'version', 'size', 'import_status', 'imported_at']
+    list_filter = ['folder', 'import_status']
+    search_fields = ['name']
+
+
+@admin.register(models.DatasetDate)
+class DatasetDateAdmin(admin.ModelAdmin):
+    list_display = ['tablename', 'date', 'first_imported', 'last_updated']
+    list_filter = ['tablename']
+
+
 @admin.register(models.AlertSubscriptions)
 class AlertSubscriptionsAdmin(admin.ModelAdmin):
     fieldsets = (
@@ -0,0 +1,299 @@
+import math
+import shutil
+import tempfile
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+
+from sagui.utils import anomaly as anomaly_utils, db as db_utils, instrumentation, pgcopy
+
+
+class Command(instrumentation.InstrumentedCommand):
+    help = '''
+    Micro-benchmarks, comparing the current implementation of some critical paths with the former one:
+      * copy: binary COPY encoder (sagui.utils.pgcopy) vs CSV text (DataFrame.to_csv), on synthetic hyfaa-like data.
+        Encoding only, then COPY into a temporary table (rolled back)
+      * anomaly: set-based compute_expected_and_anomaly vs the former, per-date, implementation, on the real data.
+        The expected/anomaly values of the last --days days are reset then computed by both functions, and the results
+        are compared. With --past_update, the values of the year before are then rewritten (like an import would) and
+        both functions are compared again: the cached expected values of that year and the next ones must be
+        invalidated. Everything is rolled back. The numpy engine (sagui.utils.anomaly, hyfaa_import --anomaly_engine
+        numpy) is then run on the same dates, from a history cube loaded from the DB, and compared with the SQL results
+      * tiles: MVT tiles of the hyfaa_*_aggregated_geo views (plain views, regenerated when the dataset changes) vs the
+        former proxy views over the func_hyfaa_*_aggregated_geo functions. All the tiles of --zoom covering the data
+        are generated, using the same query as pg_tileserv
+    The timings are reported in the stages table, at the end of the command
+    '''
+
+    # Class-wide variables, that will be set using command options
+    rows        = None
+    repeat      = None
+    no_db       = None
+    table       = None
+    column      = None
+    days        = None
+    batch_size  = None
+    past_update = None
+    zoom        = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('target',
+                            choices=['copy', 'anomaly', 'tiles'],
+                            help='What to benchmark')
+        parser.add_argument('--rows',
+                            type=int,
+                            default=1000000,
+                            help='Nb of rows of the synthetic data (default 1000000)')
+        parser.add_argument('--repeat',
+                            type=int,
+                            default=3,
+                            help='Nb of runs of each method (default 3)')
+        parser.add_argument('--table',
+                            default='hyfaa_data_mgbstandard',
+                            help='anomaly: table to compute the values on (default hyfaa_data_mgbstandard)')
+        parser.add_argument('--column',
+                            default='flow_mean',
+                            help='anomaly: column the expected value is computed from (default flow_mean)')
+        parser.add_argument('--days',
+                            type=int,
+                            default=365,
+                            help='anomaly: nb of days (the most recent ones) to compute (default 365)')
+        parser.add_argument('--batch_size',
+                            type=int,
+                            default=100,
+                            help='anomaly: nb of dates per UPDATE statement, for the set-based function (default 100)')
+        parser.add_argument('--past_update',
+                            default=False,
+                            action='store_true',
+                            help='anomaly: compare the functions again after rewriting the values of a past year')
+        parser.add_argument('--zoom',
+                            type=int,
+                            default=8,
+                            help='tiles: zoom level of the tiles (default 8)')
+        parser.add_argument('--no_db',
+                            default=False,
+                            action='store_true',
+                            help='Only benchmark the client-side part (no DB connection needed)')
+
+    def handle(self, *args, **kwargs):
+        self.rows = kwargs.get('rows')
+        self.repeat = kwargs.get('repeat')
+        self.no_db = kwargs.get('no_db') or self.dry_run
+        self.table = kwargs.get('table')
+        self.column = kwargs.get('column')
+        self.days = kwargs.get('days')
+        self.batch_size = kwargs.get('batch_size')
+        self.past_update = kwargs.get('past_update')
+        self.zoom = kwargs.get('zoom')
+        getattr(self, 'benchmark_{}'.format(kwargs['target']))()
+
+    @staticmethod
+    def _hyfaa_like_dataframe(nb_rows, nb_cells=3000):
+        """
+        Synthetic data, with the structure of a hyfaa_import page (the cells vary fastest)
+        """
+        rng = np.random.default_rng(0)
+        nb_times = -(-nb_rows // nb_cells)
+        dates = np.datetime64('2020-01-01', 'D') + np.arange(nb_times).astype('timedelta64[D]')
+        df = pd.DataFrame({
+            'cell_id': np.tile(np.arange(1, nb_cells + 1, dtype='i2'), nb_times)[:nb_rows],
+            'date': np.repeat(dates, nb_cells)[:nb_rows],
+            'update_time': np.repeat(dates + np.timedelta64(3, 'D'), nb_cells)[:nb_rows],
+            'is_analysis': rng.random(nb_rows) > 0.5,
+            'flow_median': rng.gamma(2, 500, nb_rows),
+            'flow_mad': rng.gamma(2, 50, nb_rows),
+        }, copy=False)
+        return df
+
+    def benchmark_copy(self):
+        df = self._hyfaa_like_dataframe(self.rows)
+        columns = list(df.columns)
+        types = ['int2', 'date', 'timestamptz', 'bool', 'float8', 'float8']
+        self.stdout.write('{} rows: {}'.format(len(df), ', '.join('{} {}'.format(c, t) for c, t in zip(columns, types))))
+
+        for _ in range(self.repeat):
+            with self.timer.stage('csv encode', rows=len(df)) as stage:
+                stage.nbytes = len(df.to_csv(header=False, index=False))
+            with self.timer.stage('binary encode', rows=len(df)) as stage:
+                stage.nbytes = sum(len(memoryview(b)) for b in pgcopy.encode([db_utils.dataframe_arrays(df)], types))
+        if self.no_db:
+            return
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE benchmark_copy ({}) ON COMMIT DROP;'.format(
+                ','.join('{} {}'.format(c, t) for c, t in zip(columns, types))))
+            for _ in range(self.repeat):
+                for binary in (False, True):
+                    cursor.execute('TRUNCATE benchmark_copy;')
+                    with self.timer.stage('{} copy'.format('binary' if binary else 'csv'), rows=len(df)):
+                        db_utils.copy_dataframe(cursor, df, 'benchmark_copy', binary=binary)
+            transaction.set_rollback(True)
+
+    def benchmark_anomaly(self):
+        if self.no_db:
+            raise CommandError('The anomaly benchmark needs the DB')
+        table = 'guyane.{}'.format(self.table)
+        functions = [
+            ('legacy', 'SELECT guyane.compute_expected_and_anomaly_legacy(%s, %s, %s, 10);', [table, table, self.column]),
+            ('set-based', 'SELECT guyane.compute_expected_and_anomaly(%s, %s, %s, 10, %s, %s);',
+             [table, table, self.column, '1950-01-01', self.batch_size]),
+        ]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT MAX("date") - %s FROM {};'.format(table), [self.days])
+            since = cursor.fetchone()[0]
+            self.stdout.write('Computing the expected and anomaly values of {} from {}'.format(table, since))
+            self._compare_anomaly_functions(cursor, functions, since)
+            if self.past_update:
+                year = since.year - 1
+                cursor.execute(
+                    '''
+                    UPDATE {table} SET {col} = {col} * 1.5 WHERE "date" >= make_date(%s, 1, 1) AND "date" < make_date(%s, 1, 1);
+                    SELECT guyane.register_dataset_dates(%s, ARRAY(SELECT DISTINCT "date" FROM {table}
+                        WHERE "date" >= make_date(%s, 1, 1) AND "date" < make_date(%s, 1, 1)));
+                    '''.format(table=table, col=self.column), [year, year + 1, self.table, year, year + 1])
+                self.stdout.write('Rewrote the {} values of year {}'.format(self.column, year))
+                self._compare_anomaly_functions(cursor, functions, since, suffix=' (after past update)')
+            self._benchmark_anomaly_numpy(cursor, since)
+            transaction.set_rollback(True)
+
+    def _compare_anomaly_functions(self, cursor, functions, since, suffix=''):
+        """
+        Compute the expected and anomaly values of the dates after `since` with each function, and compare the results
+        """
+        table = 'guyane.{}'.format(self.table)
+        for name, query, params in functions:
+            cursor.execute('UPDATE {} SET flow_expected = NULL, flow_anomaly = NULL WHERE "date" > %s;'.format(table),
+                           [since])
+            with self.timer.stage(name + suffix, rows=cursor.rowcount):
+                cursor.execute(query, params)
+                nb_dates = cursor.fetchone()[0]
+            self.stdout.write('{}{}: {} dates'.format(name, suffix, nb_dates))
+            cursor.execute(
+                'DROP TABLE IF EXISTS "benchmark_anomaly_{name}"; '
+                'CREATE TEMPORARY TABLE "benchmark_anomaly_{name}" ON COMMIT DROP AS '
+                'SELECT cell_id, "date", flow_expected, flow_anomaly FROM {table} WHERE "date" > %s;'.format(
+                    name=name, table=table), [since])
+        cursor.execute(
+            '''
+            SELECT count(*) FROM "benchmark_anomaly_legacy" l
+            FULL JOIN "benchmark_anomaly_set-based" s USING (cell_id, "date")
+            WHERE l.flow_expected IS DISTINCT FROM s.flow_expected OR l.flow_anomaly IS DISTINCT FROM s.flow_anomaly;
+            '''
+        )
+        differences = cursor.fetchone()[0]
+        if differences:
+            self.stdout.write(self.style.ERROR('Results differ on {} rows{}'.format(differences, suffix)))
+        else:
+            self.stdout.write(self.style.SUCCESS('Identical results{}'.format(suffix)))
+
+    def _benchmark_anomaly_numpy(self, cursor, since):
+        """
+        Run the numpy engine on the dates after `since`, and compare its results with the set-based SQL function's
+        """
+        buffer = StringIO()
+        cursor.copy_expert('COPY (SELECT s.cell_id, s."date", s.flow_expected, s.flow_anomaly, t.{col} '
+                           'FROM "benchmark_anomaly_set-based" s JOIN guyane.{table} t USING (cell_id, "date")) '
+                           'TO STDOUT WITH (FORMAT csv)'.format(col=self.column, table=self.table), buffer)
+        buffer.seek(0)
+        sql = pd.read_csv(buffer, header=None, names=['cell_id', 'date', 'flow_expected', 'flow_anomaly', self.column],
+                          parse_dates=['date'])
+        cursor.execute('SELECT MAX(cell_id) FROM guyane.{};'.format(self.table))
+        nb_cells = cursor.fetchone()[0]
+
+        directory = tempfile.mkdtemp(prefix='sagui_benchmark_')
+        try:
+            with self.timer.stage('numpy load') as stage:
+                cube = anomaly_utils.HistoryCube.create(directory, self.table, self.column, nb_cells, since.year, since.year)
+                stage.rows = cube.load_from_db(cursor, 'guyane', self.table, self.column)
+            dates = np.unique(sql['date'].to_numpy().astype('datetime64[D]'))
+            cells = np.arange(1, nb_cells + 1)
+            with self.timer.stage('numpy', rows=dates.size * cells.size):
+                expected = cube.expected(dates, cells)
+        finally:
+            shutil.rmtree(directory)
+
+        date_idx = np.searchsorted(dates, sql['date'].to_numpy().astype('datetime64[D]'))
+        numpy_expected = expected[date_idx, sql['cell_id'].to_numpy() - 1]
+        numpy_anomaly = anomaly_utils.compute_anomaly(sql[self.column].to_numpy(dtype='f8', na_value=np.nan),
+                                                      numpy_expected)
+        for column, values in [('flow_expected', numpy_expected), ('flow_anomaly', numpy_anomaly)]:
+            same = np.isclose(values, sql[column].to_numpy(dtype='f8', na_value=np.nan),
+                              rtol=1e-9, atol=1e-9, equal_nan=True)
+            if same.all():
+                self.stdout.write(self.style.SUCCESS(
+                    'numpy engine: same {} as the SQL function (rtol 1e-9)'.format(column)))
+            else:
+                self.stdout.write(self.style.ERROR(
+                    'numpy engine: {} differs on {} rows'.format(column, int((~same).sum()))))
+        stages = self.timer.stages
+        self.stdout.write('numpy engine speedup: x{:.1f} vs the set-based SQL function, x{:.1f} vs the legacy one'.format(
+            stages['set-based'].time / stages['numpy'].time, stages['legacy'].time / stages['numpy'].time))
+
+    @staticmethod
+    def _tile_range(extent, zoom):
+        """
+        Tiles (x, y) of a zoom level covering an extent (xmin, ymin, xmax, ymax), in EPSG:4326
+        """
+        n = 2 ** zoom
+
+        def tile(lon, lat):
+            x = int((lon + 180) / 360 * n)
+            y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+            return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+        (xmin, ymax), (xmax, ymin) = tile(extent[0], extent[1]), tile(extent[2], extent[3])
+        return [(x, y) for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1)]
+
+    def benchmark_tiles(self):
+        if self.no_db:
+            raise CommandError('The tiles benchmark needs the DB')
+        # Same query as pg_tileserv, for a table layer
+        tile_query = \
+            '''
+            SELECT ST_AsMVT(mvtgeom, 'default') FROM (
+                SELECT ST_AsMVTGeom(ST_Transform(t.geom, 3857), ST_TileEnvelope(%(z)s, %(x)s, %(y)s), 4096, 64) AS geom,
+                    t.cell_id, t."values", t.width, t.depth
+                FROM {relation} t
+                WHERE t.geom && ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s, margin => 64.0 / 4096), 4326)
+            ) mvtgeom;
+            '''
+        layers = [
+            ('data', 'guyane.hyfaa_data_aggregated_geo',
+             '''(SELECT cell_id, val AS "values", width, depth, geom::geometry(Geometry,4326) AS geom
+                 FROM guyane.func_hyfaa_data_aggregated_geo())'''),
+            ('forecast', 'guyane.hyfaa_forecast_aggregated_geo',
+             '''(SELECT cell_id, val AS "values", width, depth, geom::geometry(Geometry,4326) AS geom
+                 FROM guyane.func_hyfaa_forecast_aggregated_geo())'''),
+        ]
+        with connection.cursor() as cursor:
+            for layer, view, legacy in layers:
+                cursor.execute('SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM '
+                               '(SELECT ST_Extent(geom) AS e FROM {}) ext;'.format(view))
+                extent = cursor.fetchone()
+                if extent[0] is None:
+                    raise CommandError('{} is empty'.format(view))
+                tiles = self._tile_range(extent, self.zoom)
+                self.stdout.write('{}: {} tiles at zoom {}'.format(layer, len(tiles), self.zoom))
+
+                results = {}
+                for _ in range(self.repeat):
+                    for name, relation in (('legacy', legacy), ('view', view)):
+                        query = tile_query.format(relation=relation)
+                        mvts = []
+                        with self.timer.stage('{} {}'.format(layer, name), rows=len(tiles)) as stage:
+                            for x, y in tiles:
+                                cursor.execute(query, {'z': self.zoom, 'x': x, 'y': y})
+                                mvts.append(bytes(cursor.fetchone()[0]))
+                            stage.nbytes = sum(len(mvt) for mvt in mvts)
+                        results[name] = mvts
+                if results['legacy'] == results['view']:
+                    self.stdout.write(self.style.SUCCESS('{}: identical tiles'.format(layer)))
+                else:
+                    self.stdout.write(self.style.ERROR('{}: tiles differ'.format(layer)))
+                stages = self.timer.stages
+                self.stdout.write('{}: x{:.1f} speedup vs the function-based proxy view'.format(
+                    layer, stages['{} legacy'.format(layer)].time / stages['{} view'.format(layer)].time))
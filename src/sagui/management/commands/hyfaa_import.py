@@ -1,26 +1,53 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import multiprocessing
 from netCDF4 import Dataset
 import numpy as np
 import os
+import tempfile
 import pandas as pd
 import psycopg2
 import psycopg2.extras as extras
 from time import perf_counter
 import sys
+from io import StringIO
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.conf import settings
-from django.db import connection
+from django.db import connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
 
-from sagui.utils import hyfaa as hyfaautils
+from sagui.utils import anomaly as anomaly_utils, db as db_utils, hyfaa as hyfaautils, instrumentation, \
+    pipeline as pipeline_utils
 from sagui import models
 
 
-class Command(BaseCommand):
+def _publish_nc_worker(options, ds):
+    """
+    Process pool worker: publishes one data serie. Runs in its own process, with its own DB connection.
+    The import state is not updated here, the parent process takes care of it
+    Returns: a 3-tuple (serie name, import state (see Command.publish_nc) or None, error message or None)
+    """
+    cmd = Command()
+    cmd.set_options(**options)
+    try:
+        return ds['name'], cmd.publish_nc(ds, update_state=False), None
+    except Exception as error:
+        return ds['name'], None, repr(error)
+    finally:
+        cmd.stdout.write('Stages timing for serie {}:\n{}'.format(ds['name'], cmd.timer.report()))
+        connections.close_all()
+
+
+class Command(instrumentation.InstrumentedCommand):
     help = '''
     Parse a bunch of netCDF4 files produced with data from HYFAA-MGB algorithm. 
     Publish it to a pigeosolutions/hyfaa-postgis database. 
     
-    First run publishes the whole serie of data (might take a long time). 
+    First run publishes the whole serie of data (might take a long time: use --streaming to keep the memory usage 
+    bounded). 
     Subsequent runs only perform an update (UPSERT) on data modified or added since the previous run.
     The connection parameters can be provided as argument or as an environment variable (DATABASE_URI)
     '''
@@ -33,6 +60,21 @@ class Command(BaseCommand):
     only_last_n_days = None
     max_ordem        = None
     commit_page_size = None
+    write_method     = None
+    extraction_mode  = None
+    jobs             = None
+    pipeline         = None
+    queue_depth      = None
+    only_changed     = None
+    resume           = None
+    post_processing  = None
+    filter_ordem     = None
+    cold_storage     = None
+    streaming        = None
+    max_memory       = None
+    bulk_load        = None
+    anomaly_engine   = None
+    anomaly_cache_path = None
     config           = None
 
     def add_arguments(self, parser):
@@ -56,15 +98,111 @@ class Command(BaseCommand):
         parser.add_argument('--max_ordem',
                             type=int,
                             default=None,
-                            help='max ordem value for the cells to import: needs the ')
+                            help='max ordem value for the cells to import (implies --filter_ordem). Default: the '
+                                 'value configured in the sagui_saguiconfig table')
+        parser.add_argument('--filter_ordem',
+                            default=False,
+                            action='store_true',
+                            help='Only import the cells whose ordem is >= max_ordem, plus the stations\' minibasins. '
+                                 'The other cells are neither decoded nor sent to the DB')
+        parser.add_argument('--cold_storage',
+                            default=False,
+                            action='store_true',
+                            help='With ordem filtering, write the cells that are filtered out into the cold tables '
+                                 '(cold_tablename in the sources config) instead of dropping them')
+        parser.add_argument('--streaming',
+                            default=False,
+                            action='store_true',
+                            help='Streaming mode, for the first import of the whole archive: the time dimension is '
+                                 'read in pages aligned on the netCDF chunking and sized after --max_memory (instead '
+                                 'of --commit_page_size), and the rows are streamed to the DB without building '
+                                 'dataframes')
+        parser.add_argument('--max_memory', '--max-memory',
+                            dest='max_memory',
+                            type=int,
+                            default=512,
+                            help='Memory budget (MB) for the decoded data of a page, in streaming mode (default 512)')
+        parser.add_argument('--bulk_load', '--bulk-load',
+                            dest='bulk_load',
+                            default=False,
+                            action='store_true',
+                            help='Bulk-load mode, for new environments or disaster recovery: the tables are emptied and '
+                                 'their secondary indexes and unique constraints dropped, the whole series are loaded '
+                                 'with plain COPY, then the indexes are rebuilt (parallel build) and the tables '
+                                 'analyzed. The import states (and thus the post-processing) are only updated at the '
+                                 'very end. Implies --force_update')
+        parser.add_argument('--maintenance_work_mem',
+                            default='1GB',
+                            help='maintenance_work_mem used to rebuild the indexes, in bulk-load mode (default 1GB)')
+        parser.add_argument('--index_build_workers',
+                            type=int,
+                            default=4,
+                            help='max_parallel_maintenance_workers used to rebuild the indexes, in bulk-load mode '
+                                 '(default 4)')
+        parser.add_argument('--anomaly_engine',
+                            choices=['sql', 'numpy'],
+                            default='sql',
+                            help='How the expected and anomaly values are computed. "sql": by the post-processing '
+                                 '(compute_expected_and_anomaly function). "numpy": during the import, from a history '
+                                 'cube of the previous years\' values (see sagui.utils.anomaly), and written along with '
+                                 'the data (mgbstandard and assimilated series only). Default: sql')
+        parser.add_argument('--anomaly_cache_path',
+                            default=settings.SAGUI_SETTINGS.get('HYFAA_ANOMALY_CACHE_PATH',
+                                                                os.path.join(tempfile.gettempdir(), 'sagui_anomaly')),
+                            help='Folder where the history cubes of the numpy anomaly engine are stored')
         parser.add_argument('--commit_page_size',
                             type=int,
                             default=settings.SAGUI_SETTINGS.get('HYFAA_IMPORT_COMMIT_PAGE_SIZE', 1),
                             help='Commit the data into the DB every n different dates (default 1). Should run faster if set to 10 or 50')
+        parser.add_argument('--write_method',
+                            choices=['copy', 'execute_values'],
+                            default='copy',
+                            help='How the data is written into the DB. "copy" streams each page through COPY (binary '
+                                 'format) into a temporary staging table, then merges it with a single UPSERT statement. '
+                                 '"execute_values" uses the former, row-based, UPSERT (slower, kept for comparison). '
+                                 'Default: copy')
+        parser.add_argument('--extraction_mode',
+                            choices=['slab', 'timestep'],
+                            default='slab',
+                            help='How the data is read from the netCDF file. "slab" reads each variable as one '
+                                 'contiguous block per page and builds the columns with numpy. "timestep" reads one '
+                                 'time value at a time (former behaviour). Default: slab')
+        parser.add_argument('-j', '--jobs',
+                            type=int,
+                            default=1,
+                            help='Number of data series imported concurrently, each one in its own process (with its '
+                                 'own DB connection). The import states are still updated in the configured order, '
+                                 'once all series are imported. Default: 1 (sequential import)')
+        parser.add_argument('--pipeline',
+                            default=False,
+                            action='store_true',
+                            help='Pipelined import: a reader thread decodes the next pages from the netCDF file '
+                                 'while the current page is written into the DB')
+        parser.add_argument('--queue_depth',
+                            type=int,
+                            default=2,
+                            help='Max number of decoded pages waiting to be written, in pipelined mode (default 2)')
+        parser.add_argument('--only_changed',
+                            default=False,
+                            action='store_true',
+                            help='Change-detection mode: compare each page with the values currently in the DB and '
+                                 'only write the (date, cell) rows whose values changed (update_time is not compared)')
+        parser.add_argument('--post_processing',
+                            choices=['inline', 'worker'],
+                            default=settings.SAGUI_SETTINGS.get('POST_PROCESSING_MODE', 'inline'),
+                            help='"inline": run the post-processing jobs queued by the import (sagui_worker --once) '
+                                 'before exiting. "worker": leave them to a running sagui_worker service. Default: '
+                                 'SAGUI_POST_PROCESSING_MODE setting, or inline')
+        parser.add_argument('--resume',
+                            default=False,
+                            action='store_true',
+                            help='Resume an interrupted import where it stopped: the pages already committed (see the '
+                                 'importprogress table) are skipped. Use the same options as the interrupted run')
 
-    def handle(self, *args, **kwargs):
-        tic = perf_counter()
-
+    def set_options(self, **kwargs):
+        """
+        Set the class-wide variables from the command options
+        """
         self.rootpath = kwargs['rootpath']
         self.db_connect_url = kwargs.get('db_connect_url')
         self.db_schema = kwargs.get('schema')
@@ -72,25 +210,114 @@ class Command(BaseCommand):
         self.only_last_n_days = kwargs.get('only_last_n_days')
         self.max_ordem = kwargs.get('max_ordem')
         self.commit_page_size = kwargs.get('commit_page_size')
+        self.write_method = kwargs.get('write_method')
+        self.extraction_mode = kwargs.get('extraction_mode')
+        self.jobs = kwargs.get('jobs') or 1
+        self.pipeline = kwargs.get('pipeline')
+        self.queue_depth = kwargs.get('queue_depth') or 2
+        self.only_changed = kwargs.get('only_changed')
+        self.resume = kwargs.get('resume')
+        self.post_processing = kwargs.get('post_processing') or 'inline'
+        self.filter_ordem = kwargs.get('filter_ordem') or bool(self.max_ordem)
+        self.cold_storage = kwargs.get('cold_storage')
+        self.streaming = kwargs.get('streaming')
+        self.max_memory = kwargs.get('max_memory') or 512
+        self.bulk_load = kwargs.get('bulk_load')
+        self.maintenance_work_mem = kwargs.get('maintenance_work_mem') or '1GB'
+        self.index_build_workers = kwargs.get('index_build_workers') or 4
+        self.anomaly_engine = kwargs.get('anomaly_engine') or 'sql'
+        self.anomaly_cache_path = kwargs.get('anomaly_cache_path')
+        self._bulk_tables = set()
+        if self.bulk_load:
+            self.force_update = True
+        self._cells_masks = {}
+        self.dry_run = kwargs.get('dry_run', False)
+        if self.timer is None:
+            self.timer = instrumentation.StageTimer()
         self.config = settings.SAGUI_SETTINGS.get('HYFAA_IMPORT_STRUCTURE_CONFIG')
 
+    def handle(self, *args, **kwargs):
+        tic = perf_counter()
+
+        self.set_options(**kwargs)
+
         if not self.config:
             self.stdout.write(self.style.ERROR("Could not load import config data (missing SAGUI_SETTINGS.HYFAA_IMPORT_STRUCTURE_CONFIG)"))
             sys.exit(1)
-
+        if self.streaming and (self.only_changed or self.cold_storage or self.pipeline
+                               or self.extraction_mode == 'timestep' or self.write_method == 'execute_values'
+                               or self.anomaly_engine == 'numpy'):
+            raise CommandError('--streaming is not compatible with --only_changed, --cold_storage, --pipeline, '
+                               '--extraction_mode timestep, --write_method execute_values and --anomaly_engine numpy')
+        if self.bulk_load and (self.streaming or self.only_changed or self.resume
+                               or self.write_method == 'execute_values' or self.only_last_n_days):
+            raise CommandError('--bulk_load is not compatible with --streaming, --only_changed, --resume, '
+                               '--only_last_n_days and --write_method execute_values')
 
         for ds in self.config['sources']:
-            self.stdout.write('#######################################################')
-            self.stdout.write('Processing data for serie {}'.format(ds['name']))
-            self.stdout.write('#######################################################')
             nc_path = os.path.join(self.rootpath, ds['file'])
             # logging.info('Publishing {} data from {} to DB {} table'.format(ds['name'], nc_path, ds['tablename']))
             # beware, this is a bit acrobatic, I'm altering here the path in the configuration object
             ds['file'] = nc_path
-            self.publish_nc(ds)
+
+        if self.jobs > 1:
+            self.publish_concurrently(kwargs)
+        else:
+            states = []
+            for ds in self.config['sources']:
+                self.stdout.write('#######################################################')
+                self.stdout.write('Processing data for serie {}'.format(ds['name']))
+                self.stdout.write('#######################################################')
+                states.append((ds, self.publish_nc(ds, update_state=not self.bulk_load)))
+            if self.bulk_load and not self.dry_run:
+                # The post-processing is only queued once all the series are loaded and indexed
+                for ds, state in states:
+                    if state:
+                        self._update_state(ds, *state)
+        if self.post_processing == 'inline' and not self.dry_run:
+            self.run_post_processing()
 
         tac = perf_counter()
-        self.stdout.write(self.style.SUCCESS('Total processing time: {} s'.format( round(tac - tic), 2 )))
+        self.stdout.write(self.style.SUCCESS('Total processing time: {} s'.format( round(tac - tic, 2) )))
+
+    def run_post_processing(self):
+        """
+        Inline post-processing: run the jobs queued by the import state updates, as `sagui_worker --once` would
+        """
+        with self.timer.stage('post_processing'):
+            call_command('sagui_worker', once=True, stdout=self.stdout, stderr=self.stderr)
+
+    def publish_concurrently(self, options):
+        """
+        Publish the data series concurrently, in a process pool. Each serie reads a different netcdf file and writes
+        into a different table.
+        The import states are updated afterwards, in the configured order: updating the import state queues the
+        post-processing jobs (run in order), and the forecast post-processing relies on the assimilated/mgbstandard data
+        """
+        sources = self.config['sources']
+        self.stdout.write('Processing data series {} using {} processes'.format(
+            ', '.join([ds['name'] for ds in sources]), min(self.jobs, len(sources))))
+        # stdout/stderr options (when called with call_command) can't be sent to the workers
+        options = {k: v for k, v in options.items() if k not in ('stdout', 'stderr')}
+        # Don't let the workers inherit the parent's DB connection: each one has to open its own
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=min(self.jobs, len(sources)),
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_publish_nc_worker, options, ds) for ds in sources]
+            results = [f.result() for f in futures]
+
+        for ds, (name, state, error) in zip(sources, results):
+            if error:
+                self.stdout.write(self.style.ERROR("Import of serie {} failed: {}".format(name, error)))
+                # Count the error on the serie's state. Its last update time is left untouched, so the next run will
+                # try again
+                if not self.dry_run:
+                    models.ImportState.objects.filter(tablename=ds['tablename']).update(update_errors=F('update_errors') + 1)
+            elif state:
+                self._update_state(ds, *state)
+                self.stdout.write(self.style.SUCCESS("Serie {} published ({} errors)".format(name, state[0])))
+            else:
+                self.stdout.write(self.style.SUCCESS("Serie {}: DB is up to date".format(name)))
 
 
     def _extract_data_to_dataframe_at_time(self, nc, ds, t):
@@ -129,29 +356,300 @@ class Command(BaseCommand):
         return df
 
 
-    def _filter_dataframe(self, dataframe):
+    @staticmethod
+    def _read_slab(var, indices):
         """
-        Filters the dataframe based on a provided ordem value. This value is checked on the
-        minibasins_data table to get the list of 'mini' values that pass it (must be >= max_ordem)
-        max_ordem is either defined as a parameter to this command, or taken from the sagui_saguiconfig table
-        :param dataframe:
-        :return: same dataframe, filtered
+        Read the rows of a netcdf variable for the given time indices.
+        The indices are grouped into runs of contiguous values, each run being read as one contiguous slab
+        (var[i0:i1, ...]). A single run (the usual case) is returned without any copy
+        Params:
+          * var: netcdf4 variable, time being its first dimension
+          * indices: sorted numpy array of time indices
         """
-        if not self.max_ordem:
-            # Filter out data based on the Import max ordem value configured in DB
-            conf = models.SaguiConfig.objects.order_by('id').last()
-            if conf:
-                self.max_ordem = conf.max_ordem
-        if self.max_ordem:
-            mini_recs = models.MinibasinsData.objects.filter(ordem__gte=self.max_ordem).values_list('mini', flat=True)
-            mini_list = list(mini_recs)
-            dataframe.query('cell_id in @mini_list', inplace=True)
-        return dataframe
+        runs = np.split(indices, np.where(np.diff(indices) != 1)[0] + 1)
+        slabs = [np.ma.getdata(var[r[0]:r[-1] + 1]) for r in runs]
+        if len(slabs) == 1:
+            return slabs[0]
+        return np.concatenate(slabs)
 
+    def _extract_data_to_dataframes_for_times(self, nc, ds, times, selections=(None,)):
+        """
+        Retrieves data from netcdf variables, for a whole page of time values. Each variable is read as a slab
+        (time x cells) and the columns are built with numpy datetime64 arithmetic and repeat/tile: there is no
+        per-timestep dataframe. Organizes it into Pandas dataframes with the same layout than
+        _extract_data_to_dataframe_at_time
+        Returns: a list of dataframes, one per cells selection
+        Params:
+          * nc: netcdf4.Dataset input file
+          * ds: dataserie definition (one element of global script_config['sources'] list)
+          * times: list of times to look for (3-tuples, as returned by _retrieve_times_to_update)
+          * selections: list of cells selections (sorted numpy arrays of cell indices, None for all the cells)
+        """
+        self.stdout.write("Preparing data for days {} to {} ({} time values)".format(times[0][1], times[-1][1], len(times)))
+        indices = np.array([t[0] for t in times], dtype='i4')
+        nb_cells = nc.dimensions['n_cells'].size
+        dates, update_times, is_analysis, slabs = self._read_slabs(nc, ds, indices)
+
+        with self.timer.stage('transform') as stage:
+            dataframes = self._build_dataframes(dates, update_times, is_analysis, slabs, nb_cells, selections)
+            stage.rows = sum(len(df) for df in dataframes)
+            stage.nbytes = sum(df.memory_usage(index=False).sum() for df in dataframes)
+        return dataframes
+
+    def _read_slabs(self, nc, ds, indices):
+        """
+        Read the netcdf variables for the given time indices, each one as a slab (time x cells)
+        Returns: a 4-tuple (dates, update times, is_analysis values, dict of the data variables slabs, by short name)
+        """
+        with self.timer.stage('read') as stage:
+            dates = hyfaautils.julianday_to_datetime64(self._read_slab(nc.variables['time'], indices))
+            update_times = hyfaautils.julianday_to_datetime64(self._read_slab(nc.variables['time_added_to_hydb'], indices))
+            is_analysis = self._read_slab(nc.variables['is_analysis'], indices).astype('?')
+            slabs = {self.config['short_names'][j]: self._read_slab(nc.variables[j], indices) for j in ds['nc_data_vars']}
+            stage.rows = indices.size * nc.dimensions['n_cells'].size
+            stage.nbytes = sum(a.nbytes for a in slabs.values())
+        return dates, update_times, is_analysis, slabs
+
+    @staticmethod
+    def _build_dataframes(dates, update_times, is_analysis, slabs, nb_cells, selections):
+        """
+        Build the dataframes from the slabs read in the netcdf file, one dataframe per cells selection
+        """
+        nb_times = dates.size
+        dataframes = []
+        for cells in selections:
+            if cells is None:
+                cell_ids = np.arange(start=1, stop=nb_cells + 1, dtype='i2')
+            else:
+                cell_ids = (cells + 1).astype('i2')
+            # Common columns. The cells vary fastest (same layout as the netcdf variables (time, cells) in C order)
+            columns_dict = {
+                'cell_id': np.tile(cell_ids, nb_times),
+                'date': np.repeat(dates, cell_ids.size),
+                'update_time': np.repeat(update_times, cell_ids.size),
+                'is_analysis': np.repeat(is_analysis, cell_ids.size),
+            }
+            # dynamic columns: depend on the dataserie considered. A (time, cells) slab flattens into a view
+            for name, slab in slabs.items():
+                columns_dict[name] = (slab if cells is None else slab[:, cells]).reshape(-1)
+            dataframes.append(pd.DataFrame(columns_dict, copy=False))
+        return dataframes
+
+    def _extract_page(self, nc, ds, times, mask=None, with_cold=False):
+        """
+        Extract a page of time values, using the configured extraction mode
+        Returns: a 2-tuple (dataframe of the selected cells, dataframe of the cells filtered out by the mask if
+        with_cold is True, else None)
+        Params:
+          * mask: boolean numpy array over the cells (see _get_cells_mask). None to keep all the cells
+          * with_cold: whether to also extract the cells filtered out by the mask
+        """
+        if self.extraction_mode == 'timestep':
+            with self.timer.stage('read') as stage:
+                df = pd.concat([self._extract_data_to_dataframe_at_time(nc, ds, t) for t in times], ignore_index=True)
+                stage.rows, stage.nbytes = len(df), df.memory_usage(index=False).sum()
+            if mask is None:
+                return df, None
+            keep = mask[df['cell_id'].to_numpy() - 1]
+            return df[keep].reset_index(drop=True), df[~keep].reset_index(drop=True) if with_cold else None
+        if mask is None:
+            return self._extract_data_to_dataframes_for_times(nc, ds, times)[0], None
+        selections = [np.flatnonzero(mask)]
+        if with_cold:
+            selections.append(np.flatnonzero(~mask))
+        dataframes = self._extract_data_to_dataframes_for_times(nc, ds, times, selections)
+        return dataframes[0], dataframes[1] if with_cold else None
+
+    def _drop_unchanged_rows(self, df, ds):
+        """
+        Change detection: compare the page with the values currently stored in the DB, and drop the (date, cell) rows
+        whose values did not change.
+        The DB values for the page's dates are fetched with a single COPY, and the comparison is vectorized (merge on
+        (cell_id, date), then numpy comparison of each column). Float values are compared with the precision of the
+        netcdf data, NaN/NULL values being considered as equal. update_time is not compared: HYFAA re-touches it
+        without necessarily changing the values
+        Returns: a 2-tuple (dataframe of the changed or new rows, nb of unchanged rows)
+        Params:
+          * df: pandas dataframe (page) to publish
+          * ds: dataserie definition (one element of global script_config['sources'] list)
+        """
+        value_cols = [c for c in df.columns if c not in ('cell_id', 'date', 'update_time')]
+        dates = np.unique(df['date'].to_numpy().astype('datetime64[D]')).astype(str)
+        query = 'COPY (SELECT cell_id, "date", {cols} FROM {schema}.{table} WHERE "date" = ANY(\'{{{dates}}}\'::date[])) TO STDOUT WITH (FORMAT csv)'.format(
+            cols=','.join(value_cols), schema=self.db_schema, table=ds['tablename'], dates=','.join(dates))
+        buffer = StringIO()
+        with connection.cursor() as cursor:
+            cursor.copy_expert(query, buffer)
+        if not buffer.tell():
+            # Nothing in the DB yet for these dates: every row is new
+            return df, 0
+        buffer.seek(0)
+        current = pd.read_csv(buffer, header=None, names=['cell_id', 'date'] + value_cols, parse_dates=['date'],
+                              true_values=['t'], false_values=['f'])
+        current['cell_id'] = current['cell_id'].astype(df['cell_id'].dtype)
+
+        merged = df.merge(current, on=['cell_id', 'date'], how='left', suffixes=('', '_db'), indicator=True)
+        changed = (merged['_merge'] == 'left_only').to_numpy()
+        for c in value_cols:
+            new_values = merged[c].to_numpy()
+            if new_values.dtype.kind == 'f':
+                db_values = merged[c + '_db'].to_numpy(dtype=new_values.dtype, na_value=np.nan)
+                same = (new_values == db_values) | (np.isnan(new_values) & np.isnan(db_values))
+            else:
+                same = (merged[c] == merged[c + '_db']).to_numpy(dtype='?', na_value=False)
+            changed |= ~same
+        return df[changed], int((~changed).sum())
+
+    def _get_cells_mask(self, nb_cells):
+        """
+        Compute the cells selection, based on the max_ordem value: the cells whose ordem (in the minibasins_data
+        table) is >= max_ordem are kept, plus the minibasins the stations are attached to.
+        max_ordem is either defined as a parameter to this command, or taken from the sagui_saguiconfig table.
+        The selection is computed once per run
+        Returns: a boolean numpy array over the cells (cell_id - 1), or None if no filtering is configured
+        Params:
+          * nb_cells: nb of cells in the netcdf file
+        """
+        if not self.filter_ordem:
+            return None
+        if nb_cells not in self._cells_masks:
+            if not self.max_ordem:
+                # Filter out data based on the Import max ordem value configured in DB
+                conf = models.SaguiConfig.objects.order_by('id').last()
+                if conf:
+                    self.max_ordem = conf.max_ordem
+            mask = None
+            if self.max_ordem:
+                minis = np.fromiter(models.MinibasinsData.objects.filter(ordem__gte=self.max_ordem)
+                                    .values_list('mini', flat=True), dtype='i4')
+                stations_minis = np.fromiter(models.Stations.objects.values_list('minibasin_id', flat=True), dtype='i4')
+                indices = np.concatenate([minis, stations_minis]) - 1
+                mask = np.zeros(nb_cells, dtype='?')
+                mask[indices[(indices >= 0) & (indices < nb_cells)]] = True
+                self.stdout.write("Ordem filter (ordem >= {}): keeping {} cells out of {}".format(
+                    self.max_ordem, np.count_nonzero(mask), nb_cells))
+            self._cells_masks[nb_cells] = mask
+        return self._cells_masks[nb_cells]
 
     def _publish_dataframe_to_db(self, df, ds):
         """
-        Publish the provided Pandas DataFrame into the DB.
+        Publish the provided Pandas DataFrame into the DB, using the configured write method.
+        Returns: - nb of errors if there were (0 if everything went well)
+        Params:
+          * df: pandas dataframe to publish
+          * ds: dataserie definition (one element of global script_config['sources'] list)
+        """
+        try:
+            with transaction.atomic():
+                if not df.empty:
+                    self._ensure_partitions(ds, df['date'].min().date(), df['date'].max().date())
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.stderr.write(str(error))
+            return 1
+        if ds['tablename'] in self._bulk_tables:
+            errors = self._publish_dataframe_to_db_bulk(df, ds)
+        elif self.write_method == 'execute_values':
+            errors = self._publish_dataframe_to_db_execute_values(df, ds)
+        else:
+            errors = self._publish_dataframe_to_db_copy(df, ds)
+        if errors or df.empty:
+            return errors
+        # Record the written dates in the dataset_dates catalog
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                db_utils.register_dataset_dates(cursor, ds['tablename'], df['date'])
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.stderr.write(str(error))
+            return 1
+        return 0
+
+    def _ensure_partitions(self, ds, date_min, date_max):
+        """
+        Make sure the date range partitions needed to store the data between date_min and date_max exist
+        (cf migration 0053)
+        Params:
+          * ds: dataserie definition (one element of global script_config['sources'] list)
+          * date_min, date_max: dates range of the data to publish
+        """
+        if not ds.get('partition_by'):
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT guyane.create_missing_partitions(%s, %s, %s, %s, %s);',
+                           [self.db_schema, ds['tablename'], ds['partition_by'], date_min, date_max])
+            nb_created = cursor.fetchone()[0]
+        if nb_created:
+            self.stdout.write('Created {} partition(s) on table {}'.format(nb_created, ds['tablename']))
+
+    def _publish_dataframe_to_db_copy(self, df, ds):
+        """
+        Publish the provided Pandas DataFrame into the DB: stream it with COPY into a temporary staging table, then
+        merge it into the destination table with a single, set-based UPSERT statement.
+        Returns: - nb of errors if there were (0 if everything went well)
+        Params:
+          * df: pandas dataframe to publish
+          * ds: dataserie definition (one element of global script_config['sources'] list)
+        """
+        try:
+            cols = list(df.columns)
+            with connection.cursor() as cursor:
+                with db_utils.staging_table(cursor, self.db_schema, ds['tablename'], cols) as staging_name:
+                    db_utils.copy_dataframe(cursor, df, staging_name)
+                    # Considers that the pkey is composed of the 2 first fields
+                    db_utils.upsert_from_staging(cursor, self.db_schema, ds['tablename'], staging_name, cols,
+                                                 conflict_target='ON CONSTRAINT {}_unique_cellid_day'.format(ds['tablename']),
+                                                 key_columns=cols[:2])
+            return 0
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.stderr.write(str(error))
+            return 1
+
+    def _publish_dataframe_to_db_bulk(self, df, ds):
+        """
+        Bulk-load mode: the table was emptied and has no unique constraint, the dataframe is loaded with a plain COPY
+        Returns: - nb of errors if there were (0 if everything went well)
+        Params:
+          * df: pandas dataframe to publish
+          * ds: dataserie definition (one element of global script_config['sources'] list)
+        """
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                db_utils.copy_dataframe(cursor, df, '{}.{}'.format(self.db_schema, ds['tablename']))
+            return 0
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.stderr.write(str(error))
+            return 1
+
+    def _start_bulk_load(self, ds):
+        """
+        Bulk-load mode: empty the table, drop its secondary indexes and unique constraints, and invalidate the expected
+        values cached from its data (flow_climatology) and its dates catalog (dataset_dates)
+        Returns: the SQL statements re-creating the indexes and constraints
+        """
+        self.stdout.write("Bulk load: emptying table {} and dropping its indexes".format(ds['tablename']))
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE {}.{};'.format(self.db_schema, ds['tablename']))
+            index_statements = db_utils.drop_secondary_indexes(cursor, self.db_schema, ds['tablename'])
+            # The cached expected values computed from the former data are not valid anymore
+            cursor.execute('SELECT guyane.reset_flow_climatology(%s);', ['{}.{}'.format(self.db_schema, ds['tablename'])])
+            # Empty table: its dates are removed from the dataset_dates catalog
+            cursor.execute('SELECT guyane.refresh_dataset_dates(%s);', [ds['tablename']])
+        self._bulk_tables.add(ds['tablename'])
+        return index_statements
+
+    def _finish_bulk_load(self, ds, index_statements):
+        """
+        Bulk-load mode: rebuild the indexes and constraints, and analyze the table
+        """
+        self.stdout.write("Bulk load: rebuilding {} indexes on table {}".format(len(index_statements), ds['tablename']))
+        self._bulk_tables.discard(ds['tablename'])
+        with self.timer.stage('index_build'), transaction.atomic(), connection.cursor() as cursor:
+            db_utils.rebuild_indexes(cursor, self.db_schema, ds['tablename'], index_statements,
+                                     maintenance_work_mem=self.maintenance_work_mem,
+                                     parallel_workers=self.index_build_workers)
+
+    def _publish_dataframe_to_db_execute_values(self, df, ds):
+        """
+        Publish the provided Pandas DataFrame into the DB, using a row-based UPSERT (execute_values).
         Returns: - nb of errors if there were (0 if everything went well)
         Params:
           * df: pandas dataframe to publish
@@ -176,15 +674,15 @@ class Command(BaseCommand):
             query = "INSERT INTO {schema}.{table}({cols}) VALUES %s ON CONFLICT ON CONSTRAINT  {table}_unique_cellid_day DO UPDATE SET {updt_stmt};".format(
                 schema=self.db_schema, table=ds['tablename'], cols=cols, updt_stmt=update_stmt)
 
-            # Execute the query
-            with connection.cursor() as cursor:
+            # Execute the query (in a savepoint: a failure must not break the page's transaction)
+            with transaction.atomic(), connection.cursor() as cursor:
                 extras.execute_values(cursor, query, tuples)
             return 0
         except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
+            self.stderr.write(str(error))
             return 1
 
-    def publish_nc(self, ds):
+    def publish_nc(self, ds, update_state=True):
         """
         Publish a netcdf4 dataset.
         First extracts the state information from the database, to publish/.update only the records that need it
@@ -192,10 +690,14 @@ class Command(BaseCommand):
         Finally updates the `state` table
         Params:
           * ds: dataserie definition (one element of global self.config['sources']  list, see above)
+          * update_state: if False, the `state` table is not updated (it is left to the caller)
+        Returns: the import state as a 3-tuple (errors, last_published_day_jd, last_updated_without_errors_jd), or None
+        if the DB was already up to date
         """
-        nc = Dataset(ds['file'], "r", format="netCDF4")
-        # Check when was the last data publication (only publish data that need to be)
-        update_times, last_updated_without_errors_jd = self._retrieve_times_to_update(nc, ds['tablename'])
+        with self.timer.stage('scan'):
+            nc = Dataset(ds['file'], "r", format="netCDF4")
+            # Check when was the last data publication (only publish data that need to be)
+            update_times, last_updated_without_errors_jd = self._retrieve_times_to_update(nc, ds['tablename'])
 
         # truncate the extraction to the last n days (useful when you are in a hurry)
         if self.only_last_n_days:
@@ -203,57 +705,332 @@ class Command(BaseCommand):
 
         if not update_times:
             self.stdout.write(self.style.SUCCESS("DB is up to date"))
-            return
+            return None
+
+        # Cells selection (ordem filter), computed once per run
+        with self.timer.stage('scan'):
+            mask = self._get_cells_mask(nc.dimensions['n_cells'].size)
+        cold_ds = None
+        if self.cold_storage and mask is not None:
+            if ds.get('cold_tablename'):
+                cold_ds = dict(ds, tablename=ds['cold_tablename'], partition_by=None)
+            else:
+                self.stdout.write(self.style.WARNING("No cold table configured for serie {}: the cells filtered out won't be stored".format(ds['name'])))
+        cube, cube_column = self._open_history_cube(nc, ds)
 
         # # Iterate and publish all recent times
+        with self.timer.stage('state'):
+            progress = self._start_progress(ds)
+        # Errors of this run only: the ones of an interrupted import are resolved if their pages are published again
         errors = 0
-        # Initialize transitional dataframe and counter. This is a mechanims for paginating DB commits (not commit every
-        # different time, which is very slow
-        concatenated_df = pd.DataFrame()
-        counter = 1
-        for t in update_times:
+        remaining_times = update_times
+        if progress.last_committed_index is not None:
+            # Resuming: skip the pages already committed
+            remaining_times = [t for t in update_times if t[0] > progress.last_committed_index]
+            self.stdout.write("Resuming import after time index {}: {} time values left (out of {})".format(
+                progress.last_committed_index, len(remaining_times), len(update_times)))
+            if progress.update_errors:
+                self.stdout.write(self.style.WARNING("The interrupted import encountered {} error(s): the failed pages "
+                                                     "will be published again".format(progress.update_errors)))
+        index_statements = self._start_bulk_load(ds) if self.bulk_load and not self.dry_run else None
+        try:
+            if self.streaming:
+                # Pages sized after the memory budget and aligned on the netcdf chunks. The rows are generated while
+                # writing the page (see _stream_page_to_db)
+                pages = self._streaming_pages(nc, ds, remaining_times, mask)
+                pages_data = ((page, (None, None)) for page in pages)
+            else:
+                # Paginate the DB commits (not commit every different time, which is very slow)
+                pages = [remaining_times[i:i + self.commit_page_size] for i in range(0, len(remaining_times), self.commit_page_size)]
+                # netcdf to dataframe. In pipelined mode, the pages are decoded by a reader thread, ahead of the DB writes
+                pages_data = ((page, self._extract_page(nc, ds, page, mask, with_cold=cold_ds is not None)) for page in pages)
+            if self.pipeline:
+                pages_data = pipeline_utils.Pipeline(pages_data, queue_depth=self.queue_depth)
             tic = perf_counter()
-            # netcdf to dataframe
-            df = self._extract_data_to_dataframe_at_time(nc, ds, t)
-            concatenated_df = pd.concat([df, concatenated_df])
-
-            if (counter % self.commit_page_size == 0) or (
-                    t[0] == update_times[-1][0]):  # last part means is last time element
-                # dataframe to DB
-                e = self._publish_dataframe_to_db(concatenated_df, ds)
-                if not e:
-                    self.stdout.write("Published data for time {} (index {}, greg. time {})".format(t[1], t[0],
-                                                                                               hyfaautils.julianday_to_datetime(
-                                                                                                   t[1])))
+            changed_count, unchanged_count = 0, 0
+            # Once a page failed, the checkpoint is not moved anymore: --resume restarts from the failed page
+            failed = False
+            for page, (df, cold_df) in pages_data:
+                if self.only_changed:
+                    with self.timer.stage('transform'):
+                        df, unchanged = self._drop_unchanged_rows(df, ds)
+                        if cold_df is not None:
+                            cold_df, cold_unchanged = self._drop_unchanged_rows(cold_df, cold_ds)
+                            unchanged += cold_unchanged
+                    changed = len(df) + (len(cold_df) if cold_df is not None else 0)
+                    changed_count += changed
+                    unchanged_count += unchanged
+                    self.stdout.write("{} rows changed, {} unchanged".format(changed, unchanged))
+                if cube is not None and not df.empty:
+                    # numpy anomaly engine: the expected and anomaly values are written along with the data. The
+                    # page's values are staged in the cube until the page is committed
+                    with self.timer.stage('post_processing', rows=len(df)):
+                        expected, anomaly = anomaly_utils.expected_and_anomaly(df, cube, cube_column)
+                        df = df.assign(flow_expected=expected, flow_anomaly=anomaly)
+                # dataframe to DB. Each page is committed in its own transaction, along with its checkpoint
+                if self.streaming:
+                    e = self._stream_page_to_db(nc, ds, page, mask, progress, checkpoint=not failed)
+                elif self.dry_run:
+                    e = 0
+                else:
+                    with transaction.atomic():
+                        with self.timer.stage('write', rows=len(df), nbytes=df.memory_usage(index=False).sum()):
+                            e = self._publish_dataframe_to_db(df, ds) if not df.empty else 0
+                        if not e and cold_df is not None and not cold_df.empty:
+                            with self.timer.stage('write', rows=len(cold_df), nbytes=cold_df.memory_usage(index=False).sum()):
+                                e += self._publish_dataframe_to_db(cold_df, cold_ds)
+                        if e:
+                            # The page is rolled back as a whole (the transaction may be aborted)
+                            transaction.set_rollback(True)
+                        elif not failed:
+                            with self.timer.stage('state'):
+                                self._checkpoint(progress, page)
+                    if e:
+                        with self.timer.stage('state'):
+                            self._record_failure(progress, e)
+                if cube is not None:
+                    with self.timer.stage('post_processing'):
+                        self._commit_history_cube(cube, ds, committed=not e)
+                failed = failed or bool(e)
+                if self.dry_run:
+                    self.stdout.write("Dry run: skipped the writing of times {} to {} (indices {} to {})".format(
+                        page[0][1], page[-1][1], page[0][0], page[-1][0]))
+                elif not e:
+                    self.stdout.write("Published data for times {} to {} (indices {} to {}, greg. times {} to {})".format(
+                        page[0][1], page[-1][1], page[0][0], page[-1][0],
+                        hyfaautils.julianday_to_datetime(page[0][1]), hyfaautils.julianday_to_datetime(page[-1][1])))
                 else:
                     self.stdout.write(self.style.ERROR(
-                        "Encountered a DB error when publishing data for time {} ({}). Please watch your logs".format(
-                            t[0], t[1])))
+                        "Encountered a DB error when publishing data for times {} to {} (indices {} to {}). Please watch your logs".format(
+                            page[0][1], page[-1][1], page[0][0], page[-1][0])))
                 # count errors if there are
                 errors += e
 
-                concatenated_df = pd.DataFrame()
-            counter += 1
-
-            tac = perf_counter()
-            self.stdout.write("processing time: {} s".format( round(tac - tic), 2 ))
+                tac = perf_counter()
+                self.stdout.write("processing time: {} s".format( round(tac - tic, 2) ))
+                tic = tac
+            if self.pipeline:
+                self.stdout.write(pages_data.summary())
+            if self.only_changed:
+                self.stdout.write("Change detection: {} rows written, {} unchanged rows skipped".format(changed_count, unchanged_count))
+        finally:
+            if cube is not None:
+                # the values of a page interrupted by an exception were not committed
+                cube.discard()
+            if index_statements is not None:
+                # Rebuild the indexes even if the load failed: the table must stay usable
+                self._finish_bulk_load(ds, index_statements)
 
         last_published_day_jd = max(list(zip(*update_times))[1])
         if not errors:
             # increment last update time without error
             last_updated_without_errors_jd = max(list(zip(*update_times))[2])
-        # update state table
-        # _update_state(ds, errors, last_published_day_jd, last_updated_without_errors_jd)
-        tbl_state = models.ImportState.objects.update_or_create(tablename=ds['tablename'], defaults={
-            "last_updated": hyfaautils.julianday_to_datetime(last_published_day_jd),
-            "last_updated_jd": last_published_day_jd,
-            "update_errors": errors,
-            "last_updated_without_errors": hyfaautils.julianday_to_datetime(last_updated_without_errors_jd),
-            "last_updated_without_errors_jd": last_updated_without_errors_jd,
+        if update_state and not self.dry_run:
+            self._update_state(ds, errors, last_published_day_jd, last_updated_without_errors_jd)
+        return errors, last_published_day_jd, last_updated_without_errors_jd
+
+    def _open_history_cube(self, nc, ds):
+        """
+        numpy anomaly engine: open the history cube of the serie's source column (see sagui.utils.anomaly). If there is
+        none yet, or if it is not in sync with the table anymore (its watermark doesn't match the table's: the table was
+        written without the numpy engine, or the import was interrupted between the commit of a page and the cube's),
+        it is created and loaded with the values stored in the DB (in bulk-load mode, the table being emptied, it is
+        created empty). In dry-run mode, the changes are not written to the cube file
+        Returns: a 2-tuple (cube, source column), (None, None) if the engine is not used for this serie
+        """
+        column = anomaly_utils.SOURCE_COLUMNS.get(ds['tablename'])
+        if self.anomaly_engine != 'numpy' or column is None:
+            return None, None
+        nb_cells = nc.dimensions['n_cells'].size
+        cube = None
+        if not self.bulk_load:
+            cube = anomaly_utils.HistoryCube.open(self.anomaly_cache_path, ds['tablename'], column, nb_cells,
+                                                  readonly=self.dry_run)
+            if cube is not None:
+                with connection.cursor() as cursor:
+                    watermark = db_utils.dataset_watermark(cursor, ds['tablename'])
+                if cube.watermark != watermark:
+                    self.stdout.write(self.style.WARNING("The history cube of serie {} is not in sync with table {}: "
+                                                         "it will be loaded again".format(ds['name'], ds['tablename'])))
+                    cube = None
+        if cube is None:
+            if self.dry_run:
+                self.stdout.write(self.style.WARNING("Dry run: no history cube for serie {}, the expected and anomaly "
+                                                     "values won't be computed".format(ds['name'])))
+                return None, None
+            year = timezone.now().year
+            cube = anomaly_utils.HistoryCube.create(self.anomaly_cache_path, ds['tablename'], column, nb_cells, year, year)
+            if not self.bulk_load:
+                self.stdout.write("Loading the history cube of serie {} from the DB".format(ds['name']))
+                with self.timer.stage('read') as stage, connection.cursor() as cursor:
+                    # read first: if the table is written meanwhile, the cube will be loaded again next time
+                    watermark = db_utils.dataset_watermark(cursor, ds['tablename'])
+                    stage.rows = cube.load_from_db(cursor, self.db_schema, ds['tablename'], column)
+                cube.commit(watermark)
+        return cube, column
+
+    def _commit_history_cube(self, cube, ds, committed):
+        """
+        numpy anomaly engine: once a page is written, write its values to the history cube, along with the table's new
+        watermark. If the page was rolled back, its values are discarded
+        """
+        if not committed:
+            cube.discard()
+        elif self.dry_run:
+            cube.commit()
+        else:
+            with connection.cursor() as cursor:
+                cube.commit(db_utils.dataset_watermark(cursor, ds['tablename']))
+
+    def _streaming_pages(self, nc, ds, times, mask=None):
+        """
+        Split the times to publish into pages for the streaming mode: the page size (nb of time values) is derived
+        from the memory budget (the slabs of a page are held in memory while the page is streamed to the DB), and
+        rounded to a multiple of the netcdf chunk size along the time dimension. The pages are aligned on the chunks
+        boundaries, so that each chunk is decompressed only once
+        Returns: a list of pages (lists of times, as returned by _retrieve_times_to_update)
+        """
+        nb_cells = nc.dimensions['n_cells'].size
+        bytes_per_time = nb_cells * sum(nc.variables[j].dtype.itemsize for j in ds['nc_data_vars'])
+        page_size = max(1, int(self.max_memory * 1024 ** 2 // bytes_per_time))
+        chunking = nc.variables[ds['nc_data_vars'][0]].chunking()
+        time_chunk = chunking[0] if chunking != 'contiguous' else 1
+        if page_size >= time_chunk:
+            page_size -= page_size % time_chunk
+        else:
+            self.stdout.write(self.style.WARNING(
+                "The memory budget ({} MB) is lower than a netcdf chunk ({} time values): the chunks will be read "
+                "several times".format(self.max_memory, time_chunk)))
+        self.stdout.write("Streaming mode: pages of {} time values ({} MB of decoded data max, chunk size {}, {} cells)".format(
+            page_size, round(page_size * bytes_per_time / 1024 ** 2), time_chunk,
+            nb_cells if mask is None else np.count_nonzero(mask)))
+        return [list(page) for _, page in itertools.groupby(times, key=lambda t: t[0] // page_size)]
+
+    def _stream_page_to_db(self, nc, ds, page, mask, progress, checkpoint=True):
+        """
+        Streaming mode: read the page's slabs, and stream the rows into the DB (COPY into the staging table, then
+        UPSERT), one time value at a time, without building the page's dataframe.
+        The page is committed in its own transaction, along with its checkpoint (if `checkpoint`). On failure, the page
+        is rolled back and only the errors counter is updated
+        Returns: - nb of errors if there were (0 if everything went well)
+        """
+        indices = np.array([t[0] for t in page], dtype='i4')
+        nb_cells = nc.dimensions['n_cells'].size
+        dates, update_times, is_analysis, slabs = self._read_slabs(nc, ds, indices)
+        selections = [None if mask is None else np.flatnonzero(mask)]
+        cols = ['cell_id', 'date', 'update_time', 'is_analysis'] + list(slabs.keys())
+        counters = {'rows': 0, 'nbytes': 0, 'time': 0}
+
+        def blocks():
+            # One block of column arrays per time value
+            for i in range(dates.size):
+                tic = perf_counter()
+                df = self._build_dataframes(dates[i:i + 1], update_times[i:i + 1], is_analysis[i:i + 1],
+                                            {k: v[i:i + 1] for k, v in slabs.items()}, nb_cells, selections)[0]
+                block = db_utils.dataframe_arrays(df)
+                counters['rows'] += len(df)
+                counters['nbytes'] += sum(a.nbytes for a in block)
+                counters['time'] += perf_counter() - tic
+                yield block
+
+        if self.dry_run:
+            for _ in blocks():
+                pass
+            self.timer.add('transform', counters['time'], counters['rows'], counters['nbytes'])
+            return 0
+
+        try:
+            tic = perf_counter()
+            with transaction.atomic():
+                with transaction.atomic():
+                    self._ensure_partitions(ds, dates.min().astype(object), dates.max().astype(object))
+                with connection.cursor() as cursor:
+                    with db_utils.staging_table(cursor, self.db_schema, ds['tablename'], cols) as staging_name:
+                        db_utils.copy_blocks(cursor, staging_name, cols, blocks())
+                        db_utils.upsert_from_staging(cursor, self.db_schema, ds['tablename'], staging_name, cols,
+                                                     conflict_target='ON CONSTRAINT {}_unique_cellid_day'.format(ds['tablename']),
+                                                     key_columns=cols[:2])
+                    db_utils.register_dataset_dates(cursor, ds['tablename'], dates)
+                self.timer.add('write', perf_counter() - tic - counters['time'], counters['rows'], counters['nbytes'])
+                self.timer.add('transform', counters['time'], counters['rows'], counters['nbytes'])
+                if checkpoint:
+                    with self.timer.stage('state'):
+                        self._checkpoint(progress, page)
+            return 0
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.stderr.write(str(error))
+            with self.timer.stage('state'):
+                self._record_failure(progress, 1)
+            return 1
+
+    def _start_progress(self, ds):
+        """
+        Get the checkpoints record for the given dataserie. In resume mode, the record of the interrupted import is
+        returned as is. Otherwise (or if there is nothing to resume), it is reset
+        Returns: the ImportProgress record
+        """
+        if self.resume:
+            progress = models.ImportProgress.objects.filter(tablename=ds['tablename'], finished=False).first()
+            if progress and progress.last_committed_index is not None:
+                return progress
+            self.stdout.write("Nothing to resume for table {}, starting a new import".format(ds['tablename']))
+        if self.dry_run:
+            # Not saved
+            return models.ImportProgress(tablename=ds['tablename'], started_at=timezone.now())
+        progress, created = models.ImportProgress.objects.update_or_create(tablename=ds['tablename'], defaults={
+            "last_committed_index": None,
+            "last_committed_jd": None,
+            "pages_committed": 0,
+            "update_errors": 0,
+            "finished": False,
+            "started_at": timezone.now(),
         })
-        # tbl_state.save() # should not be necessary
+        return progress
 
+    @staticmethod
+    def _checkpoint(progress, page):
+        """
+        Record the page as committed. Meant to be called inside the page's transaction, once the page was written
+        without errors. The checkpoint is never moved past a failed page: the errors recorded until then (by an
+        interrupted import) are resolved, the counter is reset
+        Params:
+          * progress: ImportProgress record
+          * page: list of times (3-tuples, as returned by _retrieve_times_to_update)
+        """
+        progress.last_committed_index = int(page[-1][0])
+        progress.last_committed_jd = float(page[-1][1])
+        progress.pages_committed += 1
+        progress.update_errors = 0
+        progress.save()
 
+    @staticmethod
+    def _record_failure(progress, errors):
+        """
+        Count the errors of a failed page, without moving the checkpoint. Meant to be called outside the page's
+        (rolled back) transaction
+        Params:
+          * progress: ImportProgress record
+          * errors: nb of errors that occurred when publishing the page
+        """
+        progress.update_errors += errors
+        progress.save(update_fields=['update_errors', 'updated_at'])
+
+    def _update_state(self, ds, errors, last_published_day_jd, last_updated_without_errors_jd):
+        """
+        Update the `state` table for the given dataserie (this queues the post-processing job, run by the sagui_worker
+        command: it is timed as the post_processing stage)
+        The import being complete, its checkpoints record is flagged as finished
+        """
+        with self.timer.stage('state'):
+            models.ImportProgress.objects.filter(tablename=ds['tablename']).update(finished=True)
+        with self.timer.stage('post_processing'):
+            models.ImportState.objects.update_or_create(tablename=ds['tablename'], defaults={
+                "last_updated": hyfaautils.julianday_to_datetime(last_published_day_jd),
+                "last_updated_jd": last_published_day_jd,
+                "update_errors": errors,
+                "last_updated_without_errors": hyfaautils.julianday_to_datetime(last_updated_without_errors_jd),
+                "last_updated_without_errors_jd": last_updated_without_errors_jd,
+            })
 
     def _retrieve_times_to_update(self, nc, tablename):
         """
@@ -1,6 +1,6 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import glob
-from io import StringIO
+import multiprocessing
 
 from netCDF4 import Dataset
 import numpy as np
@@ -12,12 +12,13 @@ from datetime import datetime
 from time import perf_counter
 import sys
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.conf import settings
 from django.db import connection, transaction
 
-from sagui.utils import hyfaa as hyfaautils
-from sagui.models import ImportState, RainFall
+from sagui.utils import db as db_utils, hyfaa as hyfaautils, instrumentation, manifest, pipeline as pipeline_utils
+from sagui.models import FilesManifest, ImportState, RainFall
 
 import re
 
@@ -25,7 +26,22 @@ def glob_re(pattern, strings):
     return filter(re.compile(pattern).match, strings)
 
 
-class Command(BaseCommand):
+def read_rainfall_file(file):
+    """
+    Decode a rainfall netcdf file. Module-level, so that it can run in a process pool
+    Returns: a 3-tuple of numpy arrays (cell_id, date, rain), one value per cell
+    """
+    with Dataset(file, "r", format="netCDF4") as nc:
+        nb_cells = nc.dimensions['n_meshes'].size
+        rain = nc.variables['rain'][:].data
+    # extract record date from filename
+    rec_date = Command._datetime_from_filename(file, r'DATA_(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})')
+    return (np.arange(start=1, stop=nb_cells + 1, dtype='i2'),
+            np.full(nb_cells, np.datetime64(rec_date.date(), 'D')),
+            rain)
+
+
+class Command(instrumentation.InstrumentedCommand):
     help = '''
     Rainfall netcdf files are an intermediate product of HYFAA-MGB algorithm but useful by themselves.
     Publish them to a pigeosolutions/hyfaa-postgis database. 
@@ -41,7 +57,13 @@ class Command(BaseCommand):
     force_update     = None
     only_last_n_days = None
     commit_page_size = None
+    pipeline         = None
+    queue_depth      = None
+    bulk_load        = None
+    workers          = None
+    executor         = None
     tablename        = 'sagui_rainfall'
+    manifest_files   = None
     last_updated_without_errors = None
 
     def add_arguments(self, parser):
@@ -54,7 +76,7 @@ class Command(BaseCommand):
         parser.add_argument('-f', '--force_update',
                             default=False,
                             action='store_true',
-                            help='Force update on all values. By default, only data updated since last publish will be published')
+                            help='Force update on all values (UPSERT of all the files). By default, only data updated since last publish will be published')
         parser.add_argument('--only_last_n_days',
                             type=int,
                             default=None,
@@ -63,6 +85,42 @@ class Command(BaseCommand):
                             type=int,
                             default=settings.SAGUI_SETTINGS.get('HYFAA_IMPORT_COMMIT_PAGE_SIZE', 1),
                             help='Commit the data into the DB every n different dates (default 1). Should run faster if set to 10 or 50')
+        parser.add_argument('--pipeline',
+                            default=False,
+                            action='store_true',
+                            help='Pipelined import: a reader thread decodes the next pages of netCDF files while the '
+                                 'current page is written into the DB')
+        parser.add_argument('--queue_depth',
+                            type=int,
+                            default=2,
+                            help='Max number of decoded pages waiting to be written, in pipelined mode (default 2)')
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=1,
+                            help='Number of processes decoding the netcdf files (default 1: decoding in the main process). '
+                                 'The files are written in order')
+        parser.add_argument('--bulk_load', '--bulk-load',
+                            dest='bulk_load',
+                            default=False,
+                            action='store_true',
+                            help='Bulk-load mode, for new environments or disaster recovery: the table is emptied and '
+                                 'its secondary indexes and unique constraint dropped, the files are loaded with COPY, '
+                                 'then the indexes are rebuilt (parallel build) and the table analyzed, before the '
+                                 'import state is updated. Implies --force_update')
+        parser.add_argument('--post_processing',
+                            choices=['inline', 'worker'],
+                            default=settings.SAGUI_SETTINGS.get('POST_PROCESSING_MODE', 'inline'),
+                            help='"inline": run the post-processing jobs queued by the import (sagui_worker --once) '
+                                 'before exiting. "worker": leave them to a running sagui_worker service. Default: '
+                                 'SAGUI_POST_PROCESSING_MODE setting, or inline')
+        parser.add_argument('--maintenance_work_mem',
+                            default='1GB',
+                            help='maintenance_work_mem used to rebuild the indexes, in bulk-load mode (default 1GB)')
+        parser.add_argument('--index_build_workers',
+                            type=int,
+                            default=4,
+                            help='max_parallel_maintenance_workers used to rebuild the indexes, in bulk-load mode '
+                                 '(default 4)')
 
     def handle(self, *args, **kwargs):
         tic = perf_counter()
@@ -72,51 +130,74 @@ class Command(BaseCommand):
         self.force_update = kwargs.get('force_update')
         self.only_last_n_days = kwargs.get('only_last_n_days')
         self.commit_page_size = kwargs.get('commit_page_size')
+        self.pipeline = kwargs.get('pipeline')
+        self.queue_depth = kwargs.get('queue_depth') or 2
+        self.bulk_load = kwargs.get('bulk_load')
+        if self.bulk_load:
+            self.force_update = True
+        self.workers = kwargs.get('workers') or 1
 
         self.stdout.write("Scanning folder {}".format(self.rootpath))
-        new_files = self._get_files_list()
+        with self.timer.stage('scan'):
+            new_files = self._get_files_list()
         # truncate the extraction to the last n days (useful when you are in a hurry)
         if self.only_last_n_days:
             new_files = new_files[-self.only_last_n_days:]
+            self.manifest_files = self.manifest_files[-self.only_last_n_days:]
 
         if not new_files:
             self.stdout.write(self.style.SUCCESS("DB is up to date"))
             return
 
 
-        if self.force_update:
-            self.stdout.write("Emptying the table before loading the new data (--force_update was enabled)")
+        if self.bulk_load and not self.dry_run:
+            self.stdout.write("Bulk load: emptying the table before loading the new data")
             with transaction.atomic():
                 with connection.cursor() as cursor:
                     cursor.execute('TRUNCATE TABLE guyane.sagui_rainfall;')
+                    cursor.execute('SELECT guyane.refresh_dataset_dates(%s);', [self.tablename])
 
-        counter = 1
-        errors = 0
-        concatenated_df = pd.DataFrame()
-        for f in new_files:
-            self.stdout.write("Reading {}".format(os.path.basename(f)))
-            df = self.netcdf_to_dataframe(f)
-            concatenated_df = pd.concat([df, concatenated_df], ignore_index=True)
-            if (counter % self.commit_page_size == 0) or (
-                    f == new_files[-1]):  # last part means is last time element
+        index_statements = None
+        if self.bulk_load and not self.dry_run:
+            self.stdout.write("Bulk load: dropping the indexes of table {}".format(self.tablename))
+            with transaction.atomic(), connection.cursor() as cursor:
+                index_statements = db_utils.drop_secondary_indexes(cursor, 'guyane', self.tablename)
+        if self.workers > 1:
+            self.stdout.write("Decoding the files using {} processes".format(self.workers))
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+        try:
+            errors = 0
+            pages = [new_files[i:i + self.commit_page_size] for i in range(0, len(new_files), self.commit_page_size)]
+            # netcdf to dataframe. In pipelined mode, the pages are decoded by a reader thread, ahead of the DB writes
+            pages_data = (self._read_page(page) for page in pages)
+            if self.pipeline:
+                pages_data = pipeline_utils.Pipeline(pages_data, queue_depth=self.queue_depth)
+            for concatenated_df in pages_data:
+                if self.dry_run:
+                    continue
                 try:
-                    # save dataframe to an in memory buffer, cf https://naysan.ca/2020/05/09/pandas-to-postgresql-using-psycopg2-bulk-insert-performance-benchmark/
-                    buffer = StringIO()
-                    concatenated_df.to_csv(buffer, header=False, index=False)
-                    buffer.seek(0)
-
-                    # Execute the query
-                    with connection.cursor() as cursor:
-                        cursor.copy_from(buffer, 'sagui_rainfall', sep=",", columns = ('cell_id','date', 'rain'))
-
+                    with self.timer.stage('write', rows=len(concatenated_df),
+                                          nbytes=concatenated_df.memory_usage(index=False).sum()):
+                        self._publish_dataframe_to_db(concatenated_df)
                 except (Exception, psycopg2.DatabaseError) as error:
                     print(error)
                     errors += 1
-                finally:
-                    # clear the list of records
-                    concatenated_df = pd.DataFrame()
-
-            counter +=1
+            if self.pipeline:
+                self.stdout.write(pages_data.summary())
+        finally:
+            if self.executor:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+            if index_statements is not None:
+                # Rebuild the indexes even if the load failed: the table must stay usable
+                self.stdout.write("Bulk load: rebuilding {} indexes on table {}".format(len(index_statements), self.tablename))
+                with self.timer.stage('index_build'), transaction.atomic(), connection.cursor() as cursor:
+                    db_utils.rebuild_indexes(cursor, 'guyane', self.tablename, index_statements,
+                                             maintenance_work_mem=kwargs.get('maintenance_work_mem') or '1GB',
+                                             parallel_workers=kwargs.get('index_build_workers') or 4)
+        if self.dry_run:
+            self.stdout.write("Dry run: {} files read, nothing written".format(len(new_files)))
+            return
 
         # Update the state table
         # Get the lastest update date from the filenames
@@ -124,23 +205,32 @@ class Command(BaseCommand):
         update_dates = [self._datetime_from_filename(f, regex) for f in new_files]
         last_update_date = max(update_dates)
         last_updated_without_errors = last_update_date if not errors else self.last_updated_without_errors
-        tbl_state = ImportState.objects.update_or_create(tablename=self.tablename, defaults={
-            "last_updated": last_update_date,
-            "last_updated_jd": hyfaautils.datetime_to_julianday(last_update_date),
-            "update_errors": errors,
-            "last_updated_without_errors": last_updated_without_errors,
-            "last_updated_without_errors_jd": hyfaautils.datetime_to_julianday(last_updated_without_errors),
-        })
+        # The state update queues the post-processing job (run by the sagui_worker command)
+        with self.timer.stage('post_processing'):
+            tbl_state = ImportState.objects.update_or_create(tablename=self.tablename, defaults={
+                "last_updated": last_update_date,
+                "last_updated_jd": hyfaautils.datetime_to_julianday(last_update_date),
+                "update_errors": errors,
+                "last_updated_without_errors": last_updated_without_errors,
+                "last_updated_without_errors_jd": hyfaautils.datetime_to_julianday(last_updated_without_errors),
+            })
+
+        if not errors:
+            manifest.mark_imported(self.manifest_files)
+        if (kwargs.get('post_processing') or 'inline') == 'inline':
+            # Run the post-processing job queued by the state update, as `sagui_worker --once` would
+            with self.timer.stage('post_processing'):
+                call_command('sagui_worker', once=True, stdout=self.stdout, stderr=self.stderr)
 
         tac = perf_counter()
-        self.stdout.write(self.style.SUCCESS('Total processing time: {}'.format(tac - tic)))
+        self.stdout.write(self.style.SUCCESS('Total processing time: {} s'.format( round(tac - tic, 2) )))
 
 
     def _get_files_list(self):
         """
         List the files to import:
         - retrieve information from the state table, to determine the last import date
-        - compare it with the folder's content (note: it's not using the sqlitedb)
+        - compare it with the folder's content, listed in the files manifest (note: it's not using the sqlitedb)
         Returns: a list of file names (strings)
         """
         tbl_state = ImportState.objects.filter(tablename__exact=self.tablename)
@@ -156,39 +246,62 @@ class Command(BaseCommand):
         else:
             self.stdout.write("Importing for the first time: it will take some time (importing all dates in the file)")
 
-        # List files that are more recent than that
+        # List files that are more recent than that, from the files manifest (the folder is only scanned if it was
+        # modified since the last run)
         last_updated_text = last_updated_without_errors.strftime("%Y%m%dT%H%M")
-        # regex = '(.*)DATA_([0-9T]*)_'+last_updated_text+'([0-9]*)_([0-9]*)\\.nc'
-        regex2 = '.*DATA_[0-9T]*_(\d{8}T\d{4})[0-9]*_[0-9]*\\.nc'
-        all_filenames = glob.glob('{path}/*.nc'.format(path=self.rootpath))
-        new_files = sorted([s for s in all_filenames if re.search(regex2, s).group(1) > last_updated_text])
+        folder = manifest.refresh_folder(self.rootpath, 'rainfall')
+        new_files = list(FilesManifest.objects.filter(folder=folder, version__gt=last_updated_text).order_by('name'))
         if not new_files:
             return None
 
         # Some days might have been downloaded several times with different datestamps (last part of the name)
         # => we only need the most recent one
-        filtered_new_files = []
+        self.manifest_files = []
         for i in range(len(new_files)-1):
-            if os.path.basename(new_files[i])[:18] != os.path.basename(new_files[i+1])[:18] :
-                filtered_new_files.append(new_files[i])
-        filtered_new_files.append(new_files[-1]) # last one is always the most recent, since it is a sorted list
-        return filtered_new_files
+            if new_files[i].name[:18] != new_files[i+1].name[:18] :
+                self.manifest_files.append(new_files[i])
+        self.manifest_files.append(new_files[-1]) # last one is always the most recent, since it is a sorted list
+        return [f.path for f in self.manifest_files]
 
-    def netcdf_to_dataframe(self, file):
-        nc = Dataset(file, "r", format="netCDF4")
-        nb_cells = nc.dimensions['n_meshes'].size
-        rain_values = nc.variables['rain'][:].data
-
-        # extract record date from filename
-        regex = r'DATA_(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})'
-        rec_date = self._datetime_from_filename(file, regex)
-
-        columns_dict = {
-            'cell_id': np.arange(start=1, stop=nb_cells + 1, dtype='i2'),
-            'date': np.full(nb_cells, rec_date),
-            'rain': nc.variables['rain'][:].data,
-        }
-        df = pd.DataFrame.from_dict(columns_dict)
+    def _publish_dataframe_to_db(self, df):
+        """
+        Write a page of data into the DB: COPY into a temporary staging table, then UPSERT into the rainfall table, so
+        that the days re-downloaded (newer files) replace the previous values.
+        In bulk-load mode (empty table, no unique constraint), the page is loaded with a plain COPY
+        """
+        cols = list(df.columns)
+        with connection.cursor() as cursor:
+            if self.bulk_load:
+                with transaction.atomic():
+                    db_utils.copy_dataframe(cursor, df, 'guyane.{}'.format(self.tablename))
+                    db_utils.register_dataset_dates(cursor, self.tablename, df['date'])
+                return
+            with db_utils.staging_table(cursor, 'guyane', self.tablename, cols) as staging_name:
+                db_utils.copy_dataframe(cursor, df, staging_name)
+                db_utils.upsert_from_staging(cursor, 'guyane', self.tablename, staging_name, cols,
+                                             conflict_target='(cell_id, date)', key_columns=['cell_id', 'date'])
+                # Record the written dates in the dataset_dates catalog
+                db_utils.register_dataset_dates(cursor, self.tablename, df['date'])
+
+    def _read_page(self, files):
+        """
+        Read a page of netcdf files into a single dataframe. The files are decoded in the process pool, if
+        configured (the results are returned in the files order)
+        """
+        for f in files:
+            self.stdout.write("Reading {}".format(os.path.basename(f)))
+        with self.timer.stage('read') as stage:
+            decoded = list(self.executor.map(read_rainfall_file, files) if self.executor else map(read_rainfall_file, files))
+            stage.rows = sum(rain.size for _, _, rain in decoded)
+            stage.nbytes = sum(rain.nbytes for _, _, rain in decoded)
+
+        with self.timer.stage('transform'):
+            cell_ids, dates, rains = zip(*decoded)
+            df = pd.DataFrame({
+                'cell_id': np.concatenate(cell_ids),
+                'date': np.concatenate(dates),
+                'rain': np.concatenate(rains),
+            }, copy=False)
         return df
 
     @staticmethod
@@ -0,0 +1,41 @@
+from time import perf_counter
+
+from django.conf import settings
+
+from sagui.utils import instrumentation, manifest
+
+
+class Command(instrumentation.InstrumentedCommand):
+    help = '''
+    Update the files manifest (sagui_filesmanifest table) of the atmo and rainfall folders: new files are added, deleted
+    files removed. Meant to be run (e.g. from a cron job) after new atmo images are produced: the API only reads the
+    manifest. The rainfall folder is also refreshed by the rainfall_import command
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('-k', '--kind',
+                            choices=['atmo', 'rainfall', 'all'],
+                            default='all',
+                            help='Folder(s) to refresh (default all)')
+
+    def handle(self, *args, **kwargs):
+        tic = perf_counter()
+        folders = {
+            'atmo': settings.SAGUI_SETTINGS.get('SAGUI_PATH_TO_ATMO_FILES'),
+            'rainfall': settings.SAGUI_SETTINGS.get('RAINFALL_NETCDF_FILES_PATH'),
+        }
+        for kind, path in folders.items():
+            if kwargs['kind'] not in (kind, 'all'):
+                continue
+            if not path:
+                self.stdout.write(self.style.WARNING('No {} folder configured'.format(kind)))
+                continue
+            if self.dry_run:
+                self.stdout.write('Dry run: {} folder {} not refreshed'.format(kind, path))
+                continue
+            with self.timer.stage('scan'):
+                folder = manifest.refresh_folder(path, kind)
+            self.stdout.write('{} folder {}: {} files'.format(kind, path, folder.files.count()))
+
+        tac = perf_counter()
+        self.stdout.write(self.style.SUCCESS('Total processing time: {} s'.format( round(tac - tic, 2) )))
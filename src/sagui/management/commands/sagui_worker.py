@@ -0,0 +1,255 @@
+import select
+from time import perf_counter, sleep
+
+import psycopg2
+from django.db import OperationalError, connection, transaction
+from django.utils import timezone
+
+from sagui import models
+from sagui.utils import instrumentation, scheduler
+
+CHANNEL = 'sagui_post_processing'
+JOBS_TABLE = 'guyane.sagui_postprocessingjob'
+
+
+class Command(instrumentation.InstrumentedCommand):
+    help = '''
+    Post-processing worker: runs the post-processing jobs (computation of the expected and anomaly values, update of
+    the rolling windows, aggregate tables and stations snapshots) queued when an import updates the sagui_importstate
+    table.
+    The post-processing steps of the imported table (see guyane.post_processing_steps) are run in dependency order, the
+    independent ones in parallel (see sagui.utils.scheduler). The steps are recorded in the sagui_postprocessingstep
+    table. A step waiting for a lock (e.g. on a view read by pg_tileserv) would make the readers queue behind it: it
+    gives up after --lock_timeout seconds, and is run again later.
+    Waits for new jobs using LISTEN/NOTIFY. Several workers can run concurrently (jobs are claimed using
+    FOR UPDATE SKIP LOCKED), but a single worker guarantees that the jobs are run in the order they were queued
+    '''
+
+    # Class-wide variables, that will be set using command options
+    once          = None
+    max_attempts  = None
+    retry_delay   = None
+    poll_interval = None
+    step_workers  = None
+    lock_timeout  = None
+    lock_retries  = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once',
+                            default=False,
+                            action='store_true',
+                            help='Run the pending jobs, then exit (useful in a cron job, after the imports)')
+        parser.add_argument('--max_attempts',
+                            type=int,
+                            default=3,
+                            help='Max nb of attempts for a job before it is marked as failed (default 3)')
+        parser.add_argument('--retry_delay',
+                            type=int,
+                            default=60,
+                            help='Delay, in seconds, before a failed job is retried (default 60)')
+        parser.add_argument('--poll_interval',
+                            type=int,
+                            default=60,
+                            help='Max time, in seconds, between two checks of the jobs table when no notification is '
+                                 'received (default 60)')
+        parser.add_argument('--step_workers',
+                            type=int,
+                            default=4,
+                            help='Max nb of post-processing steps run concurrently, each one using its own DB '
+                                 'connection (default 4)')
+        parser.add_argument('--lock_timeout',
+                            type=float,
+                            default=5,
+                            help='Max time, in seconds, a post-processing step waits for a lock before it gives up '
+                                 '(default 5)')
+        parser.add_argument('--lock_retries',
+                            type=int,
+                            default=5,
+                            help='Max nb of times a post-processing step that could not get a lock in time is run '
+                                 'again (default 5)')
+
+    def handle(self, *args, **kwargs):
+        self.once = kwargs.get('once')
+        self.max_attempts = kwargs.get('max_attempts')
+        self.retry_delay = kwargs.get('retry_delay')
+        self.poll_interval = kwargs.get('poll_interval')
+        self.step_workers = kwargs.get('step_workers')
+        self.lock_timeout = kwargs.get('lock_timeout')
+        self.lock_retries = kwargs.get('lock_retries')
+
+        if not self.once:
+            connection.ensure_connection()
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN {};'.format(CHANNEL))
+            self.stdout.write('Listening for post-processing jobs on channel {}'.format(CHANNEL))
+
+        while True:
+            self.recover_stale_jobs()
+            while self.run_next_job():
+                pass
+            if self.once:
+                break
+            self.wait_for_notification()
+
+    def wait_for_notification(self):
+        """
+        Block until a notification is received on the jobs channel, or until poll_interval is elapsed
+        """
+        pg_conn = connection.connection
+        if select.select([pg_conn], [], [], self.poll_interval) != ([], [], []):
+            pg_conn.poll()
+            while pg_conn.notifies:
+                notify = pg_conn.notifies.pop(0)
+                self.stdout.write('Notified: import of table {}'.format(notify.payload))
+
+    def recover_stale_jobs(self):
+        """
+        The jobs left in 'running' status by a worker that died (its DB backend does not exist anymore) are queued
+        again: only one of them per table (the most recent one), and only if no other job is already pending for the
+        table (only one pending job per table is allowed). The other ones are marked as failed
+        """
+        if self.dry_run:
+            return
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                '''
+                WITH dead AS (
+                    SELECT d.id, row_number() OVER (PARTITION BY d.tablename ORDER BY d.id DESC) = 1 AND NOT EXISTS (
+                            SELECT 1 FROM {jobs} p WHERE p.tablename = d.tablename AND p.status = 'pending'
+                        ) AS requeue
+                    FROM {jobs} d
+                    WHERE d.status = 'running' AND d.worker_pid NOT IN (SELECT pid FROM pg_stat_activity)
+                )
+                UPDATE {jobs} j SET status = CASE WHEN dead.requeue THEN 'pending' ELSE 'failed' END,
+                    last_error = 'Worker died while running the job'
+                FROM dead
+                WHERE j.id = dead.id AND j.status = 'running';
+                '''.format(jobs=JOBS_TABLE)
+            )
+            if cursor.rowcount:
+                self.stdout.write(self.style.WARNING('Recovered {} job(s) left by a dead worker'.format(cursor.rowcount)))
+
+    def run_next_job(self):
+        """
+        Claim the oldest pending job and run it
+        Returns: True if a job was run, False if there is no pending job
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                '''
+                SELECT id, tablename, attempts FROM {jobs}
+                WHERE status = 'pending' AND (run_after IS NULL OR run_after <= now())
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED;
+                '''.format(jobs=JOBS_TABLE)
+            )
+            job = cursor.fetchone()
+            if job is None:
+                return False
+            job_id, tablename, attempts = job
+            if self.dry_run:
+                self.stdout.write('Dry run: job #{} (post-processing of table {}) not run'.format(job_id, tablename))
+                return False
+            cursor.execute(
+                '''
+                UPDATE {jobs} SET status = 'running', attempts = attempts + 1, started_at = now(), finished_at = NULL,
+                    worker_pid = pg_backend_pid()
+                WHERE id = %s;
+                '''.format(jobs=JOBS_TABLE), [job_id]
+            )
+
+        self.stdout.write('Running job #{} (post-processing of table {}, attempt {})'.format(job_id, tablename, attempts + 1))
+        tic = perf_counter()
+        error = None
+        try:
+            with self.timer.stage('post_processing'):
+                failed = self.run_steps(tablename, job_id)
+            if failed:
+                raise RuntimeError('Post-processing failed for steps {}'.format(', '.join(failed)))
+        except Exception as e:
+            error = e
+        duration = perf_counter() - tic
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            if error is None:
+                cursor.execute(
+                    '''
+                    UPDATE {jobs} SET status = 'done', finished_at = now(), duration = %s, last_error = ''
+                    WHERE id = %s;
+                    '''.format(jobs=JOBS_TABLE), [duration, job_id]
+                )
+                self.stdout.write(self.style.SUCCESS('Job #{} done in {} s'.format(job_id, round(duration, 2))))
+            else:
+                # Retry later, unless the max nb of attempts is reached or a new job is already pending for the table
+                # (it will do the same post-processing)
+                cursor.execute(
+                    '''
+                    UPDATE {jobs} j SET finished_at = now(), duration = %s, last_error = %s,
+                        run_after = now() + make_interval(secs => %s),
+                        status = CASE WHEN j.attempts < %s AND NOT EXISTS (
+                                SELECT 1 FROM {jobs} p WHERE p.tablename = j.tablename AND p.status = 'pending'
+                            ) THEN 'pending' ELSE 'failed' END
+                    WHERE id = %s
+                    RETURNING status;
+                    '''.format(jobs=JOBS_TABLE), [duration, str(error), self.retry_delay, self.max_attempts, job_id]
+                )
+                status = cursor.fetchone()[0]
+                self.stdout.write(self.style.ERROR('Job #{} failed after {} s ({}): {}'.format(
+                    job_id, round(duration, 2), 'will be retried' if status == 'pending' else 'giving up', error)))
+        return True
+
+    def run_steps(self, tablename, job_id):
+        """
+        Run the post-processing steps of the table, in dependency order, the independent ones in parallel. Each step is
+        run in its own transaction, and recorded in the sagui_postprocessingstep table. A step that could not get a
+        lock within lock_timeout is run again (up to lock_retries times), after a growing delay
+        Returns: the names of the failed steps
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT step, statement, depends_on FROM guyane.post_processing_steps(%s);', [tablename])
+            steps = {step: (statement, set(depends_on)) for step, statement, depends_on in cursor.fetchall()}
+        records = {}
+
+        def run(step):
+            record = models.PostProcessingStep(step=step, job_id=job_id, started_at=timezone.now(),
+                                               status=models.PostProcessingStep.Status.DONE)
+            records[step] = record
+            tic = perf_counter()
+            try:
+                while True:
+                    try:
+                        with transaction.atomic(), connection.cursor() as cursor:
+                            cursor.execute("SELECT set_config('lock_timeout', %s, true);",
+                                           ['{}ms'.format(int(self.lock_timeout * 1000))])
+                            cursor.execute(steps[step][0])
+                        break
+                    except OperationalError as e:
+                        if not isinstance(e.__cause__, psycopg2.errors.LockNotAvailable) \
+                                or record.attempts > self.lock_retries:
+                            raise
+                        sleep(record.attempts)
+                        record.attempts += 1
+            except Exception as e:
+                record.status = models.PostProcessingStep.Status.FAILED
+                record.error = str(e)
+            finally:
+                record.duration = perf_counter() - tic
+                # Each thread uses its own connection
+                connection.close()
+            return record.status == models.PostProcessingStep.Status.DONE
+
+        def on_done(step, result):
+            if result is None:
+                records[step] = models.PostProcessingStep(step=step, job_id=job_id, started_at=timezone.now(),
+                                                          status=models.PostProcessingStep.Status.SKIPPED,
+                                                          error='A step it depends on failed')
+            record = records[step]
+            self.stdout.write('  {}: {}{}{}'.format(
+                step, record.status, ' in {} s'.format(round(record.duration, 2)) if record.duration is not None else '',
+                ' ({} attempts)'.format(record.attempts) if record.attempts > 1 else ''))
+
+        scheduler.schedule({step: deps for step, (_, deps) in steps.items()}, run, max_workers=self.step_workers,
+                           on_done=on_done)
+        models.PostProcessingStep.objects.bulk_create(records.values())
+        return [r.step for r in records.values() if r.status == models.PostProcessingStep.Status.FAILED]
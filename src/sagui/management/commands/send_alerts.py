@@ -1,13 +1,14 @@
 from time import perf_counter
 
 from django.core.mail import send_mail
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 from django.utils import translation
 from django.template.loader import get_template
 
 from sagui import models, utils as sagui_utils
+from sagui.utils import instrumentation
 
-class Command(BaseCommand):
+class Command(instrumentation.InstrumentedCommand):
     help = '''
     Send relevant alerts (flow, rain, atmo) to subscribed users
     '''
@@ -19,12 +20,14 @@ class Command(BaseCommand):
         user_language = 'fr'
         translation.activate(user_language)
         tic = perf_counter()
-        stations_alert_info = sagui_utils.stations_alert.get_stations_alert_info()
-        stations_forecast_info = sagui_utils.stations_forecast.get_stations_alert_info()
-        rain_info = sagui_utils.rain.get_global_alert_info()
-        atmo_info = sagui_utils.atmo.get_global_alert_info()
+        with self.timer.stage('read'):
+            stations_alert_info = sagui_utils.stations_alert.get_stations_alert_info()
+            stations_forecast_info = sagui_utils.stations_forecast.get_stations_alert_info()
+            rain_info = sagui_utils.rain.get_global_alert_info()
+            atmo_info = sagui_utils.atmo.get_global_alert_info()
 
-        subscriptions = models.AlertSubscriptions.objects.all()
+        with self.timer.stage('scan'):
+            subscriptions = list(models.AlertSubscriptions.objects.all())
         for sub in subscriptions:
             with translation.override(sub.language):
                 self.stdout.write(f'Processing alerts for subscribee {sub.email}')
@@ -57,26 +60,31 @@ class Command(BaseCommand):
                     # don't send email
                     continue
 
-                tpl = get_template("sagui/alert_email.txt")
-                txt_email = tpl.render(context={'sub':sub,
-                                                 'alerts':alerts,
-                                                 'rain_levels':sagui_utils.rain.ALERT_LEVELS
-                                                 }
-                                        )
-                tpl = get_template("sagui/alert_email.html")
-                html_email = tpl.render(context={'sub':sub,
-                                                 'alerts':alerts,
-                                                 'rain_levels':sagui_utils.rain.ALERT_LEVELS
-                                                 }
-                                        )
-                send_mail(
-                    'SAGUI alert',
-                    txt_email,
-                    'ige31.jp@gmail.com',
-                    [sub.email],
-                    fail_silently=False,
-                    html_message=html_email
-                )
+                with self.timer.stage('transform', rows=1):
+                    tpl = get_template("sagui/alert_email.txt")
+                    txt_email = tpl.render(context={'sub':sub,
+                                                     'alerts':alerts,
+                                                     'rain_levels':sagui_utils.rain.ALERT_LEVELS
+                                                     }
+                                            )
+                    tpl = get_template("sagui/alert_email.html")
+                    html_email = tpl.render(context={'sub':sub,
+                                                     'alerts':alerts,
+                                                     'rain_levels':sagui_utils.rain.ALERT_LEVELS
+                                                     }
+                                            )
+                if self.dry_run:
+                    self.stdout.write(f'Dry run: alert email ({", ".join(alerts.keys())}) not sent to {sub.email}')
+                    continue
+                with self.timer.stage('write', rows=1, nbytes=len(txt_email) + len(html_email)):
+                    send_mail(
+                        'SAGUI alert',
+                        txt_email,
+                        'ige31.jp@gmail.com',
+                        [sub.email],
+                        fail_silently=False,
+                        html_message=html_email
+                    )
 
         tac = perf_counter()
-        self.stdout.write(self.style.SUCCESS('Total processing time: {} s'.format( round(tac - tic), 2 )))
+        self.stdout.write(self.style.SUCCESS('Total processing time: {} s'.format( round(tac - tic, 2) )))
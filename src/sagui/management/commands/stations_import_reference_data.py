@@ -1,11 +1,9 @@
 from time import perf_counter
 
-from django.core.management.base import BaseCommand
+from sagui.utils import instrumentation, reference_data as reference_data_utils
 
-from sagui.utils import reference_data as reference_data_utils
 
-
-class Command(BaseCommand):
+class Command(instrumentation.InstrumentedCommand):
     help = '''
     Get a very plain CSV data provided by Adrien and publish it into the DB
     '''
@@ -18,8 +16,8 @@ class Command(BaseCommand):
 
         filepath = kwargs['path']
 
-        reference_data_utils.import_csv(filepath)
+        reference_data_utils.import_csv(filepath, dry_run=self.dry_run, timer=self.timer)
 
         tac = perf_counter()
-        self.stdout.write(self.style.SUCCESS('Total processing time: {}'.format(tac - tic)))
+        self.stdout.write(self.style.SUCCESS('Total processing time: {} s'.format( round(tac - tic, 2) )))
 
@@ -0,0 +1,442 @@
+# Generated by Django 4.0.5 on 2026-10-18 09:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0052_alertsubscriptions_language'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+-- Creates the range partitions (by year or by month) needed to store the data between the _from and _to dates.
+-- Partitions are named after the parent table: <table>_p2020 (by year) or <table>_p2020_01 (by month)
+-- RETURNS the number of created partitions
+CREATE OR REPLACE FUNCTION guyane.create_missing_partitions(_schema text, _tbl text, _granularity text, _from date, _to date)
+RETURNS integer
+AS
+$$
+DECLARE
+    p_start date;
+    p_end date;
+    p_name text;
+    counter integer;
+BEGIN
+    counter := 0;
+    p_start := date_trunc(_granularity, _from)::date;
+    WHILE p_start <= _to LOOP
+        p_end := (p_start + ('1 ' || _granularity)::interval)::date;
+        p_name := _tbl || '_p' || CASE WHEN _granularity = 'month' THEN to_char(p_start, 'YYYY_MM') ELSE to_char(p_start, 'YYYY') END;
+        IF to_regclass(format('%I.%I', _schema, p_name)) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I.%I PARTITION OF %I.%I FOR VALUES FROM (%L) TO (%L)',
+                           _schema, p_name, _schema, _tbl, p_start, p_end);
+            counter := counter + 1;
+        END IF;
+        p_start := p_end;
+    END LOOP;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.create_missing_partitions(_schema text, _tbl text, _granularity text, _from date, _to date)
+    IS 'Creates the range partitions (granularity: ''year'' or ''month'') needed to store the data between the _from and _to dates.
+    RETURNS the number of created partitions';
+
+
+-- Drops the partitions of a range-partitioned table that only hold data older than the _before date
+-- RETURNS the number of dropped partitions
+CREATE OR REPLACE FUNCTION guyane.drop_partitions_before(_tbl regclass, _before date)
+RETURNS integer
+AS
+$$
+DECLARE
+    part RECORD;
+    counter integer;
+BEGIN
+    counter := 0;
+    FOR part IN
+        SELECT c.oid::regclass AS name,
+               (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \\(''([^'']+)''\\)'))[1]::date AS upper_bound
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = _tbl
+    LOOP
+        IF part.upper_bound IS NOT NULL AND part.upper_bound <= _before THEN
+            EXECUTE format('DROP TABLE %s', part.name);
+            RAISE INFO 'Dropped partition %', part.name;
+            counter := counter + 1;
+        END IF;
+    END LOOP;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.drop_partitions_before(_tbl regclass, _before date)
+    IS 'Drops the partitions of a range-partitioned table that only hold data older than the _before date.
+    RETURNS the number of dropped partitions';
+
+
+-- Converts a hyfaa_data_* table into a table partitioned by date range, keeping its data, indexes and constraints.
+-- The primary key has to include the partition key: it becomes (id, date).
+-- Dependent views have to be dropped beforehand
+CREATE OR REPLACE FUNCTION guyane.convert_to_partitioned(_schema text, _tbl text, _granularity text)
+RETURNS void
+AS
+$$
+DECLARE
+    old_tbl text;
+    old_tbl_name text;
+    min_date date;
+    max_date date;
+    rec RECORD;
+    defs text[];
+    def text;
+    seq text;
+    is_identity boolean;
+BEGIN
+    old_tbl := _tbl || '_unpartitioned';
+    EXECUTE format('ALTER TABLE %I.%I RENAME TO %I', _schema, _tbl, old_tbl);
+    old_tbl_name := format('%I.%I', _schema, old_tbl)::regclass::text;
+    EXECUTE format('CREATE TABLE %I.%I (LIKE %I.%I INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING COMMENTS) PARTITION BY RANGE ("date")',
+                   _schema, _tbl, _schema, old_tbl);
+
+    -- Copy the data
+    EXECUTE format('SELECT MIN("date"), MAX("date") FROM %I.%I', _schema, old_tbl) INTO min_date, max_date;
+    IF min_date IS NOT NULL THEN
+        PERFORM guyane.create_missing_partitions(_schema, _tbl, _granularity, min_date, max_date);
+        EXECUTE format('INSERT INTO %I.%I SELECT * FROM %I.%I', _schema, _tbl, _schema, old_tbl);
+    END IF;
+
+    -- Keep the definitions of the secondary indexes and of the unique constraints (Django knows them by name).
+    -- The indexes are rebuilt from their columns (with their opclass and ordering), on the new table
+    defs := '{}';
+    FOR rec IN
+        SELECT ic.relname AS idx_name, am.amname AS method, x.indisunique AS is_unique,
+            (SELECT string_agg(pg_get_indexdef(x.indexrelid, k, true)
+                    || CASE WHEN opc.opcdefault THEN '' ELSE format(' %I.%I', opcn.nspname, opc.opcname) END
+                    || CASE WHEN x.indoption[k - 1] & 1 = 1 THEN ' DESC' ELSE '' END
+                    || CASE WHEN x.indoption[k - 1] & 3 = 2 THEN ' NULLS FIRST'
+                            WHEN x.indoption[k - 1] & 3 = 1 THEN ' NULLS LAST'
+                            ELSE '' END,
+                    ', ' ORDER BY k)
+             FROM generate_series(1, x.indnkeyatts) k
+             JOIN pg_opclass opc ON opc.oid = x.indclass[k - 1]
+             JOIN pg_namespace opcn ON opcn.oid = opc.opcnamespace) AS key_cols,
+            (SELECT string_agg(pg_get_indexdef(x.indexrelid, k, true), ', ' ORDER BY k)
+             FROM generate_series(x.indnkeyatts + 1, x.indnatts) k) AS include_cols,
+            pg_get_expr(x.indpred, x.indrelid, true) AS pred
+        FROM pg_index x
+        JOIN pg_class ic ON ic.oid = x.indexrelid
+        JOIN pg_am am ON am.oid = ic.relam
+        WHERE x.indrelid = old_tbl_name::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+    LOOP
+        defs := defs || format('CREATE %sINDEX %I ON %I.%I USING %s (%s)%s%s',
+                               CASE WHEN rec.is_unique THEN 'UNIQUE ' ELSE '' END, rec.idx_name, _schema, _tbl,
+                               rec.method, rec.key_cols,
+                               COALESCE(' INCLUDE (' || rec.include_cols || ')', ''),
+                               COALESCE(' WHERE ' || rec.pred, ''));
+    END LOOP;
+    FOR rec IN
+        SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+        WHERE conrelid = old_tbl_name::regclass AND contype = 'u'
+    LOOP
+        defs := defs || format('ALTER TABLE %I.%I ADD CONSTRAINT %I %s', _schema, _tbl, rec.conname, rec.def);
+    END LOOP;
+
+    -- Keep the id sequence
+    seq := pg_get_serial_sequence(old_tbl_name, 'id');
+    SELECT attidentity <> '' INTO is_identity FROM pg_attribute WHERE attrelid = old_tbl_name::regclass AND attname = 'id';
+    IF seq IS NOT NULL AND NOT is_identity THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I.id', seq, _schema, _tbl);
+    END IF;
+
+    EXECUTE format('DROP TABLE %I.%I', _schema, old_tbl);
+
+    IF is_identity THEN
+        EXECUTE format('SELECT setval(pg_get_serial_sequence(%L, ''id''), COALESCE((SELECT MAX(id) FROM %I.%I), 0) + 1, false)',
+                       format('%I.%I', _schema, _tbl), _schema, _tbl);
+    END IF;
+    EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I PRIMARY KEY (id, "date")', _schema, _tbl, _tbl || '_pkey');
+    FOREACH def IN ARRAY defs LOOP
+        EXECUTE def;
+    END LOOP;
+    RAISE INFO 'Table %.% is now partitioned by %', _schema, _tbl, _granularity;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.convert_to_partitioned(_schema text, _tbl text, _granularity text)
+    IS 'Converts a hyfaa_data_* table into a table partitioned by date range (granularity: ''year'' or ''month''),
+    keeping its data, indexes and constraints. The primary key becomes (id, date).
+    Dependent views have to be dropped beforehand';
+            """),
+        migrations.RunSQL(
+            """
+-- Drop the views depending on the hyfaa_data_* tables. They are re-created below
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_assimilated CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_mgbstandard CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_data_with_assimilated_aggregate_geo CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_data_with_mgbstandard_aggregate_geo CASCADE;
+DROP VIEW IF EXISTS guyane.hyfaa_data_assimilated_aggregate_json CASCADE;
+DROP VIEW IF EXISTS guyane.hyfaa_data_mgbstandard_aggregate_json CASCADE;
+
+-- Historical data is partitioned by year. Forecast data only spans a few days and is purged on each update:
+-- partition it by month, to be able to drop the old partitions
+SELECT guyane.convert_to_partitioned('guyane', 'hyfaa_data_mgbstandard', 'year');
+SELECT guyane.convert_to_partitioned('guyane', 'hyfaa_data_assimilated', 'year');
+SELECT guyane.convert_to_partitioned('guyane', 'hyfaa_data_forecast', 'month');
+            """),
+        migrations.RunSQL(
+            """
+-----------------------------------------------------
+-- Aggregate the last 15d values in a json field
+-----------------------------------------------------
+
+
+
+-----------------------------------------------------
+-- on assimilated data
+CREATE OR REPLACE VIEW guyane.hyfaa_data_assimilated_aggregate_json
+ AS
+SELECT cell_id,
+       json_agg(
+          json_build_object(
+      		'date', date,
+      		'flow', ROUND(flow_median),
+      		'flow_anomaly', ROUND(flow_anomaly)
+      		)
+	        ORDER BY "date" DESC
+        ) AS values
+FROM guyane.hyfaa_data_assimilated
+WHERE "date" IN (SELECT "date" from guyane.hyfaa_data_assimilated
+						GROUP BY "date" ORDER BY "date" DESC LIMIT 15)
+GROUP BY cell_id
+ORDER BY cell_id;
+
+ALTER TABLE guyane.hyfaa_data_assimilated_aggregate_json
+    OWNER TO postgres;
+
+COMMENT ON  VIEW guyane.hyfaa_data_assimilated_aggregate_json IS
+    'Round the values.
+    Aggregate the results for the n last days into a json field';
+
+-----------------------------------------------------
+-- on mgbstandard data
+
+CREATE OR REPLACE VIEW guyane.hyfaa_data_mgbstandard_aggregate_json
+ AS
+SELECT cell_id,
+       json_agg(
+          json_build_object(
+      		'date', date,
+      		'flow', ROUND(flow_mean),
+      		'flow_anomaly', ROUND(flow_anomaly)
+      		)
+	        ORDER BY "date" DESC
+        ) AS values
+FROM guyane.hyfaa_data_mgbstandard
+WHERE "date" IN (SELECT "date" from guyane.hyfaa_data_mgbstandard
+						GROUP BY "date" ORDER BY "date" DESC LIMIT 15)
+GROUP BY cell_id
+ORDER BY cell_id;
+
+ALTER TABLE guyane.hyfaa_data_mgbstandard_aggregate_json
+    OWNER TO postgres;
+
+COMMENT ON  VIEW guyane.hyfaa_data_mgbstandard_aggregate_json IS
+    'Round the values.
+    Aggregate the results for the n last days into a json field';
+            """),
+        migrations.RunSQL(
+            """
+-----------------------------------------------------
+-- Join the hyfaa *_aggregate_json views with the geo data.
+-- Make them a Materialized View, in order to reduce load
+-----------------------------------------------------
+
+-- on assimilated data
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_data_with_assimilated_aggregate_geo CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_data_with_assimilated_aggregate_geo
+AS
+ SELECT data.*,
+        geo.ordem,
+        ROUND(geo.width::numeric) AS width,
+        ROUND(geo.depth::numeric, 2) AS depth,
+        ST_Transform(geo.geom, 4326)::geometry(Geometry,4326) AS geom
+  FROM guyane.hyfaa_data_assimilated_aggregate_json AS data,
+       guyane.drainage_mgb_masked AS geo
+  WHERE geo.mini = data.cell_id
+  ORDER BY cell_id
+WITH DATA;
+CREATE UNIQUE INDEX ON guyane.hyfaa_data_with_assimilated_aggregate_geo (cell_id);
+
+ALTER TABLE guyane.hyfaa_data_with_assimilated_aggregate_geo
+    OWNER TO postgres;
+
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_data_with_assimilated_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the most recent values (n last days, stored in a json object)';
+
+
+-- on mgbstandard data
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_data_with_mgbstandard_aggregate_geo CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_data_with_mgbstandard_aggregate_geo
+AS
+ SELECT data.*,
+        geo.ordem,
+        ROUND(geo.width::numeric) AS width,
+        ROUND(geo.depth::numeric, 2) AS depth,
+        ST_Transform(geo.geom, 4326)::geometry(Geometry,4326) AS geom
+  FROM guyane.hyfaa_data_mgbstandard_aggregate_json AS data,
+       guyane.drainage_mgb_masked AS geo
+  WHERE geo.mini = data.cell_id
+  ORDER BY cell_id
+WITH DATA;
+CREATE UNIQUE INDEX ON guyane.hyfaa_data_with_mgbstandard_aggregate_geo (cell_id);
+
+ALTER TABLE guyane.hyfaa_data_with_mgbstandard_aggregate_geo
+    OWNER TO postgres;
+
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_data_with_mgbstandard_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the most recent values (n last days, stored in a json object)';
+            """),
+        migrations.RunSQL(
+            """
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_assimilated CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated
+AS
+WITH forecast_data AS (
+	SELECT 'forecast' AS source, cell_id, "date", ROUND(flow_median) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_forecast WHERE "date" > (SELECT MAX("date") FROM guyane.hyfaa_data_assimilated)
+),
+data_10d AS (
+	SELECT 'assimilated' AS source, cell_id, "date", ROUND(flow_median) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_assimilated WHERE "date" > (SELECT MAX("date") FROM guyane.hyfaa_data_assimilated)  - '10 days'::interval
+)
+SELECT * FROM forecast_data UNION SELECT * FROM data_10d
+ORDER BY cell_id, "date" DESC;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated
+    IS 'Fusion latest values from assimilated table and forecast values (+/- 10 days)';
+
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_mgbstandard CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard
+AS
+WITH forecast_data AS (
+	SELECT 'forecast' AS source, cell_id, "date", ROUND(flow_median) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_forecast WHERE "date" > (SELECT MAX("date") FROM guyane.hyfaa_data_mgbstandard)
+),
+data_10d AS (
+	SELECT 'mgbstandard' AS source, cell_id, "date", ROUND(flow_mean) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_mgbstandard WHERE "date" > (SELECT MAX("date") FROM guyane.hyfaa_data_mgbstandard)  - '10 days'::interval
+)
+SELECT * FROM forecast_data UNION SELECT * FROM data_10d
+ORDER BY cell_id, "date" DESC;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard
+    IS 'Fusion latest values from mgbstandard table and forecast values (+/- 10 days)';
+            
+-- Create materialized view for MVT, fusioning data from assimilated and forecast data
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_assimilated_aggregate_geo CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated_aggregate_geo 
+AS
+     WITH data_agg AS (
+        SELECT cell_id, json_agg(
+            json_build_object(
+                'source', source, 
+                'date', "date", 
+                'flow', flow, 
+                'flow_anomaly', flow_anomaly
+            ) ORDER BY "date" DESC) AS "values" 
+        FROM guyane.hyfaa_forecast_with_assimilated 
+        GROUP BY cell_id
+        ORDER BY cell_id
+    )
+    SELECT d.cell_id, d."values", geo.ordem, 
+        round(geo.width::numeric) AS width,
+        round(geo.depth::numeric, 2) AS depth,
+        st_transform(geo.geom, 4326)::geometry(Geometry,4326) AS geom
+    FROM data_agg d,
+        guyane.drainage_mgb_masked geo
+      WHERE geo.mini = d.cell_id
+      ORDER BY d.cell_id;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the values fusioned from latest values in assimilated table and forecast values (+/- 10 days, stored in a json object)';
+
+            
+-- Create materialized view for MVT, fusioning data from mgbstandard and forecast data
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo 
+AS
+     WITH data_agg AS (
+        SELECT cell_id, json_agg(
+            json_build_object(
+                'source', source, 
+                'date', "date", 
+                'flow', flow, 
+                'flow_anomaly', flow_anomaly
+            ) ORDER BY "date" DESC) AS "values" 
+        FROM guyane.hyfaa_forecast_with_mgbstandard
+        GROUP BY cell_id
+        ORDER BY cell_id
+    )
+    SELECT d.cell_id, d."values", geo.ordem, 
+        round(geo.width::numeric) AS width,
+        round(geo.depth::numeric, 2) AS depth,
+        st_transform(geo.geom, 4326)::geometry(Geometry,4326) AS geom
+    FROM data_agg d,
+        guyane.drainage_mgb_masked geo
+      WHERE geo.mini = d.cell_id
+      ORDER BY d.cell_id;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the values fusioned from latest values in mgbstandard table and forecast values (+/- 10 days, stored in a json object)';
+            
+
+GRANT SELECT ON TABLE guyane.hyfaa_forecast_with_assimilated_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.hyfaa_data_with_assimilated_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.hyfaa_data_with_mgbstandard_aggregate_geo TO tileserv;
+            """),
+        migrations.RunSQL(
+            """
+-- dedicated function to the forecast context. Handles a possible change of data table from the saguiconfig table
+-- (does not recompute existing values upon change, but will switch seamlessly. And after 10 days, the transition will
+-- be complete)
+-- Deprecated forecast data is now removed by dropping the old (monthly) partitions. Only the remainder is DELETEd
+CREATE OR REPLACE FUNCTION guyane.update_forecast(
+                                                    _nbdays int default 10,
+                                                    lower_date date default '1950-01-01'
+                                                  )
+RETURNS integer
+AS
+$$
+DECLARE
+	counter integer;
+	dest_tbl_name regclass;
+	src_tbl_name regclass;
+	flow_field_name TEXT;
+	max_src_date date;
+BEGIN
+	dest_tbl_name = 'guyane.hyfaa_data_forecast'::regclass;
+
+	-- get the name of the dataset to use to match the thresholds. Can be default (assimilated) or defined in the saguiconfig table
+	SELECT ('guyane.hyfaa_data_' || COALESCE((SELECT use_dataset FROM guyane.sagui_saguiconfig LIMIT 1), 'assimilated'))::regclass AS use_dataset
+	INTO src_tbl_name;
+
+	IF src_tbl_name::TEXT = 'guyane.hyfaa_data_assimilated'
+	THEN flow_field_name:='flow_median';
+	ELSE flow_field_name:='flow_mean'; --means we use mgbstandard dataset
+	END IF;
+
+	EXECUTE 'SELECT guyane.compute_expected_and_anomaly($1, $2, $3, $4, $5)'
+	INTO counter
+	USING dest_tbl_name, src_tbl_name, flow_field_name, _nbdays, lower_date;
+
+	-- Remove deprecated data (older that most recent data from assimilated or mgbstandard tables)
+	EXECUTE format('SELECT MAX("date") FROM %s', src_tbl_name) INTO max_src_date;
+	IF max_src_date IS NOT NULL THEN
+		PERFORM guyane.drop_partitions_before(dest_tbl_name, max_src_date);
+		EXECUTE format('DELETE FROM %s WHERE "date" < $1', dest_tbl_name) USING max_src_date;
+	END IF;
+
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.update_forecast(_nbdays int, lower_date date)
+    IS 'Computes and inserts values for the flow_expected and flow_anomaly columns,
+	using the data from the table configured in saguiconfig (default is assimilated table, but can also be mgbstandard).
+	It also cleans old forecast data (in past time) that won''t be used anymore, dropping the old partitions';
+            """),
+    ]
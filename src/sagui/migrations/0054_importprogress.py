@@ -0,0 +1,30 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0053_partition_hyfaa_data_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportProgress',
+            fields=[
+                ('tablename', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_committed_index', models.IntegerField(blank=True, help_text='Index (in the netcdf file) of the last time value committed into the DB during the current import', null=True, verbose_name='Last committed time index')),
+                ('last_committed_jd', models.FloatField(blank=True, help_text='Last time value committed into the DB during the current import. In CNES Julian days (0 is 01/01/1950)', null=True, verbose_name='Last committed time in Julian days')),
+                ('pages_committed', models.IntegerField(default=0, help_text='Nb of pages committed during the current import', verbose_name='Pages committed')),
+                ('update_errors', models.SmallIntegerField(default=0, help_text='Nb of errors during the current import (reset once the failed pages are committed, on resume)', verbose_name='Update errors')),
+                ('finished', models.BooleanField(default=False, help_text='Whether the import completed (and the import state was updated)', verbose_name='Finished')),
+                ('started_at', models.DateTimeField(blank=True, help_text='Start time of the current import', null=True, verbose_name='Started at')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Time of the last checkpoint', verbose_name='Updated at')),
+            ],
+            options={
+                'verbose_name': 'Checkpoints of the current (or last) HYFAA import, per table',
+                'ordering': ['tablename'],
+            },
+        ),
+    ]
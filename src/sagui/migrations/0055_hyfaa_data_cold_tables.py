@@ -0,0 +1,36 @@
+# Generated by Django 4.0.5 on 2026-10-18 11:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0054_importprogress'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+-- Cold storage for the cells filtered out by the ordem filter (hyfaa_import --filter_ordem --cold_storage)
+-- Same columns as the main tables, minus the id and the computed (expected/anomaly) columns. Only the unique constraint
+-- used by the upsert is indexed, and no view depends on them
+CREATE TABLE IF NOT EXISTS guyane.hyfaa_data_mgbstandard_cold (LIKE guyane.hyfaa_data_mgbstandard);
+ALTER TABLE guyane.hyfaa_data_mgbstandard_cold
+    DROP COLUMN IF EXISTS id,
+    DROP COLUMN IF EXISTS flow_expected,
+    DROP COLUMN IF EXISTS flow_anomaly,
+    ADD CONSTRAINT hyfaa_data_mgbstandard_cold_unique_cellid_day UNIQUE (cell_id, "date");
+COMMENT ON TABLE guyane.hyfaa_data_mgbstandard_cold
+    IS 'MGB standard data for the cells filtered out by the ordem filter. Not used by the views';
+
+CREATE TABLE IF NOT EXISTS guyane.hyfaa_data_assimilated_cold (LIKE guyane.hyfaa_data_assimilated);
+ALTER TABLE guyane.hyfaa_data_assimilated_cold
+    DROP COLUMN IF EXISTS id,
+    DROP COLUMN IF EXISTS flow_expected,
+    DROP COLUMN IF EXISTS flow_anomaly,
+    ADD CONSTRAINT hyfaa_data_assimilated_cold_unique_cellid_day UNIQUE (cell_id, "date");
+COMMENT ON TABLE guyane.hyfaa_data_assimilated_cold
+    IS 'Assimilated data for the cells filtered out by the ordem filter. Not used by the views';
+            """),
+    ]
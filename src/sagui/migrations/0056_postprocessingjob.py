@@ -0,0 +1,104 @@
+# Generated by Django 4.0.5 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0055_hyfaa_data_cold_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostProcessingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tablename', models.CharField(help_text='Table whose import triggered the post-processing (cf sagui_importstate)', max_length=50)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.SmallIntegerField(default=0, help_text='Nb of times the job was run', verbose_name='Attempts')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('run_after', models.DateTimeField(blank=True, help_text='If set, the job will not be run before this time (retry delay)', null=True, verbose_name='Run after')),
+                ('started_at', models.DateTimeField(blank=True, help_text='Start time of the last attempt', null=True, verbose_name='Started at')),
+                ('finished_at', models.DateTimeField(blank=True, help_text='End time of the last attempt', null=True, verbose_name='Finished at')),
+                ('duration', models.FloatField(blank=True, help_text='Duration of the last attempt, in seconds', null=True, verbose_name='Duration')),
+                ('worker_pid', models.IntegerField(blank=True, help_text='DB backend PID of the worker running the job (used to detect the jobs of crashed workers)', null=True, verbose_name='Worker PID')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last error')),
+            ],
+            options={
+                'verbose_name': 'Post-processing job (expected values, anomaly, views refresh), run by the sagui_worker command',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='postprocessingjob',
+            index=models.Index(fields=['status', 'id'], name='postprocessingjob_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='postprocessingjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'pending')), fields=('tablename',), name='postprocessingjob_unique_pending_table'),
+        ),
+        migrations.RunSQL(
+            """
+-- Post-processing of a table, once its data has been imported. Formerly run by the trigger on importstate table,
+-- now run by the sagui_worker command (job queue: sagui_postprocessingjob table)
+CREATE OR REPLACE FUNCTION guyane.run_post_processing(_tablename text)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+    -- mgbstandard data
+    IF _tablename LIKE '%data_mgbstandard' THEN
+        RAISE INFO 'Post-processing mgbstandard table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_mgbstandard', 'flow_mean', 10);
+        REFRESH  MATERIALIZED VIEW guyane.hyfaa_data_with_mgbstandard_aggregate_geo;
+    END IF;
+
+    -- assimilated data
+    IF _tablename LIKE '%data_assimilated' THEN
+        RAISE INFO 'Post-processing assimilated table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_assimilated', 'flow_median', 10);
+        REFRESH  MATERIALIZED VIEW guyane.hyfaa_data_with_assimilated_aggregate_geo;
+    END IF;
+
+    -- forecast data
+    IF _tablename LIKE '%data_forecast' THEN
+        RAISE INFO 'Post-processing forecast table. Please wait...';
+        PERFORM guyane.update_forecast(10);
+        REFRESH  MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated;
+        REFRESH  MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard;
+        REFRESH  MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated_aggregate_geo;
+        REFRESH  MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo;
+    END IF;
+
+    -- rainfall data
+    IF _tablename LIKE '%_rainfall' THEN
+        RAISE INFO 'Post-processing rainfall table. Please wait...';
+        REFRESH  MATERIALIZED VIEW guyane.rainfall_subbasin_aggregated_geo;
+        REFRESH  MATERIALIZED VIEW guyane.rainfall_minibasin_aggregated_geo;
+    END IF;
+END $$;
+COMMENT ON FUNCTION guyane.run_post_processing(_tablename text)
+    IS 'Post-processing of a table, once its data has been imported: computes the expected and anomaly values and
+    refreshes the materialized views depending on it. Run by the sagui_worker command';
+
+
+-- Update trigger on importstate table
+--
+-- The post-processing is no more run synchronously in the importer's transaction: the trigger only queues a job
+-- (deduplicated: at most one pending job per table) and notifies the workers
+CREATE OR REPLACE FUNCTION guyane.publication_post_processing()
+    RETURNS TRIGGER LANGUAGE plpgsql
+    SECURITY DEFINER
+    AS $$
+    BEGIN
+        INSERT INTO guyane.sagui_postprocessingjob (tablename, status, attempts, created_at, last_error)
+            VALUES (NEW."tablename", 'pending', 0, now(), '')
+            ON CONFLICT (tablename) WHERE status = 'pending' DO NOTHING;
+        PERFORM pg_notify('sagui_post_processing', NEW."tablename");
+        RAISE INFO 'Post-processing of table % queued (run by the sagui_worker command)', NEW."tablename";
+        RETURN null;
+    END $$;
+            """),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.0.5 on 2026-10-18 15:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0056_postprocessingjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilesManifestFolder',
+            fields=[
+                ('path', models.CharField(max_length=500, primary_key=True, serialize=False)),
+                ('kind', models.CharField(help_text='Kind of files stored in the folder (rainfall, atmo)', max_length=20)),
+                ('mtime_watermark', models.FloatField(blank=True, help_text='Modification time (seconds since epoch) of the folder when it was last scanned. The folder is not scanned again as long as its modification time is unchanged', null=True, verbose_name='Folder mtime watermark')),
+                ('last_scan', models.DateTimeField(blank=True, null=True, verbose_name='Last scan')),
+            ],
+            options={
+                'verbose_name': 'Folder whose files are listed in the files manifest',
+                'ordering': ['path'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FilesManifest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='File name', max_length=255)),
+                ('file_date', models.DateTimeField(blank=True, help_text='Date of the data, parsed from the file name', null=True, verbose_name='File date')),
+                ('version', models.CharField(blank=True, default='', help_text='Version stamp parsed from the file name (e.g. download date of the rainfall files), if any', max_length=20, verbose_name='Version stamp')),
+                ('size', models.BigIntegerField(help_text='File size, in bytes', verbose_name='Size')),
+                ('mtime', models.FloatField(help_text='File modification time (seconds since epoch)', verbose_name='Modification time')),
+                ('import_status', models.CharField(choices=[('new', 'New'), ('imported', 'Imported')], default='new', max_length=10)),
+                ('imported_at', models.DateTimeField(blank=True, null=True, verbose_name='Imported at')),
+                ('folder', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='sagui.filesmanifestfolder')),
+            ],
+            options={
+                'verbose_name': 'Manifest of the input files (rainfall netcdf files, atmo images), maintained incrementally',
+                'ordering': ['folder', 'name'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='filesmanifest',
+            index=models.Index(fields=['folder', 'version'], name='filesmanifest_version_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='filesmanifest',
+            index=models.Index(fields=['folder', 'file_date'], name='filesmanifest_file_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='filesmanifest',
+            constraint=models.UniqueConstraint(fields=('folder', 'name'), name='filesmanifest_unique_folder_name'),
+        ),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 4.0.5 on 2026-10-18 15:45
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0057_filesmanifest'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+        """
+-- The former, per-date, implementation is kept under another name, for benchmarking purpose
+-- (cf `manage.py benchmark anomaly`)
+ALTER FUNCTION guyane.compute_expected_and_anomaly(regclass, regclass, text, int, date)
+    RENAME TO compute_expected_and_anomaly_legacy;
+COMMENT ON FUNCTION guyane.compute_expected_and_anomaly_legacy(_dest_tbl regclass, _src_tbl regclass, _columnname text, _nbdays int, lower_date date)
+    IS 'Former implementation of compute_expected_and_anomaly (one UPDATE per date, each one listing the distinct dates
+    of the mgbstandard table). Kept for benchmarking purpose';
+
+
+-- Computes and inserts values for the flow_expected and flow_anomaly columns in _dest_tbl, using the data from _src_tbl
+-- Set-based version: the pending dates are processed by batches of _batch_size dates, each batch with a single UPDATE
+-- statement. For each pending date, the reference dates (previous years, day of year less than _nbdays far from the
+-- pending date's day of year) are obtained with a day-of-year join, instead of calling
+-- surrounding_days_over_previous_years (which lists the distinct dates of the whole table) for each date.
+-- Same results as the former version: the reference dates are taken from the mgbstandard table, and the expected
+-- value is the floating median (median aggregate)
+-- RETURNS the number of updated dates
+CREATE OR REPLACE FUNCTION guyane.compute_expected_and_anomaly(
+                                                    _dest_tbl regclass,
+                                                    _src_tbl regclass,
+                                                    _columnname text,
+                                                    _nbdays int default 10,
+                                                    lower_date date default '1950-01-01',
+                                                    _batch_size int default 100
+                                                  )
+RETURNS integer
+AS
+$$
+DECLARE
+	pending_dates date[];
+	ref_dates date[];
+	batch date[];
+	i integer;
+BEGIN
+    -- list the dates at which we have some undefined values for 'expected' or 'anomaly' columns
+    EXECUTE format('SELECT array_agg(upt_date ORDER BY upt_date DESC) FROM (
+                        SELECT DISTINCT "date" AS upt_date
+                        FROM %s
+                        WHERE (flow_expected IS NULL OR flow_anomaly IS NULL)
+                        AND "date" > $1::date
+                    ) d', _dest_tbl)
+    INTO pending_dates
+    USING lower_date;
+    IF pending_dates IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    -- candidate reference dates, listed only once
+    SELECT array_agg(DISTINCT "date") INTO ref_dates FROM guyane.hyfaa_data_mgbstandard;
+
+    FOR i IN 1..array_length(pending_dates, 1) BY _batch_size
+        LOOP
+            batch := pending_dates[i:i + _batch_size - 1];
+            -- 'pairs': (pending date, reference date) couples, from the day-of-year join. 'subq': median value of the
+            -- given field (flow_mean or flow_median, supposedly), per pending date and cell
+            EXECUTE format('UPDATE %1$s AS t
+                    SET flow_expected = subq.median,
+                        flow_anomaly = guyane.compute_anomaly(t.%2$I, subq.median)
+                    FROM (SELECT pairs.upt_date, d.cell_id, median(d.%2$I)
+                        FROM (SELECT DISTINCT p.upt_date, r.s_date
+                            FROM unnest($1::date[]) AS p(upt_date)
+                            CROSS JOIN generate_series(-$2, $2) AS k(offset_days)
+                            JOIN unnest($3::date[]) AS r(s_date)
+                                ON date_part(''doy'', r.s_date) = date_part(''doy'', p.upt_date + k.offset_days)
+                                AND r.s_date < p.upt_date - $2
+                            ) AS pairs
+                        JOIN %3$s AS d ON d."date" = pairs.s_date
+                        GROUP BY pairs.upt_date, d.cell_id) AS subq
+                    WHERE t."date" = subq.upt_date
+                        AND t.cell_id = subq.cell_id', _dest_tbl, _columnname, _src_tbl)
+            USING batch, _nbdays, ref_dates;
+            RAISE INFO '[%] Computed flow_expected and flow_anomaly for dates % to %', _dest_tbl, batch[array_length(batch, 1)], batch[1];
+        END LOOP;
+    RETURN array_length(pending_dates, 1);
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.compute_expected_and_anomaly(_dest_tbl regclass, _src_tbl regclass, _columnname text, _nbdays int, lower_date date, _batch_size int)
+    IS 'Computes and inserts values for the flow_expected and flow_anomaly columns in _dest_tbl.
+    flow_expected is calculated using the floating median from _src_tbl
+    flow_anomaly is calculated using the compute_anomaly function, and uses the ''expected'' value
+	_dest_tbl and _src_tbl are usually the same, but can be different (e.g. compute values for forecast data using historical data from assimilated data)
+	The pending dates are processed by batches of _batch_size dates, one UPDATE statement per batch
+    RETURNS the number of updated dates';
+        """),
+    ]
@@ -0,0 +1,176 @@
+# Generated by Django 4.0.5 on 2026-10-18 16:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0058_set_based_compute_expected_and_anomaly'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+        """
+-- Cache of the expected values (floating median over the previous years, see compute_expected_and_anomaly)
+-- The expected value of a cell at a given date only depends on the previous years' data, which does not change: it is
+-- computed once, then retrieved by an indexed join. One row per source table, source column, window size, cell and
+-- date (year, day of year) of the values it applies to.
+-- An entry is 'complete' when the source data needed to compute it was fully available when it was computed (i.e. no
+-- date of the window is missing between the last imported date and the entry's date). Incomplete entries (e.g.
+-- computed for the forecast dates) are recomputed on the next run
+CREATE TABLE IF NOT EXISTS guyane.flow_climatology (
+    source_table text NOT NULL,
+    column_name text NOT NULL,
+    nb_days smallint NOT NULL,
+    "year" smallint NOT NULL,
+    day_of_year smallint NOT NULL,
+    cell_id integer NOT NULL,
+    flow_expected double precision,
+    nb_values integer NOT NULL,
+    complete boolean NOT NULL,
+    computed_at timestamp with time zone NOT NULL DEFAULT now(),
+    CONSTRAINT flow_climatology_pkey PRIMARY KEY (source_table, column_name, nb_days, "year", day_of_year, cell_id)
+);
+COMMENT ON TABLE guyane.flow_climatology
+    IS 'Cache of the expected values (floating median of the values over the previous years, +/- nb_days around the day
+    of year), per source table and column, cell and date (year, day of year). Maintained by compute_expected_and_anomaly';
+
+
+-- Invalidate the cached expected values computed from a table (e.g. when its data is fully reloaded). The reference
+-- dates being taken from the mgbstandard table, invalidating mgbstandard invalidates everything
+CREATE OR REPLACE FUNCTION guyane.reset_flow_climatology(_src_tbl regclass)
+RETURNS integer
+AS
+$$
+DECLARE
+	counter integer;
+BEGIN
+    IF _src_tbl = 'guyane.hyfaa_data_mgbstandard'::regclass THEN
+        DELETE FROM guyane.flow_climatology;
+    ELSE
+        DELETE FROM guyane.flow_climatology WHERE source_table = _src_tbl::text;
+    END IF;
+    GET DIAGNOSTICS counter = ROW_COUNT;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.reset_flow_climatology(_src_tbl regclass)
+    IS 'Invalidate the cached expected values computed from a table (flow_climatology table). RETURNS the number of deleted entries';
+
+
+-- Computes and inserts values for the flow_expected and flow_anomaly columns in _dest_tbl, using the data from _src_tbl
+-- The expected values are taken from the flow_climatology cache. The missing (or incomplete) cache entries for the
+-- pending dates are computed first, by batches of _batch_size dates (set-based, see migration 0058)
+-- RETURNS the number of updated dates
+CREATE OR REPLACE FUNCTION guyane.compute_expected_and_anomaly(
+                                                    _dest_tbl regclass,
+                                                    _src_tbl regclass,
+                                                    _columnname text,
+                                                    _nbdays int default 10,
+                                                    lower_date date default '1950-01-01',
+                                                    _batch_size int default 100
+                                                  )
+RETURNS integer
+AS
+$$
+DECLARE
+	pending_dates date[];
+	missing_dates date[];
+	ref_dates date[];
+	complete_until date;
+	batch date[];
+	i integer;
+BEGIN
+    -- list the dates at which we have some undefined values for 'expected' or 'anomaly' columns
+    EXECUTE format('SELECT array_agg(upt_date ORDER BY upt_date DESC) FROM (
+                        SELECT DISTINCT "date" AS upt_date
+                        FROM %s
+                        WHERE (flow_expected IS NULL OR flow_anomaly IS NULL)
+                        AND "date" > $1::date
+                    ) d', _dest_tbl)
+    INTO pending_dates
+    USING lower_date;
+    IF pending_dates IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    -- pending dates with no complete entry in the cache
+    SELECT array_agg(p.upt_date ORDER BY p.upt_date DESC) INTO missing_dates
+    FROM unnest(pending_dates) AS p(upt_date)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM guyane.flow_climatology c
+        WHERE c.source_table = _src_tbl::text AND c.column_name = _columnname AND c.nb_days = _nbdays
+            AND c."year" = date_part('year', p.upt_date)::smallint AND c.day_of_year = date_part('doy', p.upt_date)::smallint
+            AND c.complete
+    );
+
+    IF missing_dates IS NOT NULL THEN
+        -- candidate reference dates, listed only once
+        SELECT array_agg(DISTINCT "date"), MAX("date") INTO ref_dates, complete_until FROM guyane.hyfaa_data_mgbstandard;
+        EXECUTE format('SELECT LEAST(MAX("date"), $1) FROM %s', _src_tbl)
+        INTO complete_until
+        USING complete_until;
+
+        FOR i IN 1..array_length(missing_dates, 1) BY _batch_size
+            LOOP
+                batch := missing_dates[i:i + _batch_size - 1];
+                -- 'dates': the entry of a date is complete if no date of its window is missing between the last
+                -- imported date and the date. 'pairs': (date, reference date) couples, from the day-of-year join
+                EXECUTE format('INSERT INTO guyane.flow_climatology AS c
+                        (source_table, column_name, nb_days, "year", day_of_year, cell_id, flow_expected, nb_values,
+                         complete, computed_at)
+                    SELECT $4, $5, $2, date_part(''year'', pairs.upt_date), date_part(''doy'', pairs.upt_date),
+                        d.cell_id, median(d.%2$I), count(d.%2$I), bool_and(pairs.complete), now()
+                    FROM (SELECT DISTINCT dates.upt_date, dates.complete, r.s_date
+                        FROM (SELECT p.upt_date, NOT EXISTS (
+                                SELECT 1 FROM generate_series($6 + 1, p.upt_date - $2 - 1, ''1 day''::interval) AS g(day)
+                                WHERE date_part(''doy'', g.day) IN (
+                                    SELECT date_part(''doy'', p.upt_date + w) FROM generate_series(-$2, $2) AS w)
+                            ) AS complete
+                            FROM unnest($1::date[]) AS p(upt_date)) AS dates
+                        CROSS JOIN generate_series(-$2, $2) AS k(offset_days)
+                        JOIN unnest($3::date[]) AS r(s_date)
+                            ON date_part(''doy'', r.s_date) = date_part(''doy'', dates.upt_date + k.offset_days)
+                            AND r.s_date < dates.upt_date - $2
+                        ) AS pairs
+                    JOIN %1$s AS d ON d."date" = pairs.s_date
+                    GROUP BY pairs.upt_date, d.cell_id
+                    ON CONFLICT (source_table, column_name, nb_days, "year", day_of_year, cell_id) DO UPDATE SET
+                        flow_expected = EXCLUDED.flow_expected,
+                        nb_values = EXCLUDED.nb_values,
+                        complete = EXCLUDED.complete,
+                        computed_at = EXCLUDED.computed_at', _src_tbl, _columnname)
+                USING batch, _nbdays, ref_dates, _src_tbl::text, _columnname, complete_until;
+                RAISE INFO '[%] Computed the expected values for dates % to %', _src_tbl, batch[array_length(batch, 1)], batch[1];
+            END LOOP;
+    END IF;
+
+    -- Retrieve the expected values from the cache, and compute the anomaly
+    FOR i IN 1..array_length(pending_dates, 1) BY _batch_size
+        LOOP
+            batch := pending_dates[i:i + _batch_size - 1];
+            EXECUTE format('UPDATE %1$s AS t
+                    SET flow_expected = c.flow_expected,
+                        flow_anomaly = guyane.compute_anomaly(t.%2$I, c.flow_expected)
+                    FROM guyane.flow_climatology AS c
+                    WHERE t."date" = ANY($1::date[])
+                        AND c.source_table = $2 AND c.column_name = $3 AND c.nb_days = $4
+                        AND c."year" = date_part(''year'', t."date")::smallint
+                        AND c.day_of_year = date_part(''doy'', t."date")::smallint
+                        AND c.cell_id = t.cell_id', _dest_tbl, _columnname)
+            USING batch, _src_tbl::text, _columnname, _nbdays;
+            RAISE INFO '[%] Computed flow_expected and flow_anomaly for dates % to %', _dest_tbl, batch[array_length(batch, 1)], batch[1];
+        END LOOP;
+    RETURN array_length(pending_dates, 1);
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.compute_expected_and_anomaly(_dest_tbl regclass, _src_tbl regclass, _columnname text, _nbdays int, lower_date date, _batch_size int)
+    IS 'Computes and inserts values for the flow_expected and flow_anomaly columns in _dest_tbl.
+    flow_expected is calculated using the floating median from _src_tbl, cached in the flow_climatology table
+    flow_anomaly is calculated using the compute_anomaly function, and uses the ''expected'' value
+	_dest_tbl and _src_tbl are usually the same, but can be different (e.g. compute values for forecast data using historical data from assimilated data)
+	The pending dates are processed by batches of _batch_size dates
+    RETURNS the number of updated dates';
+        """),
+    ]
@@ -0,0 +1,411 @@
+# Generated by Django 4.0.5 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0059_flow_climatology'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetDate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tablename', models.CharField(help_text='Data table (cf sagui_importstate)', max_length=50)),
+                ('date', models.DateField(help_text='Date for which the table holds data', verbose_name='Date')),
+                ('first_imported', models.DateTimeField(help_text='Time the data for this date was first imported', verbose_name='First imported')),
+                ('last_updated', models.DateTimeField(help_text='Time the data for this date was last written', verbose_name='Last updated')),
+            ],
+            options={
+                'verbose_name': 'Catalog of the dates available in the data tables, maintained by the importers',
+                'db_table': 'dataset_dates',
+                'ordering': ['tablename', '-date'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='datasetdate',
+            constraint=models.UniqueConstraint(fields=('tablename', 'date'), name='datasetdate_unique_table_date'),
+        ),
+        migrations.RunSQL(
+            """
+-- Record dates written into a data table (called by the importers, in the transaction writing the data)
+-- RETURNS the number of dates
+CREATE OR REPLACE FUNCTION guyane.register_dataset_dates(_tablename text, _dates date[])
+RETURNS integer
+AS
+$$
+DECLARE
+	counter integer;
+BEGIN
+    INSERT INTO guyane.dataset_dates (tablename, "date", first_imported, last_updated)
+        SELECT DISTINCT _tablename, d, now(), now() FROM unnest(_dates) AS d WHERE d IS NOT NULL
+        ON CONFLICT (tablename, "date") DO UPDATE SET last_updated = EXCLUDED.last_updated;
+    GET DIAGNOSTICS counter = ROW_COUNT;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.register_dataset_dates(_tablename text, _dates date[])
+    IS 'Record dates written into a data table in the dataset_dates catalog. RETURNS the number of dates';
+
+
+-- Synchronize the catalog with the dates actually present in a data table, from _since on (whole table if NULL)
+-- The distinct dates are listed with a loose index scan (one index probe per date, using the date index), not by
+-- scanning the whole table
+-- RETURNS the number of dates added to the catalog
+CREATE OR REPLACE FUNCTION guyane.refresh_dataset_dates(_tablename text, _since date default NULL)
+RETURNS integer
+AS
+$$
+DECLARE
+	tbl regclass;
+	counter integer;
+BEGIN
+    tbl := to_regclass('guyane.' || _tablename);
+    IF tbl IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    EXECUTE format('DELETE FROM guyane.dataset_dates AS c
+                    WHERE c.tablename = $1 AND ($2::date IS NULL OR c."date" >= $2)
+                    AND NOT EXISTS (SELECT 1 FROM %s AS d WHERE d."date" = c."date")', tbl)
+    USING _tablename, _since;
+
+    EXECUTE format('WITH RECURSIVE dates AS (
+                        SELECT MIN("date") AS d FROM %1$s WHERE $2::date IS NULL OR "date" >= $2
+                        UNION ALL
+                        SELECT (SELECT MIN("date") FROM %1$s WHERE "date" > dates.d) FROM dates WHERE dates.d IS NOT NULL
+                    )
+                    INSERT INTO guyane.dataset_dates (tablename, "date", first_imported, last_updated)
+                        SELECT $1, d, now(), now() FROM dates WHERE d IS NOT NULL
+                        ON CONFLICT (tablename, "date") DO NOTHING', tbl)
+    USING _tablename, _since;
+    GET DIAGNOSTICS counter = ROW_COUNT;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.refresh_dataset_dates(_tablename text, _since date)
+    IS 'Synchronize the dataset_dates catalog with the dates present in a data table (guyane schema), from _since on
+    (whole table if NULL). RETURNS the number of dates added to the catalog';
+
+
+-- Initial content
+SELECT guyane.refresh_dataset_dates(tablename)
+FROM unnest(ARRAY['hyfaa_data_mgbstandard', 'hyfaa_data_assimilated', 'hyfaa_data_forecast', 'sagui_rainfall']) AS tablename;
+
+
+-- Update trigger on importstate table: the catalog is also synchronized with the table, from its latest known date
+-- on, in case some data was written without registering its dates
+CREATE OR REPLACE FUNCTION guyane.publication_post_processing()
+    RETURNS TRIGGER LANGUAGE plpgsql
+    SECURITY DEFINER
+    AS $$
+    BEGIN
+        PERFORM guyane.refresh_dataset_dates(NEW."tablename",
+            (SELECT MAX("date") FROM guyane.dataset_dates WHERE tablename = NEW."tablename"));
+        INSERT INTO guyane.sagui_postprocessingjob (tablename, status, attempts, created_at, last_error)
+            VALUES (NEW."tablename", 'pending', 0, now(), '')
+            ON CONFLICT (tablename) WHERE status = 'pending' DO NOTHING;
+        PERFORM pg_notify('sagui_post_processing', NEW."tablename");
+        RAISE INFO 'Post-processing of table % queued (run by the sagui_worker command)', NEW."tablename";
+        RETURN null;
+    END $$;
+            """),
+        migrations.RunSQL(
+            """
+-- The latest dates are read from the dataset_dates catalog, instead of scanning the data tables
+
+-----------------------------------------------------
+-- Aggregate the last 15d values in a json field
+-----------------------------------------------------
+
+-- on assimilated data
+CREATE OR REPLACE VIEW guyane.hyfaa_data_assimilated_aggregate_json
+ AS
+SELECT cell_id,
+       json_agg(
+          json_build_object(
+      		'date', date,
+      		'flow', ROUND(flow_median),
+      		'flow_anomaly', ROUND(flow_anomaly)
+      		)
+	        ORDER BY "date" DESC
+        ) AS values
+FROM guyane.hyfaa_data_assimilated
+WHERE "date" IN (SELECT "date" FROM guyane.dataset_dates WHERE tablename = 'hyfaa_data_assimilated'
+						ORDER BY "date" DESC LIMIT 15)
+GROUP BY cell_id
+ORDER BY cell_id;
+
+-- on mgbstandard data
+CREATE OR REPLACE VIEW guyane.hyfaa_data_mgbstandard_aggregate_json
+ AS
+SELECT cell_id,
+       json_agg(
+          json_build_object(
+      		'date', date,
+      		'flow', ROUND(flow_mean),
+      		'flow_anomaly', ROUND(flow_anomaly)
+      		)
+	        ORDER BY "date" DESC
+        ) AS values
+FROM guyane.hyfaa_data_mgbstandard
+WHERE "date" IN (SELECT "date" FROM guyane.dataset_dates WHERE tablename = 'hyfaa_data_mgbstandard'
+						ORDER BY "date" DESC LIMIT 15)
+GROUP BY cell_id
+ORDER BY cell_id;
+            """),
+        migrations.RunSQL(
+            """
+-----------------------------------------------------
+-- Rainfall data, aggregated over the last 15 days
+-----------------------------------------------------
+DROP MATERIALIZED VIEW IF EXISTS guyane.rainfall_subbasin_aggregated_geo;
+CREATE MATERIALIZED VIEW guyane.rainfall_subbasin_aggregated_geo AS
+    WITH latest_dates AS (
+        SELECT "date" FROM guyane.dataset_dates WHERE tablename = 'sagui_rainfall' ORDER BY "date" DESC LIMIT 15
+    ),
+    rainfall_data AS (
+        SELECT * FROM guyane.sagui_rainfall
+        WHERE "date" in (SELECT * FROM latest_dates)
+    ),
+    rainfall_catchments AS (
+        SELECT c.mini, r."date", r.rain, c.sub
+        FROM rainfall_data r JOIN guyane.hyfaa_catchments c
+        ON r.cell_id = c.mini
+    ),
+    rainfall_by_sub AS (
+        SELECT sub AS id, "date", AVG(rain) AS rain
+        FROM rainfall_catchments
+        GROUP BY sub, "date"
+    ),
+    agg AS (
+        SELECT id, json_agg(json_build_object('date', "date", 'rain', round(rain)) ORDER BY "date" DESC) AS values
+        FROM rainfall_by_sub
+        GROUP BY id
+    )
+    SELECT 'sub_'||geo.id AS id, values, geom
+    FROM agg JOIN guyane.hyfaa_catchments_subbasins geo
+    ON geo.id = agg.id
+;
+COMMENT ON MATERIALIZED VIEW guyane.rainfall_subbasin_aggregated_geo IS
+'Aggregated rainfall data (json object) at subbasin geospatial level';
+
+DROP MATERIALIZED VIEW IF EXISTS guyane.rainfall_minibasin_aggregated_geo;
+CREATE MATERIALIZED VIEW guyane.rainfall_minibasin_aggregated_geo AS
+    WITH latest_dates AS (
+        SELECT "date" FROM guyane.dataset_dates WHERE tablename = 'sagui_rainfall' ORDER BY "date" DESC LIMIT 15
+    ),
+    rainfall_agg_data AS (
+        SELECT cell_id AS id, json_agg(json_build_object('date', "date", 'rain', round(rain)) ORDER BY "date" DESC) AS values FROM guyane.sagui_rainfall
+        WHERE "date" in (SELECT * FROM latest_dates)
+        GROUP BY cell_id
+    )
+    SELECT 'mini_'||agg.id AS id, values, geom
+    FROM rainfall_agg_data agg JOIN guyane.hyfaa_catchments geo
+    ON geo.mini = agg.id
+;
+COMMENT ON MATERIALIZED VIEW guyane.rainfall_minibasin_aggregated_geo IS
+'Aggregated rainfall data (json object) at minibasin geospatial level';
+
+GRANT SELECT ON TABLE guyane.rainfall_minibasin_aggregated_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.rainfall_subbasin_aggregated_geo TO tileserv;
+            """),
+        migrations.RunSQL(
+            """
+-----------------------------------------------------
+-- Forecast data, fusioned with the latest historical values
+-----------------------------------------------------
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_assimilated CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated
+AS
+WITH latest AS (
+    SELECT MAX("date") AS d FROM guyane.dataset_dates WHERE tablename = 'hyfaa_data_assimilated'
+),
+forecast_data AS (
+	SELECT 'forecast' AS source, cell_id, "date", ROUND(flow_median) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_forecast WHERE "date" > (SELECT d FROM latest)
+),
+data_10d AS (
+	SELECT 'assimilated' AS source, cell_id, "date", ROUND(flow_median) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_assimilated WHERE "date" > (SELECT d FROM latest)  - '10 days'::interval
+)
+SELECT * FROM forecast_data UNION SELECT * FROM data_10d
+ORDER BY cell_id, "date" DESC;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated
+    IS 'Fusion latest values from assimilated table and forecast values (+/- 10 days)';
+
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_mgbstandard CASCADE;
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard
+AS
+WITH latest AS (
+    SELECT MAX("date") AS d FROM guyane.dataset_dates WHERE tablename = 'hyfaa_data_mgbstandard'
+),
+forecast_data AS (
+	SELECT 'forecast' AS source, cell_id, "date", ROUND(flow_median) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_forecast WHERE "date" > (SELECT d FROM latest)
+),
+data_10d AS (
+	SELECT 'mgbstandard' AS source, cell_id, "date", ROUND(flow_mean) AS flow, ROUND(flow_expected) AS flow_expected, ROUND(flow_anomaly) AS flow_anomaly FROM guyane.hyfaa_data_mgbstandard WHERE "date" > (SELECT d FROM latest)  - '10 days'::interval
+)
+SELECT * FROM forecast_data UNION SELECT * FROM data_10d
+ORDER BY cell_id, "date" DESC;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard
+    IS 'Fusion latest values from mgbstandard table and forecast values (+/- 10 days)';
+
+-- Create materialized view for MVT, fusioning data from assimilated and forecast data
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated_aggregate_geo
+AS
+     WITH data_agg AS (
+        SELECT cell_id, json_agg(
+            json_build_object(
+                'source', source,
+                'date', "date",
+                'flow', flow,
+                'flow_anomaly', flow_anomaly
+            ) ORDER BY "date" DESC) AS "values"
+        FROM guyane.hyfaa_forecast_with_assimilated
+        GROUP BY cell_id
+        ORDER BY cell_id
+    )
+    SELECT d.cell_id, d."values", geo.ordem,
+        round(geo.width::numeric) AS width,
+        round(geo.depth::numeric, 2) AS depth,
+        st_transform(geo.geom, 4326)::geometry(Geometry,4326) AS geom
+    FROM data_agg d,
+        guyane.drainage_mgb_masked geo
+      WHERE geo.mini = d.cell_id
+      ORDER BY d.cell_id;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_assimilated_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the values fusioned from latest values in assimilated table and forecast values (+/- 10 days, stored in a json object)';
+
+-- Create materialized view for MVT, fusioning data from mgbstandard and forecast data
+CREATE MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo
+AS
+     WITH data_agg AS (
+        SELECT cell_id, json_agg(
+            json_build_object(
+                'source', source,
+                'date', "date",
+                'flow', flow,
+                'flow_anomaly', flow_anomaly
+            ) ORDER BY "date" DESC) AS "values"
+        FROM guyane.hyfaa_forecast_with_mgbstandard
+        GROUP BY cell_id
+        ORDER BY cell_id
+    )
+    SELECT d.cell_id, d."values", geo.ordem,
+        round(geo.width::numeric) AS width,
+        round(geo.depth::numeric, 2) AS depth,
+        st_transform(geo.geom, 4326)::geometry(Geometry,4326) AS geom
+    FROM data_agg d,
+        guyane.drainage_mgb_masked geo
+      WHERE geo.mini = d.cell_id
+      ORDER BY d.cell_id;
+COMMENT ON MATERIALIZED VIEW guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the values fusioned from latest values in mgbstandard table and forecast values (+/- 10 days, stored in a json object)';
+
+GRANT SELECT ON TABLE guyane.hyfaa_forecast_with_assimilated_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo TO tileserv;
+            """),
+        migrations.RunSQL(
+        """
+-- append alert status on the stations data
+-- The latest date is read from the dataset_dates catalog
+CREATE OR REPLACE FUNCTION guyane.func_stations_with_flow_alerts()
+RETURNS TABLE(id bigint,
+			  name varchar(50),
+			 river varchar(50),
+			 minibasin smallint,
+		     levels jsonb,
+			 geom geometry(Point,4326))
+AS $$
+DECLARE
+	dataset_tbl_name TEXT;
+	query1 TEXT;
+	match_field TEXT;
+BEGIN
+	-- get the name of the dataset to use to match the thresholds. Can be default (assimilated) or defined in the saguiconfig table
+	SELECT 'guyane.hyfaa_data_' || COALESCE((SELECT use_dataset FROM guyane.sagui_saguiconfig LIMIT 1), 'assimilated') AS use_dataset
+	INTO dataset_tbl_name;
+	--RAISE INFO 'dataset_tbl_name %', dataset_tbl_name;
+
+	IF dataset_tbl_name = 'guyane.hyfaa_data_assimilated'
+	THEN match_field:='flow_median';
+	ELSE match_field:='flow_mean'; --means we use mgbstandard dataset
+	END IF;
+    --RAISE INFO 'match_field %', match_field;
+
+	query1 := 'WITH stations AS (SELECT s.id, s.name, s.river, s.minibasin_id, s.geom, d."date",
+				CASE
+				  WHEN d.%1$s < s.threshold_drought THEN ''d2''
+				  WHEN s.threshold_drought <= d.%1$s AND d.%1$s < s.threshold_flood_low THEN ''n''
+				  WHEN s.threshold_flood_low <= d.%1$s AND d.%1$s < s.threshold_flood_mid THEN ''f1''
+				  WHEN s.threshold_flood_mid <= d.%1$s AND d.%1$s < s.threshold_flood_high THEN ''f2''
+				  WHEN d.%1$s >= s.threshold_flood_high THEN ''f3''
+				  ELSE ''undefined''
+				END AS level
+				FROM guyane.hyfaa_stations s INNER JOIN %2$s d
+				ON s.minibasin_id = d.cell_id
+				WHERE d."date" > (SELECT MAX("date") FROM guyane.dataset_dates WHERE tablename = ''hyfaa_data_mgbstandard'') - ''15 days''::interval
+				ORDER BY s.name, d."date" DESC)
+			SELECT id, name, river, minibasin_id, jsonb_agg(jsonb_build_object(
+			    ''date'',"date",
+			    ''level'',level
+			) ORDER BY "date" DESC ) AS levels, geom
+			FROM stations
+			GROUP BY id, name, river, minibasin_id, geom';
+	RETURN QUERY EXECUTE format(query1, match_field, dataset_tbl_name);
+END
+$$ LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.func_stations_with_flow_alerts() IS
+'Append alert levels on stations data';
+        """),
+        migrations.RunSQL(
+            """
+-- The purged forecast dates are removed from the dataset_dates catalog
+CREATE OR REPLACE FUNCTION guyane.update_forecast(
+                                                    _nbdays int default 10,
+                                                    lower_date date default '1950-01-01'
+                                                  )
+RETURNS integer
+AS
+$$
+DECLARE
+	counter integer;
+	dest_tbl_name regclass;
+	src_tbl_name regclass;
+	flow_field_name TEXT;
+	max_src_date date;
+BEGIN
+	dest_tbl_name = 'guyane.hyfaa_data_forecast'::regclass;
+
+	-- get the name of the dataset to use to match the thresholds. Can be default (assimilated) or defined in the saguiconfig table
+	SELECT ('guyane.hyfaa_data_' || COALESCE((SELECT use_dataset FROM guyane.sagui_saguiconfig LIMIT 1), 'assimilated'))::regclass AS use_dataset
+	INTO src_tbl_name;
+
+	IF src_tbl_name::TEXT = 'guyane.hyfaa_data_assimilated'
+	THEN flow_field_name:='flow_median';
+	ELSE flow_field_name:='flow_mean'; --means we use mgbstandard dataset
+	END IF;
+
+	EXECUTE 'SELECT guyane.compute_expected_and_anomaly($1, $2, $3, $4, $5)'
+	INTO counter
+	USING dest_tbl_name, src_tbl_name, flow_field_name, _nbdays, lower_date;
+
+	-- Remove deprecated data (older that most recent data from assimilated or mgbstandard tables)
+	EXECUTE format('SELECT MAX("date") FROM %s', src_tbl_name) INTO max_src_date;
+	IF max_src_date IS NOT NULL THEN
+		PERFORM guyane.drop_partitions_before(dest_tbl_name, max_src_date);
+		EXECUTE format('DELETE FROM %s WHERE "date" < $1', dest_tbl_name) USING max_src_date;
+		DELETE FROM guyane.dataset_dates WHERE tablename = 'hyfaa_data_forecast' AND "date" < max_src_date;
+	END IF;
+
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.update_forecast(_nbdays int, lower_date date)
+    IS 'Computes and inserts values for the flow_expected and flow_anomaly columns,
+	using the data from the table configured in saguiconfig (default is assimilated table, but can also be mgbstandard).
+	It also cleans old forecast data (in past time) that won''t be used anymore, dropping the old partitions';
+            """),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.0.5 on 2026-10-18 17:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0060_datasetdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatviewRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(help_text='Materialized view (schema-qualified)', max_length=130)),
+                ('status', models.CharField(choices=[('done', 'Done'), ('failed', 'Failed'), ('skipped', 'Skipped')], max_length=10)),
+                ('started_at', models.DateTimeField(verbose_name='Started at')),
+                ('duration', models.FloatField(blank=True, help_text='Duration of the refresh, in seconds', null=True, verbose_name='Duration')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Error')),
+                ('job', models.ForeignKey(blank=True, help_text='Post-processing job the refresh was run for', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='refreshes', to='sagui.postprocessingjob')),
+            ],
+            options={
+                'verbose_name': 'Materialized view refresh, run by the refresh scheduler (sagui.utils.refresh)',
+                'ordering': ['-started_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='matviewrefresh',
+            index=models.Index(fields=['view', '-started_at'], name='matviewrefresh_view_idx'),
+        ),
+        migrations.RunSQL(
+            """
+-- The materialized views are no more refreshed here: the sagui_worker command refreshes the views depending on the
+-- table once the post-processing is done, using the refresh scheduler (sagui.utils.refresh)
+CREATE OR REPLACE FUNCTION guyane.run_post_processing(_tablename text)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+    -- mgbstandard data
+    IF _tablename LIKE '%data_mgbstandard' THEN
+        RAISE INFO 'Post-processing mgbstandard table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_mgbstandard', 'flow_mean', 10);
+    END IF;
+
+    -- assimilated data
+    IF _tablename LIKE '%data_assimilated' THEN
+        RAISE INFO 'Post-processing assimilated table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_assimilated', 'flow_median', 10);
+    END IF;
+
+    -- forecast data
+    IF _tablename LIKE '%data_forecast' THEN
+        RAISE INFO 'Post-processing forecast table. Please wait...';
+        PERFORM guyane.update_forecast(10);
+    END IF;
+END $$;
+COMMENT ON FUNCTION guyane.run_post_processing(_tablename text)
+    IS 'Post-processing of a table, once its data has been imported: computes the expected and anomaly values. The
+    materialized views depending on the table are then refreshed by the sagui_worker command';
+            """),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.0.5 on 2026-10-18 18:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0061_matviewrefresh'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matviewrefresh',
+            name='method',
+            field=models.CharField(blank=True, choices=[('concurrent', 'Concurrent'), ('swap', 'Swap'), ('plain', 'Plain')], default='', help_text='concurrent: REFRESH CONCURRENTLY, swap: shadow view built then swapped, plain: blocking REFRESH', max_length=10),
+        ),
+        migrations.RunSQL(
+            """
+-- Unique indexes on the materialized views read by pg_tileserv and the API: they allow the refresh scheduler
+-- (sagui.utils.refresh) to refresh them CONCURRENTLY, without locking out the readers
+-- (hyfaa_data_with_*_aggregate_geo already have one, on cell_id)
+CREATE UNIQUE INDEX IF NOT EXISTS hyfaa_forecast_with_assimilated_unique_cellid_day
+    ON guyane.hyfaa_forecast_with_assimilated (cell_id, "date");
+CREATE UNIQUE INDEX IF NOT EXISTS hyfaa_forecast_with_mgbstandard_unique_cellid_day
+    ON guyane.hyfaa_forecast_with_mgbstandard (cell_id, "date");
+CREATE UNIQUE INDEX IF NOT EXISTS hyfaa_forecast_with_assimilated_aggregate_geo_unique_cellid
+    ON guyane.hyfaa_forecast_with_assimilated_aggregate_geo (cell_id);
+CREATE UNIQUE INDEX IF NOT EXISTS hyfaa_forecast_with_mgbstandard_aggregate_geo_unique_cellid
+    ON guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo (cell_id);
+CREATE UNIQUE INDEX IF NOT EXISTS rainfall_subbasin_aggregated_geo_unique_id
+    ON guyane.rainfall_subbasin_aggregated_geo (id);
+CREATE UNIQUE INDEX IF NOT EXISTS rainfall_minibasin_aggregated_geo_unique_id
+    ON guyane.rainfall_minibasin_aggregated_geo (id);
+            """),
+    ]
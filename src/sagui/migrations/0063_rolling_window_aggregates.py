@@ -0,0 +1,540 @@
+# Generated by Django 4.0.5 on 2026-10-18 19:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0062_matviews_unique_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+-----------------------------------------------------
+-- Rolling windows: the (rounded) values of the latest dates of the data tables. Small tables (a few rows per cell),
+-- maintained incrementally by the post-processing (sync_rolling_window): the dates leaving the window are evicted,
+-- and only the dates entering it (or re-imported since they were loaded) are read from the data tables
+-----------------------------------------------------
+CREATE TABLE IF NOT EXISTS guyane.hyfaa_window_mgbstandard (
+    cell_id smallint NOT NULL,
+    "date" date NOT NULL,
+    flow double precision,
+    flow_expected double precision,
+    flow_anomaly double precision,
+    CONSTRAINT hyfaa_window_mgbstandard_pkey PRIMARY KEY (cell_id, "date")
+);
+COMMENT ON TABLE guyane.hyfaa_window_mgbstandard IS 'Values of the 15 latest dates of the mgbstandard table (rounded)';
+
+CREATE TABLE IF NOT EXISTS guyane.hyfaa_window_assimilated (
+    cell_id smallint NOT NULL,
+    "date" date NOT NULL,
+    flow double precision,
+    flow_expected double precision,
+    flow_anomaly double precision,
+    CONSTRAINT hyfaa_window_assimilated_pkey PRIMARY KEY (cell_id, "date")
+);
+COMMENT ON TABLE guyane.hyfaa_window_assimilated IS 'Values of the 15 latest dates of the assimilated table (rounded)';
+
+CREATE TABLE IF NOT EXISTS guyane.hyfaa_window_forecast (
+    cell_id smallint NOT NULL,
+    "date" date NOT NULL,
+    flow double precision,
+    flow_expected double precision,
+    flow_anomaly double precision,
+    CONSTRAINT hyfaa_window_forecast_pkey PRIMARY KEY (cell_id, "date")
+);
+COMMENT ON TABLE guyane.hyfaa_window_forecast IS 'Values of the forecast table (rounded)';
+
+CREATE TABLE IF NOT EXISTS guyane.rainfall_window (
+    cell_id smallint NOT NULL,
+    "date" date NOT NULL,
+    rain double precision,
+    CONSTRAINT rainfall_window_pkey PRIMARY KEY (cell_id, "date")
+);
+COMMENT ON TABLE guyane.rainfall_window IS 'Values of the 15 latest dates of the rainfall table';
+
+-- Dates loaded in each window, with the last update time (dataset_dates catalog) of the data that was loaded
+CREATE TABLE IF NOT EXISTS guyane.rolling_window_dates (
+    window_name text NOT NULL,
+    "date" date NOT NULL,
+    last_updated timestamp with time zone,
+    CONSTRAINT rolling_window_dates_pkey PRIMARY KEY (window_name, "date")
+);
+COMMENT ON TABLE guyane.rolling_window_dates IS 'Dates loaded in the rolling windows (see sync_rolling_window)';
+
+
+-----------------------------------------------------
+-- Geometries of the aggregates, computed once (see rebuild_aggregate_geometries), instead of on every refresh
+-----------------------------------------------------
+CREATE TABLE IF NOT EXISTS guyane.drainage_geo (
+    mini smallint NOT NULL,
+    ordem smallint,
+    width numeric,
+    depth numeric,
+    geom geometry(Geometry,4326),
+    CONSTRAINT drainage_geo_pkey PRIMARY KEY (mini)
+);
+COMMENT ON TABLE guyane.drainage_geo IS 'Snapshot of drainage_mgb_masked (rounded attributes, geometries in EPSG:4326)';
+
+CREATE TABLE IF NOT EXISTS guyane.catchments_geo (
+    id text NOT NULL,
+    geom geometry(Geometry,4326),
+    CONSTRAINT catchments_geo_pkey PRIMARY KEY (id)
+);
+COMMENT ON TABLE guyane.catchments_geo IS 'Snapshot of the minibasins (id mini_<mini>) and subbasins (id sub_<sub>) geometries';
+            """),
+        migrations.RunSQL(
+            """
+-- Synchronize a rolling window with its source table: evict the dates out of the window (the _nb_dates latest dates of
+-- the source table, according to the dataset_dates catalog, all of them if NULL), then upsert the rows of the dates
+-- new in the window or updated since they were loaded. Only the rows whose values changed are written.
+-- _columns: expressions giving the window's columns (other than cell_id and date), from the source table's columns
+-- RETURNS the number of rows written or deleted
+CREATE OR REPLACE FUNCTION guyane.sync_rolling_window(_window text, _src_tbl text, _columns text, _nb_dates int)
+RETURNS integer
+AS
+$$
+DECLARE
+	target_dates date[];
+	changed_dates date[];
+	cols text;
+	excluded_cols text;
+	counter integer;
+	n integer;
+BEGIN
+    SELECT COALESCE(array_agg("date"), '{}') INTO target_dates FROM (
+        SELECT "date" FROM guyane.dataset_dates WHERE tablename = _src_tbl ORDER BY "date" DESC LIMIT _nb_dates
+    ) d;
+
+    -- evict the dates out of the window
+    EXECUTE format('DELETE FROM guyane.%I WHERE "date" <> ALL($1)', _window) USING target_dates;
+    GET DIAGNOSTICS counter = ROW_COUNT;
+    DELETE FROM guyane.rolling_window_dates WHERE window_name = _window AND "date" <> ALL(target_dates);
+
+    -- dates new in the window, or updated since they were loaded
+    SELECT array_agg(c."date") INTO changed_dates
+    FROM guyane.dataset_dates c
+    LEFT JOIN guyane.rolling_window_dates w ON w.window_name = _window AND w."date" = c."date"
+    WHERE c.tablename = _src_tbl AND c."date" = ANY(target_dates) AND w.last_updated IS DISTINCT FROM c.last_updated;
+    IF changed_dates IS NULL THEN
+        RETURN counter;
+    END IF;
+
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum), string_agg('EXCLUDED.' || quote_ident(attname), ', ' ORDER BY attnum)
+    INTO cols, excluded_cols
+    FROM pg_attribute
+    WHERE attrelid = format('guyane.%I', _window)::regclass AND attnum > 0 AND NOT attisdropped
+        AND attname NOT IN ('cell_id', 'date');
+    EXECUTE format('INSERT INTO guyane.%1$I AS w (cell_id, "date", %2$s)
+                        SELECT cell_id, "date", %4$s FROM guyane.%5$I WHERE "date" = ANY($1)
+                    ON CONFLICT (cell_id, "date") DO UPDATE SET (%2$s) = ROW(%3$s)
+                        WHERE ROW(%6$s) IS DISTINCT FROM ROW(%3$s)',
+                   _window, cols, excluded_cols, _columns, _src_tbl,
+                   (SELECT string_agg('w.' || c, ', ') FROM unnest(string_to_array(cols, ', ')) AS c))
+    USING changed_dates;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    counter := counter + n;
+    -- cells removed from the source table
+    EXECUTE format('DELETE FROM guyane.%1$I AS w WHERE w."date" = ANY($1)
+                    AND NOT EXISTS (SELECT 1 FROM guyane.%2$I s WHERE s."date" = w."date" AND s.cell_id = w.cell_id)',
+                   _window, _src_tbl)
+    USING changed_dates;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    counter := counter + n;
+
+    INSERT INTO guyane.rolling_window_dates (window_name, "date", last_updated)
+        SELECT _window, c."date", c.last_updated FROM guyane.dataset_dates c
+        WHERE c.tablename = _src_tbl AND c."date" = ANY(changed_dates)
+        ON CONFLICT (window_name, "date") DO UPDATE SET last_updated = EXCLUDED.last_updated;
+    RAISE INFO '[%] % dates loaded, % rows written or deleted', _window, array_length(changed_dates, 1), counter;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.sync_rolling_window(_window text, _src_tbl text, _columns text, _nb_dates int)
+    IS 'Synchronize a rolling window table with the _nb_dates latest dates of its source table (incremental: evicts the
+    old dates, loads the new or updated ones). RETURNS the number of rows written or deleted';
+
+
+-- Merge new aggregated values into an aggregate table (key, "values", ..., geom): only the rows whose values changed
+-- are updated, the keys without values are deleted, and the new keys are inserted, using _rows_query to join them with
+-- their geometries (%s in _rows_query is replaced by the new (key, "values") rows).
+-- With _rebuild, the table is emptied first (e.g. when the geometries changed)
+-- RETURNS the number of rows written or deleted
+CREATE OR REPLACE FUNCTION guyane.merge_aggregate_geo(_tbl text, _key text, _values_query text, _rows_query text,
+                                                      _rebuild boolean default false)
+RETURNS integer
+AS
+$$
+DECLARE
+	counter integer := 0;
+	n integer;
+BEGIN
+    DROP TABLE IF EXISTS pg_temp.aggregate_values;
+    EXECUTE format('CREATE TEMPORARY TABLE aggregate_values ON COMMIT DROP AS %s', _values_query);
+    IF _rebuild THEN
+        EXECUTE format('DELETE FROM guyane.%I', _tbl);
+    END IF;
+
+    EXECUTE format('DELETE FROM guyane.%1$I t WHERE NOT EXISTS (SELECT 1 FROM aggregate_values v WHERE v.%2$I = t.%2$I)',
+                   _tbl, _key);
+    GET DIAGNOSTICS n = ROW_COUNT;
+    counter := counter + n;
+    EXECUTE format('UPDATE guyane.%1$I t SET "values" = v."values" FROM aggregate_values v
+                    WHERE v.%2$I = t.%2$I AND t."values"::text IS DISTINCT FROM v."values"::text', _tbl, _key);
+    GET DIAGNOSTICS n = ROW_COUNT;
+    counter := counter + n;
+    EXECUTE format('INSERT INTO guyane.%1$I %2$s', _tbl,
+                   format(_rows_query, format('(SELECT * FROM aggregate_values v
+                            WHERE NOT EXISTS (SELECT 1 FROM guyane.%1$I t WHERE t.%2$I = v.%2$I))', _tbl, _key)));
+    GET DIAGNOSTICS n = ROW_COUNT;
+    counter := counter + n;
+
+    DROP TABLE aggregate_values;
+    RAISE INFO '[%] % rows written or deleted', _tbl, counter;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.merge_aggregate_geo(_tbl text, _key text, _values_query text, _rows_query text, _rebuild boolean)
+    IS 'Merge new aggregated values into an aggregate table, writing only the changed rows. RETURNS the number of rows
+    written or deleted';
+
+
+-- Update the rolling windows fed by a dataset (mgbstandard, assimilated, forecast or rainfall), then the aggregate
+-- tables depending on them
+-- RETURNS the number of rows written or deleted in the aggregate tables
+CREATE OR REPLACE FUNCTION guyane.update_rolling_aggregates(_dataset text, _rebuild boolean default false)
+RETURNS integer
+AS
+$$
+DECLARE
+	datasets text[];
+	ds text;
+	counter integer := 0;
+BEGIN
+    CASE _dataset
+        WHEN 'mgbstandard' THEN
+            PERFORM guyane.sync_rolling_window('hyfaa_window_mgbstandard', 'hyfaa_data_mgbstandard',
+                'ROUND(flow_mean), ROUND(flow_expected), ROUND(flow_anomaly)', 15);
+            datasets := ARRAY['mgbstandard'];
+        WHEN 'assimilated' THEN
+            PERFORM guyane.sync_rolling_window('hyfaa_window_assimilated', 'hyfaa_data_assimilated',
+                'ROUND(flow_median), ROUND(flow_expected), ROUND(flow_anomaly)', 15);
+            datasets := ARRAY['assimilated'];
+        WHEN 'forecast' THEN
+            PERFORM guyane.sync_rolling_window('hyfaa_window_forecast', 'hyfaa_data_forecast',
+                'ROUND(flow_median), ROUND(flow_expected), ROUND(flow_anomaly)', NULL);
+            datasets := ARRAY['assimilated', 'mgbstandard'];
+        WHEN 'rainfall' THEN
+            PERFORM guyane.sync_rolling_window('rainfall_window', 'sagui_rainfall', 'rain', 15);
+            counter := counter + guyane.merge_aggregate_geo('rainfall_minibasin_aggregated_geo', 'id',
+                'SELECT ''mini_'' || cell_id AS id,
+                    json_agg(json_build_object(''date'', "date", ''rain'', round(rain)) ORDER BY "date" DESC) AS "values"
+                 FROM guyane.rainfall_window GROUP BY cell_id',
+                'SELECT v.id, v."values", g.geom FROM %s v JOIN guyane.catchments_geo g ON g.id = v.id', _rebuild);
+            counter := counter + guyane.merge_aggregate_geo('rainfall_subbasin_aggregated_geo', 'id',
+                'SELECT ''sub_'' || sub AS id,
+                    json_agg(json_build_object(''date'', "date", ''rain'', round(rain)) ORDER BY "date" DESC) AS "values"
+                 FROM (SELECT c.sub, r."date", AVG(r.rain) AS rain
+                       FROM guyane.rainfall_window r JOIN guyane.hyfaa_catchments c ON r.cell_id = c.mini
+                       GROUP BY c.sub, r."date") AS rainfall_by_sub
+                 GROUP BY sub',
+                'SELECT v.id, v."values", g.geom FROM %s v JOIN guyane.catchments_geo g ON g.id = v.id', _rebuild);
+            RETURN counter;
+    END CASE;
+
+    FOREACH ds IN ARRAY datasets
+        LOOP
+            IF _dataset <> 'forecast' THEN
+                counter := counter + guyane.merge_aggregate_geo(format('hyfaa_data_with_%s_aggregate_geo', ds), 'cell_id',
+                    format('SELECT cell_id, "values" FROM guyane.hyfaa_data_%s_aggregate_json', ds),
+                    'SELECT v.cell_id, v."values", g.ordem, g.width, g.depth, g.geom
+                     FROM %s v JOIN guyane.drainage_geo g ON g.mini = v.cell_id', _rebuild);
+            END IF;
+            counter := counter + guyane.merge_aggregate_geo(format('hyfaa_forecast_with_%s_aggregate_geo', ds), 'cell_id',
+                format('SELECT cell_id, json_agg(json_build_object(
+                            ''source'', source,
+                            ''date'', "date",
+                            ''flow'', flow,
+                            ''flow_anomaly'', flow_anomaly
+                        ) ORDER BY "date" DESC) AS "values"
+                        FROM guyane.hyfaa_forecast_with_%s
+                        GROUP BY cell_id', ds),
+                'SELECT v.cell_id, v."values", g.ordem, g.width, g.depth, g.geom
+                 FROM %s v JOIN guyane.drainage_geo g ON g.mini = v.cell_id', _rebuild);
+        END LOOP;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.update_rolling_aggregates(_dataset text, _rebuild boolean)
+    IS 'Update the rolling windows fed by a dataset (mgbstandard, assimilated, forecast or rainfall), then the aggregate
+    tables depending on them. RETURNS the number of rows written or deleted in the aggregate tables';
+
+
+-- Snapshot the geometries used by the aggregate tables, then rebuild the aggregate tables. To be run when the
+-- geometries or their filters (inclusion mask, max_ordem in saguiconfig) change
+CREATE OR REPLACE FUNCTION guyane.rebuild_aggregate_geometries()
+RETURNS void
+AS
+$$
+BEGIN
+    DELETE FROM guyane.drainage_geo;
+    INSERT INTO guyane.drainage_geo (mini, ordem, width, depth, geom)
+        SELECT mini, ordem, ROUND(width::numeric), ROUND(depth::numeric, 2), ST_Transform(geom, 4326)
+        FROM guyane.drainage_mgb_masked;
+    DELETE FROM guyane.catchments_geo;
+    INSERT INTO guyane.catchments_geo (id, geom)
+        SELECT 'mini_' || mini, geom FROM guyane.hyfaa_catchments
+        UNION ALL
+        SELECT 'sub_' || id, geom FROM guyane.hyfaa_catchments_subbasins;
+
+    PERFORM guyane.update_rolling_aggregates(ds, true)
+    FROM unnest(ARRAY['mgbstandard', 'assimilated', 'forecast', 'rainfall']) AS ds;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.rebuild_aggregate_geometries()
+    IS 'Snapshot the geometries used by the aggregate tables (drainage_geo, catchments_geo), then rebuild the aggregate tables';
+            """),
+        migrations.RunSQL(
+            """
+-- The materialized views are replaced by views over the rolling windows, and by aggregate tables
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_data_with_assimilated_aggregate_geo CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_data_with_mgbstandard_aggregate_geo CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_assimilated CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.hyfaa_forecast_with_mgbstandard CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.rainfall_subbasin_aggregated_geo CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS guyane.rainfall_minibasin_aggregated_geo CASCADE;
+
+-----------------------------------------------------
+-- Aggregate the last 15d values in a json field
+-----------------------------------------------------
+CREATE OR REPLACE VIEW guyane.hyfaa_data_assimilated_aggregate_json
+ AS
+SELECT cell_id,
+       json_agg(
+          json_build_object(
+      		'date', date,
+      		'flow', flow,
+      		'flow_anomaly', flow_anomaly
+      		)
+	        ORDER BY "date" DESC
+        ) AS values
+FROM guyane.hyfaa_window_assimilated
+GROUP BY cell_id
+ORDER BY cell_id;
+
+CREATE OR REPLACE VIEW guyane.hyfaa_data_mgbstandard_aggregate_json
+ AS
+SELECT cell_id,
+       json_agg(
+          json_build_object(
+      		'date', date,
+      		'flow', flow,
+      		'flow_anomaly', flow_anomaly
+      		)
+	        ORDER BY "date" DESC
+        ) AS values
+FROM guyane.hyfaa_window_mgbstandard
+GROUP BY cell_id
+ORDER BY cell_id;
+
+-----------------------------------------------------
+-- Forecast values, fusioned with the latest historical values (+/- 10 days)
+-----------------------------------------------------
+CREATE OR REPLACE VIEW guyane.hyfaa_forecast_with_assimilated
+AS
+WITH latest AS (
+    SELECT MAX("date") AS d FROM guyane.hyfaa_window_assimilated
+)
+SELECT 'forecast' AS source, cell_id, "date", flow, flow_expected, flow_anomaly
+    FROM guyane.hyfaa_window_forecast WHERE "date" > (SELECT d FROM latest)
+UNION ALL
+SELECT 'assimilated' AS source, cell_id, "date", flow, flow_expected, flow_anomaly
+    FROM guyane.hyfaa_window_assimilated WHERE "date" > (SELECT d FROM latest) - '10 days'::interval
+ORDER BY cell_id, "date" DESC;
+COMMENT ON VIEW guyane.hyfaa_forecast_with_assimilated
+    IS 'Fusion latest values from assimilated table and forecast values (+/- 10 days)';
+
+CREATE OR REPLACE VIEW guyane.hyfaa_forecast_with_mgbstandard
+AS
+WITH latest AS (
+    SELECT MAX("date") AS d FROM guyane.hyfaa_window_mgbstandard
+)
+SELECT 'forecast' AS source, cell_id, "date", flow, flow_expected, flow_anomaly
+    FROM guyane.hyfaa_window_forecast WHERE "date" > (SELECT d FROM latest)
+UNION ALL
+SELECT 'mgbstandard' AS source, cell_id, "date", flow, flow_expected, flow_anomaly
+    FROM guyane.hyfaa_window_mgbstandard WHERE "date" > (SELECT d FROM latest) - '10 days'::interval
+ORDER BY cell_id, "date" DESC;
+COMMENT ON VIEW guyane.hyfaa_forecast_with_mgbstandard
+    IS 'Fusion latest values from mgbstandard table and forecast values (+/- 10 days)';
+
+-----------------------------------------------------
+-- Aggregate tables, served as MVT: maintained by update_rolling_aggregates
+-----------------------------------------------------
+CREATE TABLE guyane.hyfaa_data_with_assimilated_aggregate_geo (
+    cell_id smallint NOT NULL PRIMARY KEY,
+    "values" json,
+    ordem smallint,
+    width numeric,
+    depth numeric,
+    geom geometry(Geometry,4326)
+);
+COMMENT ON TABLE guyane.hyfaa_data_with_assimilated_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the most recent values (n last days, stored in a json object)';
+
+CREATE TABLE guyane.hyfaa_data_with_mgbstandard_aggregate_geo (LIKE guyane.hyfaa_data_with_assimilated_aggregate_geo INCLUDING ALL);
+COMMENT ON TABLE guyane.hyfaa_data_with_mgbstandard_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the most recent values (n last days, stored in a json object)';
+
+CREATE TABLE guyane.hyfaa_forecast_with_assimilated_aggregate_geo (LIKE guyane.hyfaa_data_with_assimilated_aggregate_geo INCLUDING ALL);
+COMMENT ON TABLE guyane.hyfaa_forecast_with_assimilated_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the values fusioned from latest values in assimilated table and forecast values (+/- 10 days, stored in a json object)';
+
+CREATE TABLE guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo (LIKE guyane.hyfaa_data_with_assimilated_aggregate_geo INCLUDING ALL);
+COMMENT ON TABLE guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo
+    IS 'Combine the geometries for the minibasins with the values fusioned from latest values in mgbstandard table and forecast values (+/- 10 days, stored in a json object)';
+
+CREATE TABLE guyane.rainfall_minibasin_aggregated_geo (
+    id text NOT NULL PRIMARY KEY,
+    "values" json,
+    geom geometry(Geometry,4326)
+);
+COMMENT ON TABLE guyane.rainfall_minibasin_aggregated_geo IS
+'Aggregated rainfall data (json object) at minibasin geospatial level';
+
+CREATE TABLE guyane.rainfall_subbasin_aggregated_geo (LIKE guyane.rainfall_minibasin_aggregated_geo INCLUDING ALL);
+COMMENT ON TABLE guyane.rainfall_subbasin_aggregated_geo IS
+'Aggregated rainfall data (json object) at subbasin geospatial level';
+
+CREATE INDEX hyfaa_data_with_assimilated_aggregate_geo_geom_idx ON guyane.hyfaa_data_with_assimilated_aggregate_geo USING gist (geom);
+CREATE INDEX hyfaa_data_with_mgbstandard_aggregate_geo_geom_idx ON guyane.hyfaa_data_with_mgbstandard_aggregate_geo USING gist (geom);
+CREATE INDEX hyfaa_forecast_with_assimilated_aggregate_geo_geom_idx ON guyane.hyfaa_forecast_with_assimilated_aggregate_geo USING gist (geom);
+CREATE INDEX hyfaa_forecast_with_mgbstandard_aggregate_geo_geom_idx ON guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo USING gist (geom);
+CREATE INDEX rainfall_minibasin_aggregated_geo_geom_idx ON guyane.rainfall_minibasin_aggregated_geo USING gist (geom);
+CREATE INDEX rainfall_subbasin_aggregated_geo_geom_idx ON guyane.rainfall_subbasin_aggregated_geo USING gist (geom);
+
+GRANT SELECT ON TABLE guyane.hyfaa_data_with_assimilated_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.hyfaa_data_with_mgbstandard_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.hyfaa_forecast_with_assimilated_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.hyfaa_forecast_with_mgbstandard_aggregate_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.rainfall_minibasin_aggregated_geo TO tileserv;
+GRANT SELECT ON TABLE guyane.rainfall_subbasin_aggregated_geo TO tileserv;
+
+-- Initial content
+SELECT guyane.rebuild_aggregate_geometries();
+            """),
+        migrations.RunSQL(
+            """
+-- Queue a post-processing job for a table (at most one pending job per table) and notify the workers
+CREATE OR REPLACE FUNCTION guyane.queue_post_processing(_tablename text)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO guyane.sagui_postprocessingjob (tablename, status, attempts, created_at, last_error)
+        VALUES (_tablename, 'pending', 0, now(), '')
+        ON CONFLICT (tablename) WHERE status = 'pending' DO NOTHING;
+    PERFORM pg_notify('sagui_post_processing', _tablename);
+    RAISE INFO 'Post-processing of table % queued (run by the sagui_worker command)', _tablename;
+END $$;
+COMMENT ON FUNCTION guyane.queue_post_processing(_tablename text)
+    IS 'Queue a post-processing job for a table, run by the sagui_worker command';
+
+-- Update trigger on importstate table
+CREATE OR REPLACE FUNCTION guyane.publication_post_processing()
+    RETURNS TRIGGER LANGUAGE plpgsql
+    SECURITY DEFINER
+    AS $$
+    BEGIN
+        PERFORM guyane.refresh_dataset_dates(NEW."tablename",
+            (SELECT MAX("date") FROM guyane.dataset_dates WHERE tablename = NEW."tablename"));
+        PERFORM guyane.queue_post_processing(NEW."tablename");
+        RETURN null;
+    END $$;
+
+-- Trigger on the tables the aggregates' geometries are computed from: their snapshot is rebuilt by the post-processing
+CREATE OR REPLACE FUNCTION guyane.geometries_post_processing()
+    RETURNS TRIGGER LANGUAGE plpgsql
+    SECURITY DEFINER
+    AS $$
+    BEGIN
+        PERFORM guyane.queue_post_processing(TG_TABLE_NAME);
+        RETURN null;
+    END $$;
+
+DROP TRIGGER IF EXISTS geometries_post_processing ON guyane.hyfaa_geo_inclusion_mask;
+CREATE TRIGGER geometries_post_processing
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON guyane.hyfaa_geo_inclusion_mask
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.geometries_post_processing();
+DROP TRIGGER IF EXISTS geometries_post_processing ON guyane.hyfaa_minibasins_data;
+CREATE TRIGGER geometries_post_processing
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON guyane.hyfaa_minibasins_data
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.geometries_post_processing();
+DROP TRIGGER IF EXISTS geometries_post_processing ON guyane.hyfaa_drainage;
+CREATE TRIGGER geometries_post_processing
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON guyane.hyfaa_drainage
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.geometries_post_processing();
+DROP TRIGGER IF EXISTS geometries_post_processing ON guyane.hyfaa_catchments;
+CREATE TRIGGER geometries_post_processing
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON guyane.hyfaa_catchments
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.geometries_post_processing();
+DROP TRIGGER IF EXISTS geometries_post_processing ON guyane.sagui_saguiconfig;
+CREATE TRIGGER geometries_post_processing
+    AFTER INSERT OR UPDATE OF max_ordem OR DELETE ON guyane.sagui_saguiconfig
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.geometries_post_processing();
+
+
+-- Post-processing: the rolling windows and the aggregate tables are updated incrementally (they replace the
+-- materialized views)
+CREATE OR REPLACE FUNCTION guyane.run_post_processing(_tablename text)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+    -- mgbstandard data
+    IF _tablename LIKE '%data_mgbstandard' THEN
+        RAISE INFO 'Post-processing mgbstandard table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_mgbstandard', 'flow_mean', 10);
+        PERFORM guyane.update_rolling_aggregates('mgbstandard');
+    END IF;
+
+    -- assimilated data
+    IF _tablename LIKE '%data_assimilated' THEN
+        RAISE INFO 'Post-processing assimilated table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_assimilated', 'flow_median', 10);
+        PERFORM guyane.update_rolling_aggregates('assimilated');
+    END IF;
+
+    -- forecast data
+    IF _tablename LIKE '%data_forecast' THEN
+        RAISE INFO 'Post-processing forecast table. Please wait...';
+        PERFORM guyane.update_forecast(10);
+        PERFORM guyane.update_rolling_aggregates('forecast');
+    END IF;
+
+    -- rainfall data
+    IF _tablename LIKE '%_rainfall' THEN
+        RAISE INFO 'Post-processing rainfall table. Please wait...';
+        PERFORM guyane.update_rolling_aggregates('rainfall');
+    END IF;
+
+    -- geometries
+    IF _tablename IN ('hyfaa_geo_inclusion_mask', 'hyfaa_minibasins_data', 'hyfaa_drainage', 'hyfaa_catchments',
+                      'sagui_saguiconfig') THEN
+        RAISE INFO 'Rebuilding the geometries of the aggregates. Please wait...';
+        PERFORM guyane.rebuild_aggregate_geometries();
+    END IF;
+END $$;
+COMMENT ON FUNCTION guyane.run_post_processing(_tablename text)
+    IS 'Post-processing of a table, once its data has been imported: computes the expected and anomaly values, and
+    updates the rolling windows and aggregate tables depending on it. Run by the sagui_worker command';
+            """),
+    ]
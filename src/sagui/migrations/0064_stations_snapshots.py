@@ -0,0 +1,193 @@
+# Generated by Django 4.0.5 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0063_rolling_window_aggregates'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='stationswithflowalerts',
+            options={'managed': False, 'ordering': ['id'], 'verbose_name': 'Stations with alert codes (Snapshot)'},
+        ),
+        migrations.AlterModelOptions(
+            name='stationswithflowprevi',
+            options={'managed': False, 'ordering': ['id'], 'verbose_name': 'Stations with previ codes (Snapshot)'},
+        ),
+        migrations.AddField(
+            model_name='stationswithflowalerts',
+            name='computed_at',
+            field=models.DateTimeField(help_text='Time the snapshot was computed (by the post-processing)', verbose_name='Computed at'),
+        ),
+        migrations.AddField(
+            model_name='stationswithflowprevi',
+            name='computed_at',
+            field=models.DateTimeField(help_text='Time the snapshot was computed (by the post-processing)', verbose_name='Computed at'),
+        ),
+        migrations.RunSQL(
+            """
+-----------------------------------------------------
+-- The stations_with_flow_alerts and stations_with_flow_previ views, computing the levels on every read, are
+-- replaced by snapshot tables, recomputed by the post-processing (update_stations_snapshots)
+-----------------------------------------------------
+DROP VIEW IF EXISTS guyane.stations_with_flow_alerts;
+CREATE TABLE guyane.stations_with_flow_alerts (
+    id bigint NOT NULL PRIMARY KEY,
+    name varchar(50),
+    river varchar(50),
+    minibasin smallint,
+    levels jsonb,
+    geom geometry(Point,4326),
+    computed_at timestamp with time zone NOT NULL
+);
+COMMENT ON TABLE guyane.stations_with_flow_alerts IS
+'Stations with their alert levels (snapshot of func_stations_with_flow_alerts, see update_stations_snapshots)';
+
+DROP VIEW IF EXISTS guyane.stations_with_flow_previ;
+CREATE TABLE guyane.stations_with_flow_previ (LIKE guyane.stations_with_flow_alerts INCLUDING ALL);
+COMMENT ON TABLE guyane.stations_with_flow_previ IS
+'Stations with their forecast levels (snapshot of func_stations_with_flow_previ, see update_stations_snapshots)';
+
+
+-- Recompute a stations snapshot table from its function. The table is rewritten only if the snapshot changed: its
+-- computed_at column (the same for all the rows) can be used to validate the caches.
+-- RETURNS true if the snapshot changed
+CREATE OR REPLACE FUNCTION guyane.update_stations_snapshot(_tbl text, _func text)
+RETURNS boolean
+AS
+$$
+DECLARE
+	changed boolean;
+BEGIN
+    DROP TABLE IF EXISTS pg_temp.stations_snapshot;
+    EXECUTE format('CREATE TEMPORARY TABLE stations_snapshot ON COMMIT DROP AS SELECT * FROM guyane.%I()', _func);
+    EXECUTE format('SELECT EXISTS (
+                        (SELECT id, name, river, minibasin, levels, geom FROM stations_snapshot
+                         EXCEPT SELECT id, name, river, minibasin, levels, geom FROM guyane.%1$I)
+                        UNION ALL
+                        (SELECT id, name, river, minibasin, levels, geom FROM guyane.%1$I
+                         EXCEPT SELECT id, name, river, minibasin, levels, geom FROM stations_snapshot)
+                    )', _tbl)
+    INTO changed;
+    IF changed THEN
+        EXECUTE format('DELETE FROM guyane.%I', _tbl);
+        EXECUTE format('INSERT INTO guyane.%I (id, name, river, minibasin, levels, geom, computed_at)
+                            SELECT id, name, river, minibasin, levels, geom, now() FROM stations_snapshot', _tbl);
+    END IF;
+    DROP TABLE stations_snapshot;
+    RAISE INFO '[%] snapshot changed: %', _tbl, changed;
+    RETURN changed;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.update_stations_snapshot(_tbl text, _func text)
+    IS 'Recompute a stations snapshot table from its function, rewriting it only if the snapshot changed. RETURNS true
+    if the snapshot changed';
+
+CREATE OR REPLACE FUNCTION guyane.update_stations_snapshots()
+RETURNS void
+AS
+$$
+BEGIN
+    PERFORM guyane.update_stations_snapshot('stations_with_flow_alerts', 'func_stations_with_flow_alerts');
+    PERFORM guyane.update_stations_snapshot('stations_with_flow_previ', 'func_stations_with_flow_previ');
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.update_stations_snapshots()
+    IS 'Recompute the stations_with_flow_alerts and stations_with_flow_previ snapshot tables';
+
+-- Initial content
+SELECT guyane.update_stations_snapshots();
+            """),
+        migrations.RunSQL(
+            """
+-- Trigger on the tables the stations levels are computed from (other than the data tables): the snapshots are
+-- recomputed by the post-processing
+CREATE OR REPLACE FUNCTION guyane.stations_post_processing()
+    RETURNS TRIGGER LANGUAGE plpgsql
+    SECURITY DEFINER
+    AS $$
+    BEGIN
+        PERFORM guyane.queue_post_processing(TG_TABLE_NAME);
+        RETURN null;
+    END $$;
+
+DROP TRIGGER IF EXISTS stations_post_processing ON guyane.hyfaa_stations;
+CREATE TRIGGER stations_post_processing
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON guyane.hyfaa_stations
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.stations_post_processing();
+DROP TRIGGER IF EXISTS stations_post_processing ON guyane.stations_reference_flow;
+CREATE TRIGGER stations_post_processing
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON guyane.stations_reference_flow
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.stations_post_processing();
+DROP TRIGGER IF EXISTS stations_post_processing ON guyane.stations_reference_flow_period;
+CREATE TRIGGER stations_post_processing
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON guyane.stations_reference_flow_period
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.stations_post_processing();
+DROP TRIGGER IF EXISTS stations_post_processing ON guyane.sagui_saguiconfig;
+CREATE TRIGGER stations_post_processing
+    AFTER INSERT OR UPDATE OF use_dataset OR DELETE ON guyane.sagui_saguiconfig
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.stations_post_processing();
+
+
+-- Post-processing: the stations snapshots are recomputed after the hyfaa data tables and the tables they are computed
+-- from
+CREATE OR REPLACE FUNCTION guyane.run_post_processing(_tablename text)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+    -- mgbstandard data
+    IF _tablename LIKE '%data_mgbstandard' THEN
+        RAISE INFO 'Post-processing mgbstandard table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_mgbstandard', 'flow_mean', 10);
+        PERFORM guyane.update_rolling_aggregates('mgbstandard');
+    END IF;
+
+    -- assimilated data
+    IF _tablename LIKE '%data_assimilated' THEN
+        RAISE INFO 'Post-processing assimilated table. Please wait...';
+        PERFORM guyane.compute_expected_and_anomaly('guyane.hyfaa_data_assimilated', 'flow_median', 10);
+        PERFORM guyane.update_rolling_aggregates('assimilated');
+    END IF;
+
+    -- forecast data
+    IF _tablename LIKE '%data_forecast' THEN
+        RAISE INFO 'Post-processing forecast table. Please wait...';
+        PERFORM guyane.update_forecast(10);
+        PERFORM guyane.update_rolling_aggregates('forecast');
+    END IF;
+
+    -- rainfall data
+    IF _tablename LIKE '%_rainfall' THEN
+        RAISE INFO 'Post-processing rainfall table. Please wait...';
+        PERFORM guyane.update_rolling_aggregates('rainfall');
+    END IF;
+
+    -- geometries
+    IF _tablename IN ('hyfaa_geo_inclusion_mask', 'hyfaa_minibasins_data', 'hyfaa_drainage', 'hyfaa_catchments',
+                      'sagui_saguiconfig') THEN
+        RAISE INFO 'Rebuilding the geometries of the aggregates. Please wait...';
+        PERFORM guyane.rebuild_aggregate_geometries();
+    END IF;
+
+    -- stations levels
+    IF _tablename LIKE 'hyfaa_data_%' OR _tablename IN ('hyfaa_stations', 'stations_reference_flow',
+                                                         'stations_reference_flow_period', 'sagui_saguiconfig') THEN
+        RAISE INFO 'Updating the stations snapshots. Please wait...';
+        PERFORM guyane.update_stations_snapshots();
+    END IF;
+END $$;
+COMMENT ON FUNCTION guyane.run_post_processing(_tablename text)
+    IS 'Post-processing of a table, once its data has been imported: computes the expected and anomaly values, and
+    updates the rolling windows, aggregate tables and stations snapshots depending on it. Run by the sagui_worker command';
+            """),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.0.5 on 2026-10-18 20:50
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0064_stations_snapshots'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+-- The hyfaa_data_aggregated_geo and hyfaa_forecast_aggregated_geo views, used for the MVT display, were proxies over
+-- the func_hyfaa_*_aggregated_geo functions: the planner can't push the tile filter through a function, every tile was
+-- reading all the rows. They are now plain views over the aggregate tables of the dataset selected in saguiconfig,
+-- regenerated when the dataset changes. The functions are kept (used by the benchmark command, tiles target)
+CREATE OR REPLACE FUNCTION guyane.update_aggregated_geo_views()
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+	dataset TEXT;
+BEGIN
+	SELECT COALESCE((SELECT use_dataset FROM guyane.sagui_saguiconfig LIMIT 1), 'assimilated') INTO dataset;
+	IF dataset NOT IN ('assimilated', 'mgbstandard') THEN
+	    RAISE EXCEPTION 'Unknown dataset %', dataset;
+	END IF;
+	RAISE INFO 'Aggregated geo views: using dataset %', dataset;
+
+	EXECUTE format('CREATE OR REPLACE VIEW guyane.hyfaa_data_aggregated_geo AS
+	                SELECT cell_id, "values", width, depth, geom FROM guyane.%I', 'hyfaa_data_with_' || dataset || '_aggregate_geo');
+	COMMENT ON VIEW guyane.hyfaa_data_aggregated_geo IS
+'Use this one for MVT display of hyfaa drainage data.
+Serves the data from either hyfaa_data_with_assimilated_aggregate_geo or hyfaa_data_with_mgbstandard_aggregate_geo
+depending on the dataset selected in saguiconfig table (regenerated by update_aggregated_geo_views when it changes).';
+
+	EXECUTE format('CREATE OR REPLACE VIEW guyane.hyfaa_forecast_aggregated_geo AS
+	                SELECT cell_id, "values", width, depth, geom FROM guyane.%I', 'hyfaa_forecast_with_' || dataset || '_aggregate_geo');
+	COMMENT ON VIEW guyane.hyfaa_forecast_aggregated_geo IS
+'Use this one for MVT display of forecast drainage data.
+Serves the data from either hyfaa_forecast_with_assimilated_aggregate_geo or hyfaa_forecast_with_mgbstandard_aggregate_geo
+depending on the dataset selected in saguiconfig table (regenerated by update_aggregated_geo_views when it changes).';
+
+	GRANT SELECT ON TABLE guyane.hyfaa_data_aggregated_geo TO tileserv;
+	GRANT SELECT ON TABLE guyane.hyfaa_forecast_aggregated_geo TO tileserv;
+END $$;
+COMMENT ON FUNCTION guyane.update_aggregated_geo_views()
+    IS 'Regenerate the hyfaa_data_aggregated_geo and hyfaa_forecast_aggregated_geo views, using the dataset selected in
+    saguiconfig table';
+
+-- Trigger on saguiconfig: the views are regenerated when the dataset changes
+CREATE OR REPLACE FUNCTION guyane.saguiconfig_update_aggregated_geo_views()
+    RETURNS TRIGGER LANGUAGE plpgsql
+    SECURITY DEFINER
+    AS $$
+    BEGIN
+        PERFORM guyane.update_aggregated_geo_views();
+        RETURN null;
+    END $$;
+
+DROP TRIGGER IF EXISTS update_aggregated_geo_views ON guyane.sagui_saguiconfig;
+CREATE TRIGGER update_aggregated_geo_views
+    AFTER INSERT OR UPDATE OF use_dataset OR DELETE ON guyane.sagui_saguiconfig
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION guyane.saguiconfig_update_aggregated_geo_views();
+
+SELECT guyane.update_aggregated_geo_views();
+            """),
+    ]
@@ -0,0 +1,300 @@
+# Generated by Django 4.0.5 on 2026-10-18 22:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0065_aggregated_geo_plain_views'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+        """
+-- The expected values cache (flow_climatology) was keyed by date (year, day of year): it was filled lazily, one
+-- entry per pending date and cell, i.e. the daily imports were still computing the medians of their new dates.
+-- It is now keyed by (cell, day of year, years up to): the median of the values over the years up to up_to_year,
+-- +/- nb_days around the day of year. Once a year of data is complete, its entries are computed once for all the days
+-- of year, and the expected values of the next year are retrieved by an indexed join.
+-- Same results as the former definition (see compute_expected_and_anomaly_legacy): for a date D of year Y whose
+-- window (D - nb_days .. D + nb_days) is within year Y, the reference values are exactly the ones of the years up to
+-- Y - 1, at the days of year doy(D) - nb_days .. doy(D) + nb_days. The dates whose window overlaps another year (the
+-- first and last nb_days days of the year) are computed directly, like the dates of a year whose previous year is not
+-- complete yet
+DROP TABLE IF EXISTS guyane.flow_climatology;
+CREATE TABLE guyane.flow_climatology (
+    source_table text NOT NULL,
+    column_name text NOT NULL,
+    nb_days smallint NOT NULL,
+    up_to_year smallint NOT NULL,
+    day_of_year smallint NOT NULL,
+    cell_id integer NOT NULL,
+    flow_expected double precision,
+    nb_values integer NOT NULL,
+    CONSTRAINT flow_climatology_pkey PRIMARY KEY (source_table, column_name, nb_days, up_to_year, day_of_year, cell_id)
+);
+COMMENT ON TABLE guyane.flow_climatology
+    IS 'Cache of the expected values: floating median of the values over the years up to up_to_year, +/- nb_days around
+    the day of year, per source table and column and cell. Used for the dates of year up_to_year + 1. Maintained by
+    compute_expected_and_anomaly, see flow_climatology_years';
+
+-- Years of the flow_climatology table: the entries of a year are computed all at once, when the year is complete
+CREATE TABLE guyane.flow_climatology_years (
+    source_table text NOT NULL,
+    column_name text NOT NULL,
+    nb_days smallint NOT NULL,
+    up_to_year smallint NOT NULL,
+    nb_entries integer NOT NULL,
+    computed_at timestamp with time zone NOT NULL DEFAULT now(),
+    CONSTRAINT flow_climatology_years_pkey PRIMARY KEY (source_table, column_name, nb_days, up_to_year)
+);
+COMMENT ON TABLE guyane.flow_climatology_years
+    IS 'Years computed in the flow_climatology table, per source table, column and window size';
+
+
+-- Invalidate the cached expected values computed from a table (e.g. when its data is fully reloaded). The reference
+-- dates being taken from the mgbstandard table, invalidating mgbstandard invalidates everything
+CREATE OR REPLACE FUNCTION guyane.reset_flow_climatology(_src_tbl regclass)
+RETURNS integer
+AS
+$$
+DECLARE
+	counter integer;
+BEGIN
+    IF _src_tbl = 'guyane.hyfaa_data_mgbstandard'::regclass THEN
+        DELETE FROM guyane.flow_climatology_years;
+        DELETE FROM guyane.flow_climatology;
+    ELSE
+        DELETE FROM guyane.flow_climatology_years WHERE source_table = _src_tbl::text;
+        DELETE FROM guyane.flow_climatology WHERE source_table = _src_tbl::text;
+    END IF;
+    GET DIAGNOSTICS counter = ROW_COUNT;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.reset_flow_climatology(_src_tbl regclass)
+    IS 'Invalidate the cached expected values computed from a table (flow_climatology table). RETURNS the number of deleted entries';
+
+
+-- Invalidate the years of the cache whose data was updated since they were computed: an import rewriting a date of
+-- year Y (of the source table, or of the mgbstandard table, that gives the reference dates) changes the expected
+-- values of the years up to Y, Y + 1... The importers register the dates they write in the dataset_dates catalog
+-- (last_updated column). A year computed in the transaction that updated its data is considered stale too
+-- RETURNS the number of invalidated years
+CREATE OR REPLACE FUNCTION guyane.invalidate_flow_climatology(_src_tbl regclass, _columnname text, _nbdays int)
+RETURNS integer
+AS
+$$
+DECLARE
+	counter integer;
+BEGIN
+    WITH stale AS (
+        DELETE FROM guyane.flow_climatology_years AS y
+        WHERE y.source_table = _src_tbl::text AND y.column_name = _columnname AND y.nb_days = _nbdays
+            AND EXISTS (SELECT 1 FROM guyane.dataset_dates AS c
+                WHERE c.tablename IN ((SELECT relname FROM pg_class WHERE oid = _src_tbl), 'hyfaa_data_mgbstandard')
+                    AND c."date" < make_date(y.up_to_year + 1, 1, 1)
+                    AND c.last_updated >= y.computed_at)
+        RETURNING y.up_to_year
+    ), stale_entries AS (
+        DELETE FROM guyane.flow_climatology AS f
+        USING stale
+        WHERE f.source_table = _src_tbl::text AND f.column_name = _columnname AND f.nb_days = _nbdays
+            AND f.up_to_year = stale.up_to_year
+    )
+    SELECT count(*) INTO counter FROM stale;
+    IF counter > 0 THEN
+        RAISE INFO '[%] Invalidated % year(s) of cached expected values, their data was updated', _src_tbl, counter;
+    END IF;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.invalidate_flow_climatology(_src_tbl regclass, _columnname text, _nbdays int)
+    IS 'Invalidate the cached expected values (flow_climatology table) computed from data updated since then, according
+    to the dataset_dates catalog. RETURNS the number of invalidated years';
+
+
+-- Compute the flow_climatology entries of a year: median of the values of the years up to _up_to_year, for the days of
+-- year _nbdays + 1 .. 366 - _nbdays (the other ones are never read, see compute_expected_and_anomaly)
+-- RETURNS the number of entries
+CREATE OR REPLACE FUNCTION guyane.update_flow_climatology(
+                                                    _src_tbl regclass,
+                                                    _columnname text,
+                                                    _nbdays int,
+                                                    _up_to_year int
+                                                  )
+RETURNS integer
+AS
+$$
+DECLARE
+	ref_dates date[];
+	counter integer;
+BEGIN
+    -- candidate reference dates, listed only once
+    SELECT array_agg(DISTINCT "date") INTO ref_dates FROM guyane.hyfaa_data_mgbstandard
+    WHERE "date" < make_date(_up_to_year + 1, 1, 1);
+
+    DELETE FROM guyane.flow_climatology
+    WHERE source_table = _src_tbl::text AND column_name = _columnname AND nb_days = _nbdays AND up_to_year = _up_to_year;
+    -- each value is used for the days of year doy - _nbdays .. doy + _nbdays
+    EXECUTE format('INSERT INTO guyane.flow_climatology
+            (source_table, column_name, nb_days, up_to_year, day_of_year, cell_id, flow_expected, nb_values)
+        SELECT $1, $2, $3, $4, w.day_of_year, d.cell_id, median(d.%2$I), count(d.%2$I)
+        FROM %1$s AS d
+        JOIN unnest($5::date[]) AS r(s_date) ON d."date" = r.s_date
+        CROSS JOIN LATERAL (SELECT date_part(''doy'', d."date")::integer + k.offset_days AS day_of_year
+            FROM generate_series(-$3, $3) AS k(offset_days)) AS w
+        WHERE d."date" < make_date($4 + 1, 1, 1)
+            AND w.day_of_year BETWEEN $3 + 1 AND 366 - $3
+        GROUP BY w.day_of_year, d.cell_id', _src_tbl, _columnname)
+    USING _src_tbl::text, _columnname, _nbdays, _up_to_year, ref_dates;
+    GET DIAGNOSTICS counter = ROW_COUNT;
+
+    INSERT INTO guyane.flow_climatology_years (source_table, column_name, nb_days, up_to_year, nb_entries)
+    VALUES (_src_tbl::text, _columnname, _nbdays, _up_to_year, counter)
+    ON CONFLICT (source_table, column_name, nb_days, up_to_year) DO UPDATE SET
+        nb_entries = EXCLUDED.nb_entries,
+        computed_at = now();
+    RAISE INFO '[%] Computed the expected values for the years up to %', _src_tbl, _up_to_year;
+    RETURN counter;
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.update_flow_climatology(_src_tbl regclass, _columnname text, _nbdays int, _up_to_year int)
+    IS 'Compute the flow_climatology entries of the years up to _up_to_year (floating median of the _columnname values
+    of _src_tbl, +/- _nbdays around each day of year). RETURNS the number of entries';
+
+
+-- Computes and inserts values for the flow_expected and flow_anomaly columns in _dest_tbl, using the data from _src_tbl
+-- The expected values are retrieved from the flow_climatology cache by an indexed join. The years of the cache needed
+-- by the pending dates are computed first (again, if their data was updated since), if the source data of the year is
+-- complete. The dates the cache can't be
+-- used for (first and last _nbdays days of a year, year following an incomplete one) are computed directly, by
+-- batches of _batch_size dates (set-based, see migration 0058)
+-- RETURNS the number of updated dates
+CREATE OR REPLACE FUNCTION guyane.compute_expected_and_anomaly(
+                                                    _dest_tbl regclass,
+                                                    _src_tbl regclass,
+                                                    _columnname text,
+                                                    _nbdays int default 10,
+                                                    lower_date date default '1950-01-01',
+                                                    _batch_size int default 100
+                                                  )
+RETURNS integer
+AS
+$$
+DECLARE
+	pending_dates date[];
+	cached_dates date[];
+	direct_dates date[];
+	ref_dates date[];
+	last_date date;
+	complete_year integer;
+	y integer;
+	updated boolean;
+	batch date[];
+	i integer;
+BEGIN
+    -- list the dates at which we have some undefined values for 'expected' or 'anomaly' columns
+    EXECUTE format('SELECT array_agg(upt_date ORDER BY upt_date DESC) FROM (
+                        SELECT DISTINCT "date" AS upt_date
+                        FROM %s
+                        WHERE (flow_expected IS NULL OR flow_anomaly IS NULL)
+                        AND "date" > $1::date
+                    ) d', _dest_tbl)
+    INTO pending_dates
+    USING lower_date;
+    IF pending_dates IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    -- last complete year: both the reference dates and the source data cover it
+    SELECT MAX("date") INTO last_date FROM guyane.hyfaa_data_mgbstandard;
+    EXECUTE format('SELECT LEAST(MAX("date"), $1) FROM %s', _src_tbl)
+    INTO last_date
+    USING last_date;
+    complete_year := date_part('year', last_date + 1)::integer - 1;
+
+    -- dates whose window is within their year, and whose previous year is complete: retrieved from the cache
+    SELECT array_agg(p.upt_date ORDER BY p.upt_date DESC) FILTER (WHERE c.cached),
+           array_agg(p.upt_date ORDER BY p.upt_date DESC) FILTER (WHERE NOT c.cached)
+    INTO cached_dates, direct_dates
+    FROM unnest(pending_dates) AS p(upt_date)
+    CROSS JOIN LATERAL (SELECT COALESCE(date_part('year', p.upt_date - _nbdays) = date_part('year', p.upt_date)
+                              AND date_part('year', p.upt_date + _nbdays) = date_part('year', p.upt_date)
+                              AND date_part('year', p.upt_date) - 1 <= complete_year, false) AS cached) AS c;
+
+    IF cached_dates IS NOT NULL THEN
+        -- compute the missing (or invalidated) years of the cache
+        PERFORM guyane.invalidate_flow_climatology(_src_tbl, _columnname, _nbdays);
+        updated := false;
+        FOR y IN SELECT DISTINCT date_part('year', d)::integer - 1 FROM unnest(cached_dates) AS d
+            EXCEPT SELECT up_to_year FROM guyane.flow_climatology_years
+                WHERE source_table = _src_tbl::text AND column_name = _columnname AND nb_days = _nbdays
+            ORDER BY 1
+            LOOP
+                PERFORM guyane.update_flow_climatology(_src_tbl, _columnname, _nbdays, y);
+                updated := true;
+            END LOOP;
+        IF updated THEN
+            -- up-to-date statistics, for the join below
+            ANALYZE guyane.flow_climatology;
+        END IF;
+
+        FOR i IN 1..array_length(cached_dates, 1) BY _batch_size
+            LOOP
+                batch := cached_dates[i:i + _batch_size - 1];
+                EXECUTE format('UPDATE %1$s AS t
+                        SET flow_expected = c.flow_expected,
+                            flow_anomaly = guyane.compute_anomaly(t.%2$I, c.flow_expected)
+                        FROM guyane.flow_climatology AS c
+                        WHERE t."date" = ANY($1::date[])
+                            AND c.source_table = $2 AND c.column_name = $3 AND c.nb_days = $4
+                            AND c.up_to_year = date_part(''year'', t."date")::smallint - 1
+                            AND c.day_of_year = date_part(''doy'', t."date")::smallint
+                            AND c.cell_id = t.cell_id', _dest_tbl, _columnname)
+                USING batch, _src_tbl::text, _columnname, _nbdays;
+                RAISE INFO '[%] Computed flow_expected and flow_anomaly for dates % to %', _dest_tbl, batch[array_length(batch, 1)], batch[1];
+            END LOOP;
+    END IF;
+
+    IF direct_dates IS NOT NULL THEN
+        -- candidate reference dates, listed only once
+        SELECT array_agg(DISTINCT "date") INTO ref_dates FROM guyane.hyfaa_data_mgbstandard;
+
+        FOR i IN 1..array_length(direct_dates, 1) BY _batch_size
+            LOOP
+                batch := direct_dates[i:i + _batch_size - 1];
+                -- 'pairs': (pending date, reference date) couples, from the day-of-year join. 'subq': median value of
+                -- the given field (flow_mean or flow_median, supposedly), per pending date and cell
+                EXECUTE format('UPDATE %1$s AS t
+                        SET flow_expected = subq.median,
+                            flow_anomaly = guyane.compute_anomaly(t.%2$I, subq.median)
+                        FROM (SELECT pairs.upt_date, d.cell_id, median(d.%2$I)
+                            FROM (SELECT DISTINCT p.upt_date, r.s_date
+                                FROM unnest($1::date[]) AS p(upt_date)
+                                CROSS JOIN generate_series(-$2, $2) AS k(offset_days)
+                                JOIN unnest($3::date[]) AS r(s_date)
+                                    ON date_part(''doy'', r.s_date) = date_part(''doy'', p.upt_date + k.offset_days)
+                                    AND r.s_date < p.upt_date - $2
+                                ) AS pairs
+                            JOIN %3$s AS d ON d."date" = pairs.s_date
+                            GROUP BY pairs.upt_date, d.cell_id) AS subq
+                        WHERE t."date" = subq.upt_date
+                            AND t.cell_id = subq.cell_id', _dest_tbl, _columnname, _src_tbl)
+                USING batch, _nbdays, ref_dates;
+                RAISE INFO '[%] Computed flow_expected and flow_anomaly for dates % to % (not cached)', _dest_tbl, batch[array_length(batch, 1)], batch[1];
+            END LOOP;
+    END IF;
+    RETURN array_length(pending_dates, 1);
+END
+$$  LANGUAGE plpgsql;
+COMMENT ON FUNCTION guyane.compute_expected_and_anomaly(_dest_tbl regclass, _src_tbl regclass, _columnname text, _nbdays int, lower_date date, _batch_size int)
+    IS 'Computes and inserts values for the flow_expected and flow_anomaly columns in _dest_tbl.
+    flow_expected is calculated using the floating median from _src_tbl, cached per year in the flow_climatology table
+    flow_anomaly is calculated using the compute_anomaly function, and uses the ''expected'' value
+	_dest_tbl and _src_tbl are usually the same, but can be different (e.g. compute values for forecast data using historical data from assimilated data)
+	The pending dates are processed by batches of _batch_size dates
+    RETURNS the number of updated dates';
+        """),
+    ]
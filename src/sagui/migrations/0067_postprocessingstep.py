@@ -0,0 +1,137 @@
+# Generated by Django 4.0.5 on 2026-10-18 22:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0066_flow_climatology_by_year'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='matviewrefresh',
+            name='matviewrefresh_view_idx',
+        ),
+        migrations.RemoveField(
+            model_name='matviewrefresh',
+            name='method',
+        ),
+        migrations.RenameModel(
+            old_name='MatviewRefresh',
+            new_name='PostProcessingStep',
+        ),
+        migrations.RenameField(
+            model_name='postprocessingstep',
+            old_name='view',
+            new_name='step',
+        ),
+        migrations.AlterField(
+            model_name='postprocessingstep',
+            name='step',
+            field=models.CharField(help_text='Post-processing step (see guyane.post_processing_steps)', max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='postprocessingstep',
+            name='job',
+            field=models.ForeignKey(blank=True, help_text='Post-processing job the step was run for', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='steps', to='sagui.postprocessingjob'),
+        ),
+        migrations.AlterField(
+            model_name='postprocessingstep',
+            name='duration',
+            field=models.FloatField(blank=True, help_text='Duration of the step, in seconds', null=True, verbose_name='Duration'),
+        ),
+        migrations.AlterModelOptions(
+            name='postprocessingstep',
+            options={'ordering': ['-started_at'], 'verbose_name': 'Post-processing step, run by the steps scheduler (sagui.utils.scheduler)'},
+        ),
+        migrations.AlterModelOptions(
+            name='postprocessingjob',
+            options={'ordering': ['-id'], 'verbose_name': 'Post-processing job (expected values, anomaly, aggregates), run by the sagui_worker command'},
+        ),
+        migrations.AddIndex(
+            model_name='postprocessingstep',
+            index=models.Index(fields=['step', '-started_at'], name='postprocessingstep_step_idx'),
+        ),
+        migrations.RunSQL(
+            """
+-- The materialized views refreshed by the scheduler of the sagui_worker command (0061) were replaced by aggregate
+-- tables and plain views (0063 to 0065). The scheduler now runs the post-processing steps listed here, in dependency
+-- order, the independent ones in parallel, and records each step (sagui_postprocessingstep table)
+CREATE OR REPLACE FUNCTION guyane.post_processing_steps(_tablename text)
+RETURNS TABLE(step text, statement text, depends_on text[])
+LANGUAGE plpgsql
+STABLE
+AS $$
+BEGIN
+    -- mgbstandard data
+    IF _tablename LIKE '%data_mgbstandard' THEN
+        RETURN QUERY VALUES
+            ('expected_and_anomaly', 'SELECT guyane.compute_expected_and_anomaly(''guyane.hyfaa_data_mgbstandard'', ''flow_mean'', 10)', '{}'::text[]),
+            ('rolling_aggregates', 'SELECT guyane.update_rolling_aggregates(''mgbstandard'')', '{expected_and_anomaly}');
+    END IF;
+
+    -- assimilated data
+    IF _tablename LIKE '%data_assimilated' THEN
+        RETURN QUERY VALUES
+            ('expected_and_anomaly', 'SELECT guyane.compute_expected_and_anomaly(''guyane.hyfaa_data_assimilated'', ''flow_median'', 10)', '{}'::text[]),
+            ('rolling_aggregates', 'SELECT guyane.update_rolling_aggregates(''assimilated'')', '{expected_and_anomaly}');
+    END IF;
+
+    -- forecast data
+    IF _tablename LIKE '%data_forecast' THEN
+        RETURN QUERY VALUES
+            ('update_forecast', 'SELECT guyane.update_forecast(10)', '{}'::text[]),
+            ('rolling_aggregates', 'SELECT guyane.update_rolling_aggregates(''forecast'')', '{update_forecast}');
+    END IF;
+
+    -- rainfall data
+    IF _tablename LIKE '%_rainfall' THEN
+        RETURN QUERY VALUES
+            ('rolling_aggregates', 'SELECT guyane.update_rolling_aggregates(''rainfall'')', '{}'::text[]);
+    END IF;
+
+    -- geometries
+    IF _tablename IN ('hyfaa_geo_inclusion_mask', 'hyfaa_minibasins_data', 'hyfaa_drainage', 'hyfaa_catchments',
+                      'sagui_saguiconfig') THEN
+        RETURN QUERY VALUES
+            ('aggregate_geometries', 'SELECT guyane.rebuild_aggregate_geometries()', '{}'::text[]);
+    END IF;
+
+    -- views serving the aggregates of the selected dataset (also regenerated by the saguiconfig trigger)
+    IF _tablename = 'sagui_saguiconfig' THEN
+        RETURN QUERY VALUES
+            ('aggregated_geo_views', 'SELECT guyane.update_aggregated_geo_views()', '{aggregate_geometries}'::text[]);
+    END IF;
+
+    -- stations levels, computed from the expected and anomaly values
+    IF _tablename LIKE 'hyfaa_data_%' OR _tablename IN ('hyfaa_stations', 'stations_reference_flow',
+                                                         'stations_reference_flow_period', 'sagui_saguiconfig') THEN
+        RETURN QUERY VALUES
+            ('stations_snapshots', 'SELECT guyane.update_stations_snapshots()', '{expected_and_anomaly,update_forecast}'::text[]);
+    END IF;
+END $$;
+COMMENT ON FUNCTION guyane.post_processing_steps(_tablename text)
+    IS 'Post-processing steps of a table, in dependency order: name, SQL statement, and the steps it depends on (when
+    they are run for this table). Run by the sagui_worker command, or sequentially by run_post_processing';
+
+CREATE OR REPLACE FUNCTION guyane.run_post_processing(_tablename text)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    s record;
+BEGIN
+    FOR s IN SELECT * FROM guyane.post_processing_steps(_tablename) LOOP
+        RAISE INFO 'Post-processing table %: step %. Please wait...', _tablename, s.step;
+        EXECUTE s.statement;
+    END LOOP;
+END $$;
+COMMENT ON FUNCTION guyane.run_post_processing(_tablename text)
+    IS 'Post-processing of a table, once its data has been imported: runs its steps (see post_processing_steps)
+    sequentially, in a single transaction. The sagui_worker command runs them in parallel instead';
+            """),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.0.5 on 2026-10-18 22:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sagui', '0067_postprocessingstep'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postprocessingstep',
+            name='attempts',
+            field=models.SmallIntegerField(default=1, help_text='Nb of attempts: the step is run again when it could not get a lock in time (see the --lock_timeout option of the sagui_worker command)', verbose_name='Attempts'),
+        ),
+        migrations.RunSQL(
+            """
+-- The unique indexes of 0062 allowed refreshing the materialized views read by pg_tileserv CONCURRENTLY. Those views
+-- were replaced (0063 to 0065) by aggregate tables, updated row by row (merge_aggregate_geo: readers are never
+-- blocked), and by the hyfaa_data_aggregated_geo / hyfaa_forecast_aggregated_geo views over them.
+-- CREATE OR REPLACE VIEW takes an ACCESS EXCLUSIVE lock on the view, that waits for the running tile requests and
+-- blocks the next ones meanwhile: the views are now only replaced when the selected dataset changes
+CREATE OR REPLACE FUNCTION guyane.update_aggregated_geo_views()
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+	dataset TEXT;
+	view_name TEXT;
+	source_table TEXT;
+BEGIN
+	SELECT COALESCE((SELECT use_dataset FROM guyane.sagui_saguiconfig LIMIT 1), 'assimilated') INTO dataset;
+	IF dataset NOT IN ('assimilated', 'mgbstandard') THEN
+	    RAISE EXCEPTION 'Unknown dataset %', dataset;
+	END IF;
+
+	FOR view_name, source_table IN VALUES ('hyfaa_data_aggregated_geo', 'hyfaa_data_with_' || dataset || '_aggregate_geo'),
+	                                      ('hyfaa_forecast_aggregated_geo', 'hyfaa_forecast_with_' || dataset || '_aggregate_geo')
+	LOOP
+	    -- is the view already reading from the source table ?
+	    IF EXISTS (
+	        SELECT 1 FROM pg_rewrite r
+	        JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass AND d.objid = r.oid
+	        WHERE r.ev_class = to_regclass(format('guyane.%I', view_name))
+	          AND d.refobjid = to_regclass(format('guyane.%I', source_table))
+	    ) THEN
+	        CONTINUE;
+	    END IF;
+	    RAISE INFO 'Aggregated geo views: % now using dataset %', view_name, dataset;
+	    EXECUTE format('CREATE OR REPLACE VIEW guyane.%I AS SELECT cell_id, "values", width, depth, geom FROM guyane.%I',
+	                   view_name, source_table);
+	    -- (the comment and privileges of the view are kept)
+	END LOOP;
+END $$;
+COMMENT ON FUNCTION guyane.update_aggregated_geo_views()
+    IS 'Regenerate the hyfaa_data_aggregated_geo and hyfaa_forecast_aggregated_geo views, if they don''t use the dataset
+    selected in saguiconfig table yet';
+            """),
+    ]
@@ -1,3 +1,5 @@
+import os
+
 from django.db import models
 from django.contrib.gis.db import models as geomodels
 from colorfield.fields import ColorField
@@ -274,9 +276,11 @@ class StationsWithFlowAlerts(geomodels.Model):
     minibasin = models.IntegerField(null=False)
     levels = models.JSONField()
     geom = geomodels.PointField(null=True)
+    computed_at = models.DateTimeField("Computed at",
+                                       help_text="Time the snapshot was computed (by the post-processing)")
 
     class Meta:
-        verbose_name = 'Stations with alert codes (View)'
+        verbose_name = 'Stations with alert codes (Snapshot)'
         db_table = 'stations_with_flow_alerts'
         managed = False
         ordering = ['id']
@@ -292,9 +296,11 @@ class StationsWithFlowPrevi(geomodels.Model):
     minibasin = models.IntegerField(null=False)
     levels = models.JSONField()
     geom = geomodels.PointField(null=True)
+    computed_at = models.DateTimeField("Computed at",
+                                       help_text="Time the snapshot was computed (by the post-processing)")
 
     class Meta:
-        verbose_name = 'Stations with previ codes (View)'
+        verbose_name = 'Stations with previ codes (Snapshot)'
         db_table = 'stations_with_flow_previ'
         managed = False
         ordering = ['id']
@@ -324,6 +330,168 @@ class ImportState(models.Model):
         return '{}: {} ({} JD), {} errors'.format(self.tablename, self.last_updated, self.last_updated_jd, self.update_errors)
 
 
+class ImportProgress(models.Model):
+    tablename = models.CharField(max_length=50, null=False, primary_key=True)
+    last_committed_index = models.IntegerField("Last committed time index", null=True, blank=True,
+            help_text='Index (in the netcdf file) of the last time value committed into the DB during the current import')
+    last_committed_jd = models.FloatField('Last committed time in Julian days', null=True, blank=True,
+            help_text='Last time value committed into the DB during the current import. In CNES Julian days (0 is 01/01/1950)')
+    pages_committed = models.IntegerField("Pages committed", default=0,
+            help_text='Nb of pages committed during the current import')
+    update_errors = models.SmallIntegerField("Update errors", default=0,
+            help_text='Nb of errors during the current import (reset once the failed pages are committed, on resume)')
+    finished = models.BooleanField("Finished", default=False,
+            help_text='Whether the import completed (and the import state was updated)')
+    started_at = models.DateTimeField("Started at", null=True, blank=True,
+            help_text='Start time of the current import')
+    updated_at = models.DateTimeField("Updated at", auto_now=True,
+            help_text='Time of the last checkpoint')
+
+    class Meta:
+        verbose_name = 'Checkpoints of the current (or last) HYFAA import, per table'
+        ordering = ['tablename']
+
+    def __str__(self):
+        return '{}: index {} ({} pages), {} errors{}'.format(self.tablename, self.last_committed_index,
+                                                              self.pages_committed, self.update_errors,
+                                                              ' (finished)' if self.finished else '')
+
+
+class PostProcessingJob(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    tablename = models.CharField(max_length=50, null=False,
+            help_text='Table whose import triggered the post-processing (cf sagui_importstate)')
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = models.SmallIntegerField("Attempts", default=0, help_text='Nb of times the job was run')
+    created_at = models.DateTimeField("Created at", auto_now_add=True)
+    run_after = models.DateTimeField("Run after", null=True, blank=True,
+            help_text='If set, the job will not be run before this time (retry delay)')
+    started_at = models.DateTimeField("Started at", null=True, blank=True, help_text='Start time of the last attempt')
+    finished_at = models.DateTimeField("Finished at", null=True, blank=True, help_text='End time of the last attempt')
+    duration = models.FloatField("Duration", null=True, blank=True, help_text='Duration of the last attempt, in seconds')
+    worker_pid = models.IntegerField("Worker PID", null=True, blank=True,
+            help_text='DB backend PID of the worker running the job (used to detect the jobs of crashed workers)')
+    last_error = models.TextField("Last error", default='', blank=True)
+
+    class Meta:
+        verbose_name = 'Post-processing job (expected values, anomaly, aggregates), run by the sagui_worker command'
+        ordering = ['-id']
+        constraints = [
+            # Deduplication: only one pending job per table
+            models.UniqueConstraint(fields=['tablename'], condition=models.Q(status='pending'),
+                                    name='postprocessingjob_unique_pending_table'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'id'], name='postprocessingjob_status_idx'),
+        ]
+
+    def __str__(self):
+        return '#{} {}: {} ({} attempts, {} s)'.format(self.id, self.tablename, self.status, self.attempts, self.duration)
+
+
+class PostProcessingStep(models.Model):
+    class Status(models.TextChoices):
+        DONE = 'done'
+        FAILED = 'failed'
+        SKIPPED = 'skipped'
+
+    step = models.CharField(max_length=50, null=False, help_text='Post-processing step (see guyane.post_processing_steps)')
+    job = models.ForeignKey(PostProcessingJob, on_delete=models.SET_NULL, null=True, blank=True,
+            related_name='steps', help_text='Post-processing job the step was run for')
+    status = models.CharField(max_length=10, choices=Status.choices)
+    started_at = models.DateTimeField("Started at")
+    duration = models.FloatField("Duration", null=True, blank=True, help_text='Duration of the step, in seconds')
+    attempts = models.SmallIntegerField("Attempts", default=1,
+            help_text='Nb of attempts: the step is run again when it could not get a lock in time (see the '
+                      '--lock_timeout option of the sagui_worker command)')
+    error = models.TextField("Error", default='', blank=True)
+
+    class Meta:
+        verbose_name = 'Post-processing step, run by the steps scheduler (sagui.utils.scheduler)'
+        ordering = ['-started_at']
+        indexes = [
+            models.Index(fields=['step', '-started_at'], name='postprocessingstep_step_idx'),
+        ]
+
+    def __str__(self):
+        return '{} {}: {} ({} s)'.format(self.started_at, self.step, self.status, self.duration)
+
+
+class FilesManifestFolder(models.Model):
+    path = models.CharField(max_length=500, null=False, primary_key=True)
+    kind = models.CharField(max_length=20, null=False, help_text='Kind of files stored in the folder (rainfall, atmo)')
+    mtime_watermark = models.FloatField("Folder mtime watermark", null=True, blank=True,
+            help_text='Modification time (seconds since epoch) of the folder when it was last scanned. The folder is '
+                      'not scanned again as long as its modification time is unchanged')
+    last_scan = models.DateTimeField("Last scan", null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Folder whose files are listed in the files manifest'
+        ordering = ['path']
+
+    def __str__(self):
+        return '{} ({})'.format(self.path, self.kind)
+
+
+class FilesManifest(models.Model):
+    class ImportStatus(models.TextChoices):
+        NEW = 'new'
+        IMPORTED = 'imported'
+
+    folder = models.ForeignKey(FilesManifestFolder, on_delete=models.CASCADE, related_name='files')
+    name = models.CharField(max_length=255, null=False, help_text='File name')
+    file_date = models.DateTimeField("File date", null=True, blank=True,
+            help_text='Date of the data, parsed from the file name')
+    version = models.CharField("Version stamp", max_length=20, default='', blank=True,
+            help_text='Version stamp parsed from the file name (e.g. download date of the rainfall files), if any')
+    size = models.BigIntegerField("Size", help_text='File size, in bytes')
+    mtime = models.FloatField("Modification time", help_text='File modification time (seconds since epoch)')
+    import_status = models.CharField(max_length=10, choices=ImportStatus.choices, default=ImportStatus.NEW)
+    imported_at = models.DateTimeField("Imported at", null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Manifest of the input files (rainfall netcdf files, atmo images), maintained incrementally'
+        ordering = ['folder', 'name']
+        constraints = [
+            models.UniqueConstraint(fields=['folder', 'name'], name='filesmanifest_unique_folder_name'),
+        ]
+        indexes = [
+            models.Index(fields=['folder', 'version'], name='filesmanifest_version_idx'),
+            models.Index(fields=['folder', 'file_date'], name='filesmanifest_file_date_idx'),
+        ]
+
+    @property
+    def path(self):
+        return os.path.join(self.folder_id, self.name)
+
+    def __str__(self):
+        return '{} ({})'.format(self.path, self.import_status)
+
+
+class DatasetDate(models.Model):
+    tablename = models.CharField(max_length=50, null=False, help_text='Data table (cf sagui_importstate)')
+    date = models.DateField("Date", null=False, help_text='Date for which the table holds data')
+    first_imported = models.DateTimeField("First imported", help_text='Time the data for this date was first imported')
+    last_updated = models.DateTimeField("Last updated", help_text='Time the data for this date was last written')
+
+    class Meta:
+        db_table = 'dataset_dates'
+        verbose_name = 'Catalog of the dates available in the data tables, maintained by the importers'
+        ordering = ['tablename', '-date']
+        constraints = [
+            # Also serves the "n latest dates of a table" queries (backward index scan)
+            models.UniqueConstraint(fields=['tablename', 'date'], name='datasetdate_unique_table_date'),
+        ]
+
+    def __str__(self):
+        return '{}: {}'.format(self.tablename, self.date)
+
+
 class AtmoAlertCategories(models.Model):
     label = models.CharField(max_length=50, null=False, primary_key=True)
     label_fr = models.CharField(max_length=50, null=False, default='', blank=True)
@@ -0,0 +1,99 @@
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
+
+from sagui.utils import anomaly
+
+
+class ComputeAnomalyTest(SimpleTestCase):
+
+    def test_formula(self):
+        # 200 * (current - expected) / (current + expected), like guyane.compute_anomaly
+        current = np.array([150, 100, 50, 0, 0, 10, np.nan, 100])
+        expected = np.array([100, 100, 150, 100, 0, 0, 100, np.nan])
+        np.testing.assert_allclose(anomaly.compute_anomaly(current, expected),
+                                   [40, 0, -100, -200, 0, 200, np.nan, np.nan])
+
+
+class HistoryCubeTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cube = anomaly.HistoryCube.create(self.directory, 'hyfaa_data_mgbstandard', 'flow_mean', 3, 2020, 2020)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_expected(self):
+        # 2022-06-15, window of +/- 1 day: days of year 165-167, before 2022-06-14.
+        # 2020 is a leap year: the days of year 165-167 are 2020-06-13..15
+        self.cube.update([1, 1, 1, 1, 1, 1], np.array(['2020-06-13', '2020-06-14', '2020-06-15',
+                                                       '2021-06-14', '2021-06-15', '2021-06-16'], dtype='datetime64[D]'),
+                         [1., 2., 3., 4., 5., 6.])
+        self.cube.update([1, 1, 2, 2, 2], np.array(['2022-06-15', '2021-06-13', '2021-06-13', '2021-06-15', '2022-06-14'],
+                                                   dtype='datetime64[D]'),
+                         # not in the window, or too recent
+                         [100., 100., 100., 10., 100.])
+        self.assertEqual((self.cube.first_year, self.cube.last_year), (2020, 2022))
+        np.testing.assert_array_equal(self.cube.expected(np.array(['2022-06-15'], dtype='datetime64[D]'), [1, 2, 3], 1),
+                                      [[3.5, 10, np.nan]])
+        # no previous year
+        np.testing.assert_array_equal(self.cube.expected(np.array(['2020-06-15'], dtype='datetime64[D]'), [1], 1),
+                                      [[np.nan]])
+
+    def test_expected_and_anomaly(self):
+        self.cube.update([1, 1, 2], np.array(['2020-01-01', '2021-01-01', '2021-01-02'], dtype='datetime64[D]'),
+                         [100., 200., 0.])
+        page = pd.DataFrame({'cell_id': [1, 2, 1],
+                             'date': pd.to_datetime(['2022-01-01', '2022-01-01', '2022-01-02']),
+                             'flow_mean': [50., 0., 450.]})
+        expected, flow_anomaly = anomaly.expected_and_anomaly(page, self.cube, 'flow_mean', nb_days=0)
+        np.testing.assert_array_equal(expected, [150., np.nan, np.nan])
+        np.testing.assert_allclose(flow_anomaly, [-100., np.nan, np.nan])
+        # the page is stored into the cube
+        self.assertEqual(self.cube.data[2, 1, 0], 450.)
+        expected, flow_anomaly = anomaly.expected_and_anomaly(page.iloc[[0]], self.cube, 'flow_mean', nb_days=1)
+        # days of year 365, 1 and 2 before 2021-12-31: 100 and 200 (the 2022 values are too recent)
+        np.testing.assert_array_equal(expected, [150.])
+
+    def test_commit(self):
+        dates = np.array(['2020-03-01', '2020-03-02'], dtype='datetime64[D]')
+        self.cube.update([1, 2], dates, [1., 2.])
+        # staged: not in the file yet
+        reopened = anomaly.HistoryCube.open(self.directory, 'hyfaa_data_mgbstandard', 'flow_mean', 3)
+        self.assertTrue(np.isnan(reopened.data).all())
+        self.cube.commit(['2022-01-01T00:00:00+00:00', 2])
+        reopened = anomaly.HistoryCube.open(self.directory, 'hyfaa_data_mgbstandard', 'flow_mean', 3)
+        self.assertEqual(reopened.data[0, 60, 0], 1.)
+        self.assertEqual(reopened.data[0, 61, 1], 2.)
+        self.assertEqual(reopened.watermark, ['2022-01-01T00:00:00+00:00', 2])
+
+    def test_discard(self):
+        date = np.array(['2020-03-01'], dtype='datetime64[D]')
+        self.cube.update([1], date, [1.])
+        self.cube.commit()
+        self.cube.update([1, 1], np.repeat(date, 2), [2., 3.])
+        self.cube.update([2], np.array(['2022-03-01'], dtype='datetime64[D]'), [4.])
+        self.assertEqual(self.cube.data[0, 60, 0], 3.)
+        self.cube.discard()
+        self.assertEqual(self.cube.data[0, 60, 0], 1.)
+        self.assertTrue(np.isnan(self.cube.data[2]).all())
+        self.cube.commit()
+        reopened = anomaly.HistoryCube.open(self.directory, 'hyfaa_data_mgbstandard', 'flow_mean', 3)
+        self.assertEqual(reopened.data[0, 60, 0], 1.)
+        self.assertTrue(np.isnan(reopened.data[2]).all())
+
+    def test_grow_with_staged_updates(self):
+        self.cube.update([1], np.array(['2020-01-01'], dtype='datetime64[D]'), [1.])
+        # the cube is grown (new file) while the 2019 value is staged
+        self.cube.update([1, 2], np.array(['2019-01-01', '2021-01-01'], dtype='datetime64[D]'), [2., 3.])
+        self.assertEqual((self.cube.first_year, self.cube.last_year), (2019, 2021))
+        np.testing.assert_array_equal(self.cube.data[:, 0, :2], [[2., np.nan], [1., np.nan], [np.nan, 3.]])
+        reopened = anomaly.HistoryCube.open(self.directory, 'hyfaa_data_mgbstandard', 'flow_mean', 3)
+        self.assertTrue(np.isnan(reopened.data).all())
+        self.cube.commit()
+        reopened = anomaly.HistoryCube.open(self.directory, 'hyfaa_data_mgbstandard', 'flow_mean', 3)
+        np.testing.assert_array_equal(reopened.data[:, 0, :2], [[2., np.nan], [1., np.nan], [np.nan, 3.]])
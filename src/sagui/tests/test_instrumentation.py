@@ -0,0 +1,57 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from sagui.utils.instrumentation import StageTimer
+
+
+class StageTimerTest(SimpleTestCase):
+
+    def test_stage(self):
+        timer = StageTimer()
+        with timer.stage('read', rows=10, nbytes=100):
+            pass
+        with timer.stage('read') as counter:
+            # the amount of data can be set once it is known
+            counter.rows += 5
+            counter.nbytes = 50
+        read = timer.stages['read']
+        self.assertEqual((read.calls, read.rows, read.nbytes), (2, 15, 150))
+        self.assertGreaterEqual(read.time, 0)
+
+    def test_exception(self):
+        # the stage is timed even if the block fails
+        timer = StageTimer()
+        with self.assertRaises(ValueError):
+            with timer.stage('write') as counter:
+                counter.rows = 3
+                raise ValueError()
+        self.assertEqual((timer.stages['write'].calls, timer.stages['write'].rows), (1, 3))
+
+    def test_threads(self):
+        timer = StageTimer()
+
+        def work():
+            for _ in range(1000):
+                timer.add('read', 0.001, rows=1, nbytes=8)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        read = timer.stages['read']
+        self.assertEqual((read.calls, read.rows, read.nbytes), (8000, 8000, 64000))
+        self.assertAlmostEqual(read.time, 8)
+
+    def test_report(self):
+        self.assertEqual(StageTimer().report(), 'No stage was timed')
+        timer = StageTimer()
+        timer.add('custom', 1)
+        timer.add('write', 2, rows=1000, nbytes=4e6)
+        timer.add('read', 1, rows=1000)
+        lines = timer.report().split('\n')
+        # known stages first, in the STAGES order, then the others
+        self.assertEqual([line.split()[0] for line in lines], ['stage', 'read', 'write', 'custom'])
+        self.assertEqual(lines[2].split(), ['write', '2.00', '50.0%', '1000', '500', '2.0'])
+        self.assertEqual(lines[3].split(), ['custom', '1.00', '25.0%'])
@@ -0,0 +1,156 @@
+import struct
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from sagui.utils import db as db_utils, pgcopy
+
+# Python decoders of the binary representation of the supported types
+DECODERS = {
+    'bool': lambda b: struct.unpack('>?', b)[0],
+    'int2': lambda b: struct.unpack('>h', b)[0],
+    'int4': lambda b: struct.unpack('>i', b)[0],
+    'int8': lambda b: struct.unpack('>q', b)[0],
+    'float4': lambda b: struct.unpack('>f', b)[0],
+    'float8': lambda b: struct.unpack('>d', b)[0],
+    'date': lambda b: date(2000, 1, 1) + timedelta(days=struct.unpack('>i', b)[0]),
+    'timestamp': lambda b: datetime(2000, 1, 1) + timedelta(microseconds=struct.unpack('>q', b)[0]),
+    'timestamptz': lambda b: datetime(2000, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=struct.unpack('>q', b)[0]),
+}
+
+
+def decode(data, types):
+    """
+    Decode a binary COPY stream, as PostgreSQL would
+    Returns: the list of the rows (tuples, None for NULL values)
+    """
+    data = bytes(data)
+    assert data[:len(pgcopy.HEADER)] == pgcopy.HEADER, 'bad header'
+    pos, rows = len(pgcopy.HEADER), []
+    while True:
+        nb_fields, = struct.unpack_from('>h', data, pos)
+        pos += 2
+        if nb_fields == -1:
+            assert pos == len(data), 'data after the trailer'
+            return rows
+        assert nb_fields == len(types), 'bad nb of fields'
+        row = []
+        for t in types:
+            length, = struct.unpack_from('>i', data, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(DECODERS[t](data[pos:pos + length]))
+            pos += length
+        rows.append(tuple(row))
+
+
+def encode(blocks, types, **kwargs):
+    return b''.join(bytes(b) for b in pgcopy.encode(blocks, types, **kwargs))
+
+
+class EncodeTest(SimpleTestCase):
+
+    def test_empty(self):
+        self.assertEqual(encode([], ['int4']), pgcopy.HEADER + pgcopy.TRAILER)
+        self.assertEqual(decode(encode([[np.array([], dtype='i4')]], ['int4']), ['int4']), [])
+
+    def test_types(self):
+        types = ['bool', 'int2', 'int4', 'int8', 'float4', 'float8', 'date', 'timestamp', 'timestamptz']
+        arrays = [
+            np.array([True, False]),
+            np.array([-3, 32767], dtype='i2'),
+            np.array([-2 ** 31, 42], dtype='i4'),
+            np.array([2 ** 40, -1], dtype='i8'),
+            np.array([1.5, -0.25], dtype='f4'),
+            np.array([1e300, -3.125]),
+            np.array(['1950-01-01', '2023-03-21'], dtype='datetime64[D]'),
+            np.array(['2023-03-21T10:30:00.000001', '1999-12-31T23:59:59'], dtype='datetime64[us]'),
+            np.array(['2023-03-21T10:30:00', '2000-01-01T00:00:00'], dtype='datetime64[s]'),
+        ]
+        self.assertEqual(decode(encode([arrays], types), types), [
+            (True, -3, -2 ** 31, 2 ** 40, 1.5, 1e300, date(1950, 1, 1), datetime(2023, 3, 21, 10, 30, 0, 1),
+             datetime(2023, 3, 21, 10, 30, tzinfo=timezone.utc)),
+            (False, 32767, 42, -1, -0.25, -3.125, date(2023, 3, 21), datetime(1999, 12, 31, 23, 59, 59),
+             datetime(2000, 1, 1, tzinfo=timezone.utc)),
+        ])
+
+    def test_conversions(self):
+        # the values are converted to the type of the destination column
+        types = ['int2', 'float4', 'date']
+        arrays = [np.array([1.0, 2.0]), np.array([1, 2], dtype='i8'),
+                  np.array(['2020-01-01T12:00', '2020-01-02T23:59'], dtype='datetime64[m]')]
+        self.assertEqual(decode(encode([arrays], types), types),
+                         [(1, 1.0, date(2020, 1, 1)), (2, 2.0, date(2020, 1, 2))])
+
+    def test_pg_epoch(self):
+        # dates and timestamps are relative to 2000-01-01
+        dates = np.array(['2000-01-01', '1999-12-31', '2000-01-02'], dtype='datetime64[D]')
+        data = encode([[dates]], ['date'])
+        values = [struct.unpack_from('>i', data, len(pgcopy.HEADER) + 2 + 4 + i * 10)[0] for i in range(3)]
+        self.assertEqual(values, [0, -1, 1])
+        data = encode([[np.array(['2000-01-01T00:00:01'], dtype='datetime64[s]')]], ['timestamp'])
+        self.assertEqual(struct.unpack_from('>q', data, len(pgcopy.HEADER) + 2 + 4)[0], 1000000)
+
+    def test_nulls(self):
+        types = ['float8', 'int4', 'date', 'int2', 'bool']
+        arrays = [
+            np.array([np.nan, 1.5, 2.5]),
+            np.array([1.0, np.nan, 3.0]),
+            np.array(['2020-01-01', 'NaT', '2020-01-03'], dtype='datetime64[D]'),
+            np.array([None, 5, float('nan')], dtype=object),
+            np.array([True, True, False]),
+        ]
+        self.assertEqual(decode(encode([arrays], types), types), [
+            (None, 1, date(2020, 1, 1), None, True),
+            (1.5, None, None, 5, True),
+            (2.5, 3, date(2020, 1, 3), None, False),
+        ])
+
+    def test_all_nulls(self):
+        arrays = [np.array([np.nan, np.nan]), np.array(['NaT', 'NaT'], dtype='datetime64[D]')]
+        self.assertEqual(decode(encode([arrays], ['float8', 'date']), ['float8', 'date']), [(None, None)] * 2)
+
+    def test_chunks(self):
+        # several blocks, split into chunks of 3 rows: fixed-width chunks (no NULL) and variable-width ones
+        types = ['int4', 'float8']
+        values = [float(i) if i % 7 else np.nan for i in range(1, 11)]
+        blocks = [[np.arange(1, 6, dtype='i4'), np.array(values[:5])],
+                  [np.arange(6, 11, dtype='i4'), np.array(values[5:])]]
+        expected = [(i, None if i % 7 == 0 else float(i)) for i in range(1, 11)]
+        self.assertEqual(decode(encode(blocks, types, chunk_rows=3), types), expected)
+        self.assertEqual(encode(blocks, types, chunk_rows=3), encode(blocks, types))
+        # one chunk per encoded part
+        self.assertEqual(len(list(pgcopy.encode(blocks, types, chunk_rows=3))), 1 + 2 + 2 + 1)
+
+    def test_supported(self):
+        self.assertTrue(pgcopy.supported(['int2', 'date', 'timestamptz', 'float8']))
+        self.assertFalse(pgcopy.supported(['int2', 'text']))
+
+
+class CopyStreamTest(SimpleTestCase):
+
+    def test_read(self):
+        parts = [b'abc', b'', b'defgh', b'i']
+        self.assertEqual(pgcopy.CopyStream(parts).read(), b'abcdefghi')
+        stream = pgcopy.CopyStream(parts)
+        self.assertEqual([stream.read(2) for _ in range(6)], [b'ab', b'cd', b'ef', b'gh', b'i', b''])
+
+    def test_encoded(self):
+        blocks = [[np.arange(1000, dtype='i4'), np.linspace(0, 1, 1000)]]
+        stream = pgcopy.CopyStream(pgcopy.encode(blocks, ['int4', 'float8'], chunk_rows=100))
+        data = b''.join(iter(lambda: stream.read(8192), b''))
+        self.assertEqual(data, encode(blocks, ['int4', 'float8']))
+
+    def test_csv_fallback(self):
+        class Cursor:
+            def copy_expert(self, sql, file, size):
+                self.sql, self.data = sql, b''.join(iter(lambda: file.read(size), b''))
+
+        cursor = Cursor()
+        blocks = [[np.array([1, 2]), np.array([0.5, np.nan])], [np.array([3]), np.array([1.5])]]
+        db_utils.copy_blocks(cursor, 'guyane.t', ['cell_id', 'flow'], blocks, binary=False)
+        self.assertIn('FORMAT csv', cursor.sql)
+        self.assertEqual(cursor.data, b'1,0.5\n2,\n3,1.5\n')
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from sagui.utils.pipeline import Pipeline
+
+
+class PipelineTest(SimpleTestCase):
+
+    def test_order(self):
+        pipeline = Pipeline(range(20), queue_depth=3)
+        self.assertEqual(list(pipeline), list(range(20)))
+        self.assertEqual(pipeline.nb_items, 20)
+        self.assertIn('20 pages', pipeline.summary())
+
+    def test_reader_thread(self):
+        threads = []
+
+        def producer():
+            for i in range(3):
+                threads.append(threading.current_thread())
+                yield i
+
+        self.assertEqual(list(Pipeline(producer())), [0, 1, 2])
+        self.assertTrue(all(t is not threading.main_thread() for t in threads))
+
+    def test_bounded_queue(self):
+        produced = []
+
+        def producer():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        for item in Pipeline(producer(), queue_depth=2):
+            # let the reader run ahead: it is blocked once the queue is full
+            time.sleep(0.2)
+            # queued items + the one waiting to be queued + the one being consumed
+            self.assertLessEqual(len(produced), item + 1 + 2 + 1)
+            if item == 3:
+                break
+
+    def test_early_exit(self):
+        # the reader is stopped when the consumer stops iterating
+        pipeline = Pipeline(iter(range(1000)), queue_depth=2)
+        for item in pipeline:
+            if item == 5:
+                break
+        self.assertFalse(any(t.name == 'pipeline-reader' for t in threading.enumerate()))
+
+    def test_producer_error(self):
+        def producer():
+            yield 1
+            yield 2
+            raise ValueError('decoding error')
+
+        items = []
+        with self.assertRaisesMessage(ValueError, 'decoding error'):
+            for item in Pipeline(producer()):
+                items.append(item)
+        # the items produced before the error are consumed first
+        self.assertEqual(items, [1, 2])
+
+    def test_consumer_error(self):
+        with self.assertRaises(RuntimeError):
+            for item in Pipeline(range(1000)):
+                raise RuntimeError('write error')
+        self.assertFalse(any(t.name == 'pipeline-reader' for t in threading.enumerate()))
@@ -0,0 +1,60 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from sagui.utils.scheduler import schedule
+
+
+class ScheduleTest(SimpleTestCase):
+
+    def test_order(self):
+        done = []
+        lock = threading.Lock()
+
+        def run(task):
+            with lock:
+                done.append(task)
+            return True
+
+        dependencies = {
+            'expected_and_anomaly': set(),
+            'rolling_aggregates': {'expected_and_anomaly'},
+            'stations_snapshots': {'expected_and_anomaly'},
+        }
+        results = schedule(dependencies, run)
+        self.assertEqual(done[0], 'expected_and_anomaly')
+        self.assertEqual(set(done), set(dependencies))
+        self.assertTrue(all(results.values()))
+
+    def test_parallel(self):
+        threads = set()
+
+        def run(task):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.2)
+            return True
+
+        start = time.perf_counter()
+        schedule({'a': set(), 'b': set(), 'c': set()}, run, max_workers=3)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(len(threads), 3)
+
+    def test_failure(self):
+        def run(task):
+            if task == 'b':
+                raise RuntimeError('step error')
+            return task != 'a'
+
+        results = schedule({'a': set(), 'b': set(), 'c': {'a'}, 'd': {'c'}, 'e': set()}, run)
+        self.assertEqual(results, {'a': False, 'b': False, 'c': None, 'd': None, 'e': True})
+
+    def test_unknown_dependency(self):
+        # dependencies on steps not run for this table are ignored
+        results = schedule({'rolling_aggregates': {'update_forecast'}}, lambda task: True)
+        self.assertEqual(results, {'rolling_aggregates': True})
+
+    def test_on_done(self):
+        calls = []
+        schedule({'a': set(), 'b': {'a'}}, lambda task: task == 'a', on_done=lambda *args: calls.append(args))
+        self.assertEqual(calls, [('a', True), ('b', False)])
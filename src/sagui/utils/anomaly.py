@@ -0,0 +1,275 @@
+"""
+Numpy engine computing the expected values (floating median over the previous years) and the anomaly during the
+import (hyfaa_import --anomaly_engine numpy), instead of the PL/pgSQL post-processing (compute_expected_and_anomaly).
+The source values of a table are kept in a history cube, indexed by (year, day of year, cell), held as a memory-mapped
+.npy file: the cube is loaded from the DB on the first run, then maintained with the imported pages. The values of a
+page are written to the file only once the page is committed into the DB, along with a watermark of the table (see
+sagui.utils.db.dataset_watermark): a cube whose watermark doesn't match the table is loaded again.
+Same definition as the SQL function: the expected value of a cell at date D is the median of its values at the dates
+S such that doy(S) is the day of year of one of the dates D-nbdays..D+nbdays, and S < D - nbdays. The anomaly is
+computed like guyane.compute_anomaly (symmetric relative difference, see 0041_fix_anomaly_calculation).
+Difference with the SQL function: the SQL function only considers the dates present in the mgbstandard table, the
+numpy engine considers the dates present in the source table
+"""
+
+import json
+import os
+import warnings
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+# Column the expected value is computed from, for each table (cf guyane.run_post_processing)
+SOURCE_COLUMNS = {
+    'hyfaa_data_mgbstandard': 'flow_mean',
+    'hyfaa_data_assimilated': 'flow_median',
+}
+
+# Half-width of the floating window, in days (cf guyane.run_post_processing)
+NB_DAYS = 10
+
+
+def compute_anomaly(current, expected):
+    """
+    Anomaly formula, vectorized version of guyane.compute_anomaly: 200 * (current - expected) / (current + expected),
+    0 when current + expected = 0. NaN (NULL) if one of the values is NaN
+    """
+    current, expected = np.asarray(current, dtype='f8'), np.asarray(expected, dtype='f8')
+    total = current + expected
+    with np.errstate(divide='ignore', invalid='ignore'):
+        anomaly = 200 * (current - expected) / total
+    return np.where(total == 0, 0., anomaly)
+
+
+def _years_and_doys(dates):
+    """
+    Returns: the years and the days of year (1-366) of a datetime64 array
+    """
+    dates = np.asarray(dates).astype('datetime64[D]')
+    years = dates.astype('datetime64[Y]')
+    return years.astype(int) + 1970, (dates - years.astype('datetime64[D]')).astype(int) + 1
+
+
+class HistoryCube:
+    """
+    Source values of a table, as a (year, day of year, cell) float64 array, memory-mapped from a .npy file. Missing
+    values are NaN. The first year and the watermark are stored in a .json file along with the .npy file.
+    The updates are staged in a private, copy-on-write mapping of the file: they are written to the file by commit(),
+    or reverted by discard()
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        with open(path + '.json') as f:
+            self.meta = json.load(f)
+        self.first_year = self.meta['first_year']
+        # staged updates: (years, days of year, cell ids, values, previous values) arrays
+        self._staged = []
+        self._map()
+
+    def _map(self):
+        self.data = np.load(self.path + '.npy', mmap_mode='c')
+        # readonly: the changes are never written to the file
+        self._file = None if self.readonly else np.load(self.path + '.npy', mmap_mode='r+')
+
+    @property
+    def nb_cells(self):
+        return self.data.shape[2]
+
+    @property
+    def watermark(self):
+        """
+        State of the DB table when the cube was last committed (see commit)
+        """
+        return self.meta.get('watermark')
+
+    @classmethod
+    def path_for(cls, directory, tablename, column):
+        return os.path.join(directory, '{}_{}'.format(tablename, column))
+
+    @classmethod
+    def open(cls, directory, tablename, column, nb_cells, readonly=False):
+        """
+        Open the cube of a table's column
+        Returns: the cube, or None if there is none or if it does not have the expected nb of cells
+        """
+        path = cls.path_for(directory, tablename, column)
+        if not (os.path.exists(path + '.npy') and os.path.exists(path + '.json')):
+            return None
+        cube = cls(path, readonly=readonly)
+        return cube if cube.nb_cells == nb_cells else None
+
+    @classmethod
+    def create(cls, directory, tablename, column, nb_cells, first_year, last_year, readonly=False):
+        """
+        Create an empty cube (replacing the existing one, if any)
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = cls.path_for(directory, tablename, column)
+        data = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype='f8',
+                                         shape=(last_year - first_year + 1, 366, nb_cells))
+        data[:] = np.nan
+        data.flush()
+        del data
+        with open(path + '.json', 'w') as f:
+            json.dump({'tablename': tablename, 'column': column, 'first_year': first_year, 'watermark': None}, f)
+        return cls(path, readonly=readonly)
+
+    @property
+    def last_year(self):
+        return self.first_year + self.data.shape[0] - 1
+
+    def ensure_years(self, first_year, last_year):
+        """
+        Grow the cube so that it covers the first_year..last_year range. The grown cube is written to a new file (with
+        the committed values), then swapped with the current one. The staged updates are kept
+        """
+        first_year = min(first_year, self.first_year)
+        last_year = max(last_year, self.last_year)
+        if (first_year, last_year) == (self.first_year, self.last_year):
+            return
+        shape = (last_year - first_year + 1, 366, self.nb_cells)
+        if self.readonly:
+            data = np.full(shape, np.nan)
+        else:
+            data = np.lib.format.open_memmap(self.path + '.new.npy', mode='w+', dtype='f8', shape=shape)
+            data[:] = np.nan
+        offset = self.first_year - first_year
+        self.first_year = first_year
+        if self.readonly:
+            data[offset:offset + self.data.shape[0]] = self.data
+            self.data = data
+            return
+        data[offset:offset + self._file.shape[0]] = self._file
+        data.flush()
+        del data
+        self.data = self._file = None
+        os.replace(self.path + '.new.npy', self.path + '.npy')
+        self.meta['first_year'] = first_year
+        self._write_meta()
+        self._map()
+        for years, doys, cells, values, _ in self._staged:
+            self.data[years - self.first_year, doys - 1, cells - 1] = values
+
+    def update(self, cell_ids, dates, values):
+        """
+        Store values into the cube. They are staged until commit() is called
+        Params:
+          * cell_ids: cell identifiers (1-based)
+          * dates: datetime64 array
+          * values: values array
+        """
+        years, doys = _years_and_doys(dates)
+        self.ensure_years(int(years.min()), int(years.max()))
+        cells = np.asarray(cell_ids, dtype='i8')
+        index = (years - self.first_year, doys - 1, cells - 1)
+        self._staged.append((years, doys, cells, np.asarray(values, dtype='f8'), self.data[index]))
+        self.data[index] = values
+
+    def commit(self, watermark=None):
+        """
+        Write the staged updates to the cube file (in readonly mode, they are only kept in memory). Meant to be called
+        once their data is committed into the DB
+        Params:
+          * watermark: if set, state of the DB table (see sagui.utils.db.dataset_watermark) the cube is now in sync with
+        """
+        if not self.readonly:
+            for years, doys, cells, values, _ in self._staged:
+                self._file[years - self.first_year, doys - 1, cells - 1] = values
+            self._file.flush()
+            if watermark is not None:
+                self.meta['watermark'] = watermark
+                self._write_meta()
+        self._staged = []
+
+    def discard(self):
+        """
+        Revert the staged updates (e.g. when their data was rolled back)
+        """
+        for years, doys, cells, _, previous in reversed(self._staged):
+            self.data[years - self.first_year, doys - 1, cells - 1] = previous
+        self._staged = []
+
+    def _write_meta(self):
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.meta, f)
+
+    def expected(self, dates, cell_ids, nb_days=NB_DAYS):
+        """
+        Compute the expected values
+        Params:
+          * dates: datetime64 array of the (distinct) dates to compute the expected values for
+          * cell_ids: cell identifiers (1-based) to compute the expected values for
+          * nb_days: half-width of the floating window
+        Returns: a (dates, cells) array
+        """
+        dates = np.asarray(dates).astype('datetime64[D]')
+        cells = np.asarray(cell_ids, dtype='i8') - 1
+        # Date of each (year, day of year) slot of the cube
+        years = np.arange(self.first_year, self.first_year + self.data.shape[0])
+        jan1 = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+        result = np.full((dates.size, cells.size), np.nan)
+        for i, d in enumerate(dates):
+            _, window_doys = _years_and_doys(d + np.arange(-nb_days, nb_days + 1))
+            window_doys = np.unique(window_doys)
+            slots_dates = jan1[:, None] + (window_doys - 1)[None, :]
+            year_idx, doy_idx = np.nonzero(slots_dates < d - nb_days)
+            if not year_idx.size:
+                continue
+            values = self.data[year_idx[:, None], window_doys[doy_idx][:, None] - 1, cells[None, :]]
+            with warnings.catch_warnings():
+                # All-NaN cells: no previous value, the expected value is NaN (NULL)
+                warnings.simplefilter('ignore', RuntimeWarning)
+                result[i] = np.nanmedian(values, axis=0)
+        return result
+
+    def load_from_db(self, cursor, schema, tablename, column):
+        """
+        Fill the cube with the values stored in the DB, one year at a time (each year is committed once loaded)
+        Returns: the nb of values loaded
+        """
+        cursor.execute('SELECT MIN("date"), MAX("date") FROM {}.{};'.format(schema, tablename))
+        date_min, date_max = cursor.fetchone()
+        if date_min is None:
+            return 0
+        self.ensure_years(date_min.year, date_max.year)
+        count = 0
+        for year in range(date_min.year, date_max.year + 1):
+            buffer = StringIO()
+            cursor.copy_expert(
+                'COPY (SELECT cell_id, "date", {col} FROM {schema}.{table} WHERE "date" >= \'{year}-01-01\' AND '
+                '"date" < \'{next_year}-01-01\') TO STDOUT WITH (FORMAT csv)'.format(
+                    col=column, schema=schema, table=tablename, year=year, next_year=year + 1), buffer)
+            if not buffer.tell():
+                continue
+            buffer.seek(0)
+            df = pd.read_csv(buffer, header=None, names=['cell_id', 'date', column], parse_dates=['date'])
+            df = df[df['cell_id'] <= self.nb_cells]
+            self.update(df['cell_id'].to_numpy(), df['date'].to_numpy(), df[column].to_numpy(dtype='f8', na_value=np.nan))
+            self.commit()
+            count += len(df)
+        return count
+
+
+def expected_and_anomaly(df, cube, column, nb_days=NB_DAYS):
+    """
+    Stage a page of data in the cube (see HistoryCube.commit), then compute the expected values and the anomaly for
+    the page's rows
+    Params:
+      * df: page of data (cell_id, date and source columns)
+      * cube: HistoryCube of the source column
+      * column: source column
+      * nb_days: half-width of the floating window
+    Returns: a 2-tuple of arrays (flow_expected, flow_anomaly), in the rows order
+    """
+    cell_ids = df['cell_id'].to_numpy()
+    dates = df['date'].to_numpy().astype('datetime64[D]')
+    current = df[column].to_numpy(dtype='f8', na_value=np.nan)
+    cube.update(cell_ids, dates, current)
+
+    unique_dates, date_idx = np.unique(dates, return_inverse=True)
+    unique_cells, cell_idx = np.unique(cell_ids, return_inverse=True)
+    expected = cube.expected(unique_dates, unique_cells, nb_days)[date_idx, cell_idx]
+    return expected, compute_anomaly(current, expected)
@@ -0,0 +1,203 @@
+"""
+DB utilities shared by the import commands.
+Bulk writes are done by streaming the data with COPY (binary format, see sagui.utils.pgcopy) into a temporary staging
+table, then merging the staging table into the destination table with a single, set-based INSERT ... ON CONFLICT
+statement
+"""
+
+from contextlib import contextmanager
+
+import pandas as pd
+from django.db import transaction
+from django.db.backends.utils import CursorWrapper
+
+from sagui.utils import pgcopy
+
+# Size of the chunks sent to COPY
+COPY_BUFFER_SIZE = 1 << 20
+
+
+@contextmanager
+def staging_table(cursor: CursorWrapper, schema: str, tablename: str, columns: list):
+    """
+    Context manager creating a temporary staging table, with the same column types than the destination table
+    (restricted to the given columns).
+    Temporary tables are not WAL-logged. The table is created inside a transaction (or a savepoint if already in a
+    transaction) and is dropped when leaving the block: ON COMMIT DROP only applies when the outermost transaction
+    commits, and the staging table may be created again before that (e.g. for the next page, when the import is run
+    inside an outer transaction).
+    On error, it is removed by the rollback of the savepoint
+    :param cursor: DB cursor (django.db.connection)
+    :param schema: schema of the destination table
+    :param tablename: destination table
+    :param columns: list of the columns to load
+    :return: yields the name of the staging table
+    """
+    staging_name = '{}_staging'.format(tablename)
+    with transaction.atomic():
+        cursor.execute(
+            '''
+            CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS SELECT {cols} FROM {schema}.{table} LIMIT 0;
+            '''.format(staging=staging_name, cols=','.join(columns), schema=schema, table=tablename)
+        )
+        yield staging_name
+        cursor.execute('DROP TABLE {staging};'.format(staging=staging_name))
+
+
+def copy_dataframe(cursor: CursorWrapper, df, tablename: str, binary: bool = True):
+    """
+    Stream a pandas DataFrame into a table, using COPY. The dataframe's column names have to match the table's columns
+    :param cursor: DB cursor (django.db.connection)
+    :param df: pandas dataframe to load
+    :param tablename: destination table (can be schema-qualified)
+    :param binary: use the binary COPY format (see sagui.utils.pgcopy). Falls back to the CSV format if some column
+    types are not supported by the binary encoder
+    """
+    copy_blocks(cursor, tablename, list(df.columns), [dataframe_arrays(df)], binary=binary)
+
+
+def copy_blocks(cursor: CursorWrapper, tablename: str, columns: list, blocks, binary: bool = True):
+    """
+    Stream blocks of rows into a table, using a single COPY statement. The blocks are encoded one after the other,
+    while being sent, so that only one block needs to be in memory
+    :param cursor: DB cursor (django.db.connection)
+    :param tablename: destination table (can be schema-qualified)
+    :param columns: list of the columns to load
+    :param blocks: iterable of lists of numpy arrays (one list per block, one array per column)
+    :param binary: use the binary COPY format (see copy_dataframe)
+    """
+    types = pgcopy.column_types(cursor, tablename, columns) if binary else None
+    if types and pgcopy.supported(types):
+        cursor.copy_expert('COPY {table} ({cols}) FROM STDIN WITH (FORMAT binary)'.format(
+            table=tablename, cols=','.join(columns)), pgcopy.CopyStream(pgcopy.encode(blocks, types)), size=COPY_BUFFER_SIZE)
+        return
+    # CSV format, cf https://naysan.ca/2020/05/09/pandas-to-postgresql-using-psycopg2-bulk-insert-performance-benchmark/
+    csv_blocks = (pd.DataFrame(dict(zip(columns, arrays)), copy=False).to_csv(header=False, index=False).encode()
+                  for arrays in blocks)
+    cursor.copy_expert('COPY {table} ({cols}) FROM STDIN WITH (FORMAT csv)'.format(
+        table=tablename, cols=','.join(columns)), pgcopy.CopyStream(csv_blocks), size=COPY_BUFFER_SIZE)
+
+
+def dataframe_arrays(df):
+    """
+    Returns: the columns of a DataFrame, as a list of numpy arrays (timezone-aware dates are converted to UTC, missing
+    values of the object and extension columns are converted to None)
+    """
+    arrays = []
+    for c in df.columns:
+        col = df[c]
+        if isinstance(col.dtype, pd.DatetimeTZDtype):
+            col = col.dt.tz_convert('UTC').dt.tz_localize(None)
+        elif col.dtype == object or pd.api.types.is_extension_array_dtype(col.dtype):
+            # missing values (pd.NA, NaN) as None
+            col = col.astype(object).where(col.notna(), None)
+        arrays.append(col.to_numpy())
+    return arrays
+
+
+def upsert_from_staging(cursor: CursorWrapper, schema: str, tablename: str, staging_name: str, columns: list,
+                        conflict_target: str, key_columns: list):
+    """
+    Merge the content of the staging table into the destination table, using an UPSERT statement
+    :param cursor: DB cursor (django.db.connection)
+    :param schema: schema of the destination table
+    :param tablename: destination table
+    :param staging_name: staging table name
+    :param columns: list of the columns to merge
+    :param conflict_target: conflict target, e.g. '(cell_id, date)' or 'ON CONSTRAINT my_unique_constraint'
+    :param key_columns: columns defining the conflict (they won't be updated)
+    :return: the number of rows inserted or updated
+    """
+    cols = ','.join(columns)
+    # Write the update statement (internal part). EXCLUDED is a PG internal table contained rejected rows from the insert
+    # see https://www.postgresql.org/docs/10/sql-insert.html#SQL-ON-CONFLICT
+    update_stmt = ','.join(['{n}=EXCLUDED.{n}'.format(n=c) for c in columns if c not in key_columns])
+    cursor.execute(
+        '''
+        INSERT INTO {schema}.{table} ({cols})
+        SELECT {cols} FROM {staging}
+        ON CONFLICT {target} DO UPDATE SET {updt_stmt};
+        '''.format(schema=schema, table=tablename, cols=cols, staging=staging_name, target=conflict_target,
+                   updt_stmt=update_stmt)
+    )
+    return cursor.rowcount
+
+
+def register_dataset_dates(cursor: CursorWrapper, tablename: str, dates):
+    """
+    Record the dates written into a data table in the dataset_dates catalog (see guyane.register_dataset_dates).
+    Should be called in the transaction writing the data
+    :param cursor: DB cursor (django.db.connection)
+    :param tablename: data table (not schema-qualified)
+    :param dates: dates of the written rows (dates, datetimes or numpy datetime64 values, possibly repeated)
+    :return: the number of dates registered
+    """
+    dates = pd.to_datetime(pd.Series(dates)).dt.date.dropna().unique().tolist()
+    if not dates:
+        return 0
+    cursor.execute('SELECT guyane.register_dataset_dates(%s, %s::date[]);', [tablename, dates])
+    return cursor.fetchone()[0]
+
+
+def dataset_watermark(cursor: CursorWrapper, tablename: str):
+    """
+    State of a data table, according to the dataset_dates catalog: last update time and nb of dates. It changes
+    whenever some data is written into the table (if its dates are registered, see register_dataset_dates)
+    :param cursor: DB cursor (django.db.connection)
+    :param tablename: data table (not schema-qualified)
+    :return: a JSON-serializable [last update time (ISO format) or None, nb of dates] list
+    """
+    cursor.execute('SELECT MAX(last_updated), COUNT(*) FROM guyane.dataset_dates WHERE tablename = %s;', [tablename])
+    last_updated, nb_dates = cursor.fetchone()
+    return [last_updated.isoformat() if last_updated else None, nb_dates]
+
+
+def drop_secondary_indexes(cursor: CursorWrapper, schema: str, tablename: str):
+    """
+    Drop the secondary indexes and the unique constraints of a table (the primary key is kept), to speed up a bulk
+    load. On a partitioned table, the partitions' indexes are dropped along with the parent's ones
+    :param cursor: DB cursor (django.db.connection)
+    :param schema: schema of the table
+    :param tablename: table name
+    :return: the list of the SQL statements re-creating the dropped indexes and constraints (see rebuild_indexes)
+    """
+    table = '{}.{}'.format(schema, tablename)
+    cursor.execute(
+        '''
+        SELECT 'ALTER TABLE ' || %(table)s || ' ADD CONSTRAINT ' || quote_ident(conname) || ' ' || pg_get_constraintdef(oid),
+               'ALTER TABLE ' || %(table)s || ' DROP CONSTRAINT ' || quote_ident(conname)
+        FROM pg_constraint WHERE conrelid = %(table)s::regclass AND contype = 'u'
+        UNION ALL
+        -- "ON ONLY" is used by pg_get_indexdef for the indexes of partitioned tables: the re-created index has to be
+        -- propagated to the partitions
+        SELECT replace(pg_get_indexdef(i.indexrelid), ' ON ONLY ', ' ON '),
+               'DROP INDEX ' || i.indexrelid::regclass::text
+        FROM pg_index i
+        WHERE i.indrelid = %(table)s::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid);
+        ''', {'table': table}
+    )
+    statements = cursor.fetchall()
+    for create_stmt, drop_stmt in statements:
+        cursor.execute(drop_stmt)
+    return [create_stmt for create_stmt, drop_stmt in statements]
+
+
+def rebuild_indexes(cursor: CursorWrapper, schema: str, tablename: str, statements: list,
+                    maintenance_work_mem: str = '1GB', parallel_workers: int = 4):
+    """
+    Re-create the indexes and constraints dropped by drop_secondary_indexes, using a parallel index build, then
+    ANALYZE the table
+    :param cursor: DB cursor (django.db.connection)
+    :param schema: schema of the table
+    :param tablename: table name
+    :param statements: SQL statements, as returned by drop_secondary_indexes
+    :param maintenance_work_mem: memory used by each index build (PostgreSQL setting)
+    :param parallel_workers: max nb of parallel workers used by each index build (PostgreSQL setting)
+    """
+    cursor.execute('SET maintenance_work_mem = %s;', [maintenance_work_mem])
+    cursor.execute('SET max_parallel_maintenance_workers = %s;', [parallel_workers])
+    for stmt in statements:
+        cursor.execute(stmt)
+    cursor.execute('ANALYZE {}.{};'.format(schema, tablename))
+    cursor.execute('RESET maintenance_work_mem; RESET max_parallel_maintenance_workers;')
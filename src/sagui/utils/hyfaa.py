@@ -5,3 +5,7 @@ import numpy as np
 julianday_to_datetime = lambda t: datetime(1950, 1, 1, tzinfo=timezone.utc) + timedelta(int(t))
 datetime_to_julianday = lambda t: (t - datetime(1950, 1, 1, tzinfo=timezone.utc)).total_seconds() / (24. * 3600.)
 vfunc_jd_to_dt = np.vectorize(julianday_to_datetime)
+
+# vectorized CNES Julian days to numpy datetime64 (day precision). Truncates the fractional part, like
+# julianday_to_datetime, but works on whole arrays without any python loop
+julianday_to_datetime64 = lambda t: np.datetime64('1950-01-01', 'D') + np.asarray(t).astype('i8').astype('timedelta64[D]')
@@ -0,0 +1,186 @@
+"""
+Instrumentation shared by the management commands: per-stage timers (with rows/s and MB/s throughput), a profiling
+mode (cProfile or pyinstrument) and a dry-run mode.
+Helps finding out, on a given run, whether the time is spent scanning the files, decoding the netCDF data, building
+the dataframes, writing into the DB or post-processing the data
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Stages, in the order they are reported
+STAGES = ['scan', 'read', 'transform', 'write', 'index_build', 'state', 'post_processing']
+
+
+class _StageCounter:
+    """
+    Counters for one stage. rows and nbytes can be set inside the `with timer.stage(...)` block, once they are known
+    """
+    def __init__(self):
+        self.time = 0
+        self.calls = 0
+        self.rows = 0
+        self.nbytes = 0
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in each stage, and the amount of data (rows, bytes) processed by each stage.
+    Thread-safe: the stages can be timed from a reader thread (see sagui.utils.pipeline)
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows=0, nbytes=0):
+        """
+        Time the enclosed block as part of the `name` stage
+        Yields: a counter object, whose rows and nbytes attributes can be incremented inside the block
+        """
+        counter = _StageCounter()
+        counter.rows, counter.nbytes = rows, nbytes
+        tic = perf_counter()
+        try:
+            yield counter
+        finally:
+            self.add(name, perf_counter() - tic, counter.rows, counter.nbytes)
+
+    def add(self, name, seconds, rows=0, nbytes=0):
+        """
+        Add a measure to the `name` stage
+        """
+        with self._lock:
+            counter = self.stages.setdefault(name, _StageCounter())
+            counter.time += seconds
+            counter.calls += 1
+            counter.rows += int(rows)
+            counter.nbytes += int(nbytes)
+
+    def report(self):
+        """
+        Returns: the stages timings and throughputs, as a human-readable table
+        """
+        names = [s for s in STAGES if s in self.stages] + [s for s in self.stages if s not in STAGES]
+        if not names:
+            return 'No stage was timed'
+        total = sum(self.stages[n].time for n in names)
+        lines = ['{:<16} {:>10} {:>7} {:>12} {:>12} {:>10}'.format('stage', 'time (s)', '%', 'rows', 'rows/s', 'MB/s')]
+        for n in names:
+            c = self.stages[n]
+            lines.append('{:<16} {:>10.2f} {:>6.1f}% {:>12} {:>12} {:>10}'.format(
+                n, c.time, 100 * c.time / total if total else 0,
+                c.rows or '',
+                '{:.0f}'.format(c.rows / c.time) if c.rows and c.time else '',
+                '{:.1f}'.format(c.nbytes / c.time / 1e6) if c.nbytes and c.time else ''))
+        return '\n'.join(lines)
+
+
+def peak_rss_mb():
+    """
+    Returns: the peak resident set size of the current process, in MB
+    """
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def profiling(output=None, profiler='cprofile', stdout=None):
+    """
+    Profile the enclosed block.
+    cprofile: the stats are dumped to `output` (open it with snakeviz, or pstats) and the 25 costliest functions
+    (cumulative time) are printed. pyinstrument: an HTML report is written to `output` and a summary is printed
+    Params:
+      * output: output file path
+      * profiler: 'cprofile' or 'pyinstrument' (needs the pyinstrument package)
+      * stdout: stream to print the summary to
+    """
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise CommandError('pyinstrument is not installed (pip install pyinstrument). Use --profiler cprofile')
+        p = Profiler()
+        p.start()
+        try:
+            yield
+        finally:
+            p.stop()
+            with open(output, 'w') as f:
+                f.write(p.output_html())
+            if stdout:
+                stdout.write(p.output_text(unicode=True))
+                stdout.write('Profile written to {}'.format(output))
+    else:
+        p = cProfile.Profile()
+        p.enable()
+        try:
+            yield
+        finally:
+            p.disable()
+            p.dump_stats(output)
+            if stdout:
+                s = io.StringIO()
+                pstats.Stats(p, stream=s).sort_stats('cumulative').print_stats(25)
+                stdout.write(s.getvalue())
+                stdout.write('Profile written to {}'.format(output))
+
+
+class InstrumentedCommand(BaseCommand):
+    """
+    Base class for the management commands, adding the --profile and --dry-run options and a per-stage timer
+    (self.timer), reported at the end of the command.
+    The commands are responsible for timing their stages and for honouring self.dry_run (no write into the DB, no
+    email sent...)
+    """
+    timer   = None
+    dry_run = False
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument('--dry-run', '--dry_run',
+                            dest='dry_run',
+                            default=False,
+                            action='store_true',
+                            help='Run the read and transform stages, without writing anything')
+        parser.add_argument('--profile',
+                            default=False,
+                            action='store_true',
+                            help='Profile the command. Only the main process is profiled')
+        parser.add_argument('--profiler',
+                            choices=['cprofile', 'pyinstrument'],
+                            default='cprofile',
+                            help='Profiler used with --profile (default cprofile. pyinstrument needs to be installed)')
+        parser.add_argument('--profile_output',
+                            default=None,
+                            help='Profile output file. Default: /tmp/<command>_<datetime>.prof (.html for pyinstrument)')
+        self._command_name = subcommand
+        return parser
+
+    def execute(self, *args, **options):
+        self.timer = StageTimer()
+        self.dry_run = options.get('dry_run', False)
+        if self.dry_run:
+            self.stdout.write('Dry run: nothing will be written')
+        if not options.get('profile'):
+            output = super().execute(*args, **options)
+        else:
+            profile_output = options.get('profile_output') or os.path.join('/tmp', '{}_{}.{}'.format(
+                getattr(self, '_command_name', self.__module__.split('.')[-1]),
+                datetime.now().strftime('%Y%m%dT%H%M%S'),
+                'html' if options.get('profiler') == 'pyinstrument' else 'prof'))
+            with profiling(profile_output, options.get('profiler'), self.stdout):
+                output = super().execute(*args, **options)
+        self.stdout.write(self.timer.report())
+        self.stdout.write('Peak RSS: {:.0f} MB'.format(peak_rss_mb()))
+        return output
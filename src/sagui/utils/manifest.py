@@ -0,0 +1,128 @@
+"""
+Persistent manifest of the input files (rainfall netcdf files, atmo images): the folders only grow, so instead of
+globbing the whole folder on each import / each API call, the manifest (sagui_filesmanifest table) is maintained
+incrementally and queried through its indexes.
+The manifest is only written by the commands (imports, refresh_manifest): the API reads it (latest_files).
+A folder is scanned (os.scandir) only when its modification time changed since the last scan (mtime watermark), and
+only the new files are stat'ed
+"""
+
+import os
+import re
+import time
+from datetime import datetime, timezone
+
+from django.db import transaction
+
+from sagui.models import FilesManifest, FilesManifestFolder
+
+# A folder modified less than WATERMARK_DELAY seconds ago might still be written into, within the same mtime
+# (coarse-grained filesystem timestamps): its watermark is not stored, so that it is scanned again next time
+WATERMARK_DELAY = 2
+
+
+def _parse_rainfall(name):
+    """
+    Rainfall files are named like <prefix>DATA_<data date>_<download date><seconds>_<n>.nc
+    Returns: (data date, version stamp)
+    """
+    d = re.search(r'DATA_(\d{4})(\d{2})(\d{2})T(\d{2})(\d{2})', name)
+    v = re.search(r'DATA_[0-9T]*_(\d{8}T\d{4})[0-9]*_[0-9]*\.nc', name)
+    file_date = datetime(*[int(g) for g in d.groups()], tzinfo=timezone.utc) if d else None
+    return file_date, v.group(1) if v else ''
+
+
+def _parse_atmo(name):
+    """
+    Atmo images are named like <prefix><YYYYMMDD><suffix>_aai.png
+    Returns: (data date, version stamp)
+    """
+    d = re.search(r'[0-9]{8}', name)
+    file_date = datetime.strptime(d[0], '%Y%m%d').replace(tzinfo=timezone.utc) if d else None
+    return file_date, ''
+
+
+# For each kind of files: (file name pattern, file name parser)
+KINDS = {
+    'rainfall': (re.compile(r'.*\.nc$'), _parse_rainfall),
+    'atmo': (re.compile(r'.*_aai\.png$'), _parse_atmo),
+}
+
+
+def refresh_folder(path, kind):
+    """
+    Update the manifest of a folder: new files are added, deleted files removed. Does nothing if the folder was not
+    modified since the last scan
+    Params:
+      * path: folder path
+      * kind: kind of files in the folder (key of KINDS)
+    Returns: the FilesManifestFolder object
+    """
+    pattern, parser = KINDS[kind]
+    path = os.path.normpath(path)
+    folder, created = FilesManifestFolder.objects.get_or_create(path=path, defaults={'kind': kind})
+    try:
+        dir_mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return folder
+    if not created and folder.mtime_watermark == dir_mtime:
+        return folder
+
+    with os.scandir(path) as it:
+        entries = {e.name: e for e in it if pattern.match(e.name) and e.is_file()}
+    with transaction.atomic():
+        known = set(FilesManifest.objects.filter(folder=folder).values_list('name', flat=True))
+        new_files = []
+        for name in entries.keys() - known:
+            try:
+                st = entries[name].stat()
+            except FileNotFoundError:
+                # deleted in-between
+                continue
+            file_date, version = parser(name)
+            new_files.append(FilesManifest(folder=folder, name=name, file_date=file_date, version=version,
+                                           size=st.st_size, mtime=st.st_mtime))
+        FilesManifest.objects.bulk_create(new_files, batch_size=1000, ignore_conflicts=True)
+        deleted = known - entries.keys()
+        if deleted:
+            FilesManifest.objects.filter(folder=folder, name__in=deleted).delete()
+
+        folder.kind = kind
+        folder.last_scan = datetime.now(timezone.utc)
+        folder.mtime_watermark = dir_mtime if time.time() - dir_mtime > WATERMARK_DELAY else None
+        folder.save()
+    return folder
+
+
+def latest_files(path, kind, n):
+    """
+    Read-only lookup of the n latest files of a folder (by name, descending), for the API: the manifest is used if the
+    folder was not modified since its last scan (see refresh_folder, run by the imports and the refresh_manifest
+    command), otherwise the folder is listed
+    Params:
+      * path: folder path
+      * kind: kind of files in the folder (key of KINDS)
+      * n: nb of files to return
+    Returns: the list of the file names
+    """
+    pattern, _ = KINDS[kind]
+    path = os.path.normpath(path)
+    folder = FilesManifestFolder.objects.filter(path=path).first()
+    try:
+        dir_mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return []
+    if folder is not None and folder.mtime_watermark == dir_mtime:
+        return list(FilesManifest.objects.filter(folder=folder).order_by('-name').values_list('name', flat=True)[:n])
+    with os.scandir(path) as it:
+        return sorted((e.name for e in it if pattern.match(e.name) and e.is_file()), reverse=True)[:n]
+
+
+def mark_imported(files):
+    """
+    Set the import status of the files to 'imported'
+    Params:
+      * files: queryset, or list of FilesManifest objects
+    """
+    FilesManifest.objects.filter(pk__in=[f.pk for f in files]).update(
+        import_status=FilesManifest.ImportStatus.IMPORTED, imported_at=datetime.now(timezone.utc))
@@ -0,0 +1,182 @@
+"""
+PostgreSQL binary COPY encoder, shared by the bulk loaders (see sagui.utils.db.copy_dataframe).
+The numpy column arrays are encoded directly into the binary COPY format (https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4):
+no float-to-text formatting on the client side, and no text parsing on the server side.
+The rows are encoded by chunks, using a numpy structured array matching the binary layout of the rows (fixed-width
+types only), so that the encoding is vectorized and the memory use bounded. Rows with NULL values (NaN, NaT) have a
+variable width: the chunks containing some are encoded with a (slower) scatter into a flat byte buffer
+"""
+
+import io
+import struct
+
+import numpy as np
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+
+# PostgreSQL epoch (2000-01-01), relative to the unix epoch
+_PG_EPOCH_DAYS = 10957
+_PG_EPOCH_US = _PG_EPOCH_DAYS * 86400 * 1000000
+
+# Supported PostgreSQL types: big-endian numpy type of their binary representation
+PG_TYPES = {
+    'bool': np.dtype('?'),
+    'int2': np.dtype('>i2'),
+    'int4': np.dtype('>i4'),
+    'int8': np.dtype('>i8'),
+    'float4': np.dtype('>f4'),
+    'float8': np.dtype('>f8'),
+    'date': np.dtype('>i4'),
+    'timestamp': np.dtype('>i8'),
+    'timestamptz': np.dtype('>i8'),
+}
+
+# Default nb of rows encoded at once
+CHUNK_ROWS = 1 << 16
+
+
+def column_types(cursor, tablename, columns):
+    """
+    Retrieve the types of the columns of a table (temporary tables included)
+    :param cursor: DB cursor (django.db.connection)
+    :param tablename: table name (can be schema-qualified)
+    :param columns: list of column names
+    :return: the list of the types names (pg_type.typname), in the columns order
+    """
+    cursor.execute(
+        '''
+        SELECT a.attname, t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped;
+        ''', [tablename]
+    )
+    types = dict(cursor.fetchall())
+    return [types[c] for c in columns]
+
+
+def supported(types):
+    """
+    Returns: True if all the given types can be encoded
+    """
+    return all(t in PG_TYPES for t in types)
+
+
+def _to_pg(values, pg_type):
+    """
+    Convert a column array into the binary representation of the PostgreSQL type
+    Returns: (big-endian array, null mask or None)
+    """
+    values = np.asarray(values)
+    if pg_type == 'date':
+        values = values.astype('datetime64[D]')
+    elif pg_type in ('timestamp', 'timestamptz'):
+        values = values.astype('datetime64[us]')
+    if values.dtype.kind == 'M':
+        nulls = np.isnat(values)
+        values = values.view('i8') - (_PG_EPOCH_DAYS if pg_type == 'date' else _PG_EPOCH_US)
+    elif values.dtype.kind == 'f':
+        nulls = np.isnan(values)
+        if pg_type not in ('float4', 'float8') and nulls.any():
+            values = np.where(nulls, 0, values)
+    elif values.dtype.kind == 'O':
+        nulls = np.array([v is None or v != v for v in values], dtype='?')
+        values = np.where(nulls, 0, values)
+    else:
+        nulls = None
+    if nulls is not None and not nulls.any():
+        nulls = None
+    return values.astype(PG_TYPES[pg_type], copy=False), nulls
+
+
+def _encode_chunk(arrays, nulls):
+    """
+    Encode rows into the binary COPY format
+    :param arrays: list of big-endian arrays (one per column), see _to_pg
+    :param nulls: list of null masks (or None) for each column
+    :return: the encoded rows (numpy uint8 array)
+    """
+    nb_rows = arrays[0].size
+    if all(n is None for n in nulls):
+        # Fixed-width rows: fill a structured array whose layout is the layout of the rows
+        fields = [('n', '>i2')]
+        for i, a in enumerate(arrays):
+            fields += [('l{}'.format(i), '>i4'), ('v{}'.format(i), a.dtype)]
+        rows = np.empty(nb_rows, dtype=np.dtype(fields))
+        rows['n'] = len(arrays)
+        for i, a in enumerate(arrays):
+            rows['l{}'.format(i)] = a.dtype.itemsize
+            rows['v{}'.format(i)] = a
+        return rows.view(np.uint8)
+
+    # Variable-width rows: compute the offset of each field, and scatter the values' bytes into a flat buffer
+    widths = [np.where(n, 4, 4 + a.dtype.itemsize) if n is not None else np.full(nb_rows, 4 + a.dtype.itemsize)
+              for a, n in zip(arrays, nulls)]
+    row_sizes = 2 + np.sum(widths, axis=0)
+    pos = np.concatenate(([0], np.cumsum(row_sizes)[:-1]))
+    buffer = np.empty(int(row_sizes.sum()), dtype=np.uint8)
+
+    def scatter(positions, values):
+        # explicit width: the chunk can have no value to scatter (all NULL)
+        values = values.view(np.uint8).reshape(positions.size, values.dtype.itemsize)
+        buffer[positions[:, None] + np.arange(values.shape[1])] = values
+
+    scatter(pos, np.full(nb_rows, len(arrays), dtype='>i2'))
+    pos = pos + 2
+    for a, n in zip(arrays, nulls):
+        width = a.dtype.itemsize
+        if n is None:
+            scatter(pos, np.full(nb_rows, width, dtype='>i4'))
+            scatter(pos + 4, a)
+            pos = pos + 4 + width
+        else:
+            scatter(pos, np.where(n, -1, width).astype('>i4'))
+            scatter(pos[~n] + 4, a[~n])
+            pos = pos + 4 + np.where(n, 0, width)
+    return buffer
+
+
+def encode(blocks, types, chunk_rows=CHUNK_ROWS):
+    """
+    Encode blocks of rows into the binary COPY format
+    :param blocks: iterable of lists of column arrays (one list per block, one array per column, in the order of types)
+    :param types: types of the destination columns (see column_types)
+    :param chunk_rows: max nb of rows encoded at once
+    :return: yields the encoded data (bytes-like objects): header, rows, trailer
+    """
+    yield HEADER
+    for arrays in blocks:
+        nb_rows = len(arrays[0]) if arrays else 0
+        for start in range(0, nb_rows, chunk_rows):
+            converted = [_to_pg(a[start:start + chunk_rows], t) for a, t in zip(arrays, types)]
+            yield _encode_chunk([c[0] for c in converted], [c[1] for c in converted])
+    yield TRAILER
+
+
+class CopyStream(io.RawIOBase):
+    """
+    Read-only binary file-like object, reading from an iterator of bytes-like objects (e.g. encode()). Used to stream
+    the encoded data to COPY (cursor.copy_expert) without concatenating it
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iter(iterator)
+        self._block = memoryview(b'')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size is None or size < 0 or size > 0:
+            if self._pos >= len(self._block):
+                try:
+                    self._block, self._pos = memoryview(next(self._iterator)).cast('B'), 0
+                except StopIteration:
+                    break
+            end = len(self._block) if size is None or size < 0 else min(len(self._block), self._pos + size)
+            parts.append(self._block[self._pos:end])
+            if size is not None and size >= 0:
+                size -= end - self._pos
+            self._pos = end
+        return b''.join(parts)
@@ -0,0 +1,89 @@
+"""
+Producer/consumer pipeline used by the import commands: a reader thread decodes the next pages (netCDF reading,
+dataframe building) into a bounded queue, while the main thread writes the current page into the DB.
+netCDF4/HDF5 and psycopg2 both release the GIL while doing I/O, so the two stages actually overlap.
+"""
+
+import queue
+import threading
+from time import perf_counter
+
+# Marks the end of the production
+_END = object()
+
+
+class Pipeline:
+    """
+    Iterate over the items of `producer`, the items being produced by a reader thread, ahead of the consumer.
+    At most `queue_depth` items are buffered.
+    Collects some stats: time spent producing the items (read), time spent by the consumer on each item (write),
+    time the consumer had to wait for the reader, and the queue occupancy
+    """
+
+    def __init__(self, producer, queue_depth=2):
+        self.producer = producer
+        self.queue_depth = queue_depth
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.read_time = 0
+        self.write_time = 0
+        self.wait_time = 0
+        self.nb_items = 0
+        self.queue_occupancy = []
+        self._error = None
+        self._stop = threading.Event()
+
+    def _produce(self):
+        try:
+            iterator = iter(self.producer)
+            while not self._stop.is_set():
+                tic = perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.read_time += perf_counter() - tic
+                self._put(item)
+        except BaseException as error:
+            self._error = error
+        finally:
+            self._put(_END)
+
+    def _put(self, item):
+        # Don't block forever if the consumer stopped iterating
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        reader = threading.Thread(target=self._produce, name='pipeline-reader', daemon=True)
+        reader.start()
+        try:
+            while True:
+                tic = perf_counter()
+                self.queue_occupancy.append(self.queue.qsize())
+                item = self.queue.get()
+                self.wait_time += perf_counter() - tic
+                if item is _END:
+                    break
+                tic = perf_counter()
+                yield item
+                self.write_time += perf_counter() - tic
+                self.nb_items += 1
+        finally:
+            self._stop.set()
+            reader.join()
+        if self._error:
+            raise self._error
+
+    def summary(self):
+        """
+        Returns: the pipeline stats, as a human-readable string
+        """
+        mean_occupancy = sum(self.queue_occupancy) / len(self.queue_occupancy) if self.queue_occupancy else 0
+        return ('Pipeline: {nb} pages, queue depth {depth} (mean occupancy {occ:.1f}). '
+                'Read: {read:.2f} s, write: {write:.2f} s, writer waiting for the reader: {wait:.2f} s').format(
+            nb=self.nb_items, depth=self.queue_depth, occ=mean_occupancy,
+            read=self.read_time, write=self.write_time, wait=self.wait_time)
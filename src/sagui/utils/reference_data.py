@@ -9,10 +9,11 @@ from django.db.backends.utils import CursorWrapper
 import pandas as pd
 import numpy as np
 from contextlib import contextmanager
-from io import StringIO
 from typing import Any
 
 from .. import models
+from . import db
+from .instrumentation import StageTimer
 
 # Used in next function, to encapsulate the SQL copy command in a with block that handles
 # the temp table
@@ -36,7 +37,7 @@ def setup_teardown_temp_tables(cursor: CursorWrapper):
         )
 
 
-def import_csv(csv_file: Any):
+def import_csv(csv_file: Any, dry_run: bool = False, timer: StageTimer = None):
     """
     Parse a CSV data file and try to import as much as possible into the DB (table stations_reference_flow)
     Expected content for the csv file is expected to be produced by the reference_data_from_MGB_run.py script
@@ -50,21 +51,54 @@ def import_csv(csv_file: Any):
         ...
     ref_period should already exist in the DB table stations_reference_flow_period
     :param csv_file: can be any input accepted by pandas read_csv function: file path, stream, ByteIO
+    :param dry_run: if True, the data is read and prepared but not written into the DB
+    :param timer: StageTimer collecting the stages timings (optional)
     :return:
     """
-    # Get list of available periods (declared in UI/DB)
-    periods = models.StationsReferenceFlowPeriod.objects.all().values()
-    period_names = [p['period'] for p in periods]
-
-    # Get list of station ids (only allow to try to import those)
-    stations = models.Stations.objects.values('id', 'name', 'minibasin').order_by('id')
-    df = pd.read_csv(csv_file, sep=',', dtype={
-        'ref_period': "string",
-        'mini': 'int16',
-        'day_of_year': 'int16',
-        'flow': 'float32',
-    })
+    timer = timer or StageTimer()
+    with timer.stage('read') as stage:
+        # Get list of available periods (declared in UI/DB)
+        periods = models.StationsReferenceFlowPeriod.objects.all().values()
+        period_names = [p['period'] for p in periods]
 
+        # Get list of station ids (only allow to try to import those)
+        stations = models.Stations.objects.values('id', 'name', 'minibasin').order_by('id')
+        df = pd.read_csv(csv_file, sep=',', dtype={
+            'ref_period': "string",
+            'mini': 'int16',
+            'day_of_year': 'int16',
+            'flow': 'float32',
+        })
+        stage.rows, stage.nbytes = len(df), df.memory_usage(index=False).sum()
+
+    with timer.stage('transform'):
+        _prepare_dataframe(df, periods, period_names, stations)
+
+    if dry_run:
+        return
+
+    # Write the data into the DB using copy from and an upsert query
+    # Inspired from https://www.thebookofjoel.com/django-fast-bulk-upsert
+    columns = ['period_id', 'station_id', 'day_of_year', 'flow']
+    with timer.stage('write', rows=len(df), nbytes=df[columns].memory_usage(index=False).sum()):
+        with connection.cursor() as cursor:
+            with setup_teardown_temp_tables(cursor):
+                db.copy_dataframe(cursor, df[columns], 'stations_reference_flow_temp')
+                cursor.execute(
+                    '''
+                    INSERT INTO stations_reference_flow (period_id, station_id, day_of_year, flow)
+                    SELECT t.period_id, t.station_id, t.day_of_year, t.flow
+                    FROM stations_reference_flow_temp t
+                    ON CONFLICT(period_id, station_id, day_of_year) DO UPDATE SET
+                        flow = EXCLUDED.flow
+                    '''
+                )
+
+
+def _prepare_dataframe(df, periods, period_names, stations):
+    """
+    Filter and map the CSV data (in place) to the stations_reference_flow table structure
+    """
     # filter out periods that are not valid (not declared)
     df.query("ref_period in " + str(period_names), inplace=True)
 
@@ -85,22 +119,3 @@ def import_csv(csv_file: Any):
 
     # Save to CSV file
     df.to_csv('/tmp/df2.csv', index=False)
-
-    # save dataframe to an in memory buffer, cf https://naysan.ca/2020/05/09/pandas-to-postgresql-using-psycopg2-bulk-insert-performance-benchmark/
-    buffer = StringIO()
-    df.to_csv(buffer, columns=['period_id', 'station_id', 'day_of_year', 'flow'], header=False, index=True)
-    buffer.seek(0)
-    # Write the data into the DB using copy from and an upsert query
-    # Inspired from https://www.thebookofjoel.com/django-fast-bulk-upsert
-    with connection.cursor() as cursor:
-        with setup_teardown_temp_tables(cursor):
-            cursor.copy_from(buffer, 'stations_reference_flow_temp', sep=",")
-            cursor.execute(
-                '''
-                INSERT INTO stations_reference_flow (period_id, station_id, day_of_year, flow)
-                SELECT t.period_id, t.station_id, t.day_of_year, t.flow
-                FROM stations_reference_flow_temp t
-                ON CONFLICT(period_id, station_id, day_of_year) DO UPDATE SET
-                    flow = EXCLUDED.flow
-                '''
-            )
@@ -0,0 +1,58 @@
+"""
+Dependency-aware, parallel scheduler of the post-processing steps, run by the post-processing worker (sagui_worker
+command).
+The post-processing of a table is made of steps (expected and anomaly values, rolling windows and aggregate tables,
+stations snapshots...), listed with their dependencies by guyane.post_processing_steps. The steps are run in
+topological order, the independent branches in parallel, each step in its own thread (and DB connection). When a step
+fails, the steps depending on it are skipped.
+The scheduler used to refresh the materialized views depending on the imported table: they were replaced by aggregate
+tables maintained by the post-processing steps (migration 0063)
+"""
+
+import graphlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def schedule(dependencies, run, max_workers=4, on_done=None):
+    """
+    Run tasks in topological order, the independent ones in parallel threads
+    :param dependencies: dict giving, for each task, the set of the tasks it depends on (the tasks not in the dict
+    are ignored)
+    :param run: function run(task), returning True if the task succeeded. An exception means the task failed
+    :param max_workers: max nb of tasks run concurrently
+    :param on_done: if set, function on_done(task, result) called (in the calling thread) when a task is done
+    :return: a dict giving, for each task, True if it succeeded, False if it failed, None if it was skipped (one of its
+    dependencies did not succeed), in the order the tasks were done
+    """
+    dependencies = {task: set(deps) & set(dependencies) for task, deps in dependencies.items()}
+    sorter = graphlib.TopologicalSorter(dependencies)
+    sorter.prepare()
+
+    def _run(task):
+        try:
+            return bool(run(task))
+        except Exception:
+            return False
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scheduler') as executor:
+        running = {}
+        while sorter.is_active():
+            for task in sorter.get_ready():
+                if all(results[d] for d in dependencies[task]):
+                    running[executor.submit(_run, task)] = task
+                    continue
+                results[task] = None
+                sorter.done(task)
+                if on_done:
+                    on_done(task, None)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                results[task] = future.result()
+                sorter.done(task)
+                if on_done:
+                    on_done(task, results[task])
+    return results
@@ -23,7 +23,8 @@ def get_global_alert_info():
             query = '''
         -- Use current day+5d for forecast alerts
         WITH most_recent_date AS (
-            SELECT DISTINCT "date"+5 AS d FROM guyane.hyfaa_data_assimilated ORDER BY d DESC LIMIT 1
+            SELECT "date"+5 AS d FROM guyane.dataset_dates WHERE tablename = 'hyfaa_data_assimilated'
+            ORDER BY "date" DESC LIMIT 1
         ) ,
         flows AS (
             SELECT cell_id, flow, "date" FROM guyane.{tbl}
@@ -4,10 +4,12 @@ from datetime import date, timedelta, datetime
 import logging
 import os
 import re
-from glob import glob
 
 from django.core import serializers
+from django.db.models import Max
 from django.http import HttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.contrib.staticfiles.storage import staticfiles_storage
 from rest_framework import generics, status
 from rest_framework.pagination import PageNumberPagination
@@ -22,7 +24,7 @@ from django.conf import settings
 from django.shortcuts import render
 
 from sagui import serializers, models
-from sagui.utils import atmo, rain, \
+from sagui.utils import atmo, manifest, rain, \
     stations_forecast as stations_forecast_utils, \
     stations_alert as stations_alert_utils
 
@@ -143,6 +145,14 @@ class LargeResultsSetPagination(PageNumberPagination):
     max_page_size = 10000
 
 
+def _snapshot_last_modified(model):
+    """
+    Last-Modified function for the views reading a stations snapshot table: time the snapshot was computed
+    """
+    return lambda request, *args, **kwargs: model.objects.aggregate(m=Max('computed_at'))['m']
+
+
+@method_decorator(condition(last_modified_func=_snapshot_last_modified(models.StationsWithFlowAlerts)), name='get')
 class StationsAlertList(generics.ListAPIView):
     """
     Get the list of stations, as geojson.
@@ -153,6 +163,7 @@ class StationsAlertList(generics.ListAPIView):
     queryset = models.StationsWithFlowAlerts.objects.all()
 
 
+@method_decorator(condition(last_modified_func=_snapshot_last_modified(models.StationsWithFlowPrevi)), name='get')
 class StationsPreviList(generics.ListAPIView):
     serializer_class = serializers.StationsWithFlowPreviGeoSerializer
     pagination_class = LargeResultsSetPagination
@@ -265,7 +276,7 @@ class StationsPreviRecordsById(generics.GenericAPIView):
         nb_days_backward = int(nb_days_backward)
 
         # Get last date available from the DB
-        ref_date = models.DataAssimilated.objects.latest('date').date
+        ref_date = models.DatasetDate.objects.filter(tablename='hyfaa_data_assimilated').latest('date').date
         from_date = ref_date - timedelta(days=nb_days_backward)
 
         # 1. Get station records
@@ -401,7 +412,7 @@ class StationFlowRecordsById(generics.GenericAPIView):
         # Get last date available from the DB
         ref_date = None
         try:
-            ref_date = models.DataAssimilated.objects.latest('date').date
+            ref_date = models.DatasetDate.objects.filter(tablename='hyfaa_data_assimilated').latest('date').date
         except:
             logger.error("Impossible to retrieve last date for data from hyfaa_data_assimilated table. Are you sure it's not empty ?")
             return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -549,7 +560,7 @@ class AtmoAlertsFilesList(generics.GenericAPIView):
         nb_days_backward = int(nb_days_backward)
 
         files_path = settings.SAGUI_SETTINGS.get('SAGUI_PATH_TO_ATMO_FILES', '')
-        files_list = sorted(glob(f'{files_path}/*_aai.png'), reverse=True)[:10]
+        files_list = manifest.latest_files(files_path, 'atmo', 10)
 
         results = {
             'count': len(files_list),
@@ -565,7 +576,7 @@ class AtmoAlertsFilesList(generics.GenericAPIView):
             'results': [],
         }
         for f in files_list:
-            d = datetime.strptime(re.search(r"[0-9]{8}", os.path.basename(f))[0], '%Y%m%d').strftime("%Y-%m-%d")
+            d = datetime.strptime(re.search(r"[0-9]{8}", f)[0], '%Y%m%d').strftime("%Y-%m-%d")
             results['results'].append({
                 'date': d,
                 'png': self.request.build_absolute_uri(f'/atmo/styled/{os.path.basename(f)}'),
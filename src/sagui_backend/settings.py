@@ -191,6 +191,9 @@ SAGUI_SETTINGS = {
     'HYFAA_DATABASE_URI': env('HYFAA_DATABASE_URI', default=None),
     'HYFAA_DATABASE_SCHEMA': env('HYFAA_DATABASE_SCHEMA', default='guyane'),
     'HYFAA_IMPORT_COMMIT_PAGE_SIZE': env('HYFAA_IMPORT_COMMIT_PAGE_SIZE', default=1),
+    # inline: the import commands run the post-processing jobs they queued before exiting.
+    # worker: they are left to a sagui_worker service
+    'POST_PROCESSING_MODE': env('SAGUI_POST_PROCESSING_MODE', default='inline'),
     'HYFAA_IMPORT_STRUCTURE_CONFIG': {
      # Configures where to find the netcdf data and what to retrieve (var names)
      # Also configures the names mapping between the netcdf data and the database
@@ -203,7 +206,11 @@ SAGUI_SETTINGS = {
                     'water_elevation_catchment_mean',
                     'streamflow_catchment_mean',
                  ],
-                'tablename': 'hyfaa_data_mgbstandard'
+                'tablename': 'hyfaa_data_mgbstandard',
+                # date range partitioning of the table (year|month), cf migration 0053
+                'partition_by': 'year',
+                # where to store the cells filtered out by the ordem filter (--cold_storage), cf migration 0055
+                'cold_tablename': 'hyfaa_data_mgbstandard_cold'
             },
             {
                 'name': 'forecast',
@@ -218,7 +225,8 @@ SAGUI_SETTINGS = {
                     'streamflow_catchment_std',
                     'streamflow_catchment_mad',
                  ],
-                'tablename': 'hyfaa_data_forecast'
+                'tablename': 'hyfaa_data_forecast',
+                'partition_by': 'month'
             },
             {
                 'name': 'assimilated',
@@ -233,7 +241,9 @@ SAGUI_SETTINGS = {
                     'streamflow_catchment_std',
                     'streamflow_catchment_mad',
                  ],
-                'tablename': 'hyfaa_data_assimilated'
+                'tablename': 'hyfaa_data_assimilated',
+                'partition_by': 'year',
+                'cold_tablename': 'hyfaa_data_assimilated_cold'
             },
           ],
           'short_names': {